@@ -0,0 +1,233 @@
+"""
+End-to-end benchmark of ask_question without Gemini or Atlas.
+
+Loads synthetic milk_collections documents into a MongoDB stand-in (in-memory mongomock by
+default, or a local mongod via --mongodb-uri), answers LLM calls with a deterministic fake
+model that returns recorded queries, and replays a corpus built from get_sample_questions()
+and the prompt examples. Reports per-stage latency, throughput and peak memory; --json
+saves the report and --compare flags regressions against a saved one.
+
+Run with:  python bench_ask_question.py [--docs 100k] [--rounds 5] [--json out.json]
+For 1M-10M documents use a local mongod:  --mongodb-uri mongodb://localhost:27017 --load
+"""
+import argparse
+import contextlib
+import io
+import json
+import re
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from fakes import FakeGeminiModel, FakeMongoClient, generate_milk_collections
+from instrumentation import Instrumentation
+from prompt_builder import DEFAULT_EXAMPLES
+from v1 import EnhancedMongoDBBot
+
+# Queries recorded for get_sample_questions(); the prompt examples carry their own
+SAMPLE_QUERIES = {
+    "Show me 5 collections for member 730110400002":
+        'find({"memberCode": "730110400002"}).limit(5)',
+    "What are the details for dcsCode 001000001993 between 01/01/2025 and 03/01/2025?":
+        'find({"dcsCode": "001000001993", "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-01-04T00:00:00Z")}})',
+    "Find records where fat is greater than 4.1 and limit to 3 results":
+        'find({"fat": {"$gt": 4.1}}).limit(3)',
+    "List top 3 members by total quantity":
+        'aggregate([{"$group": {"_id": "$memberCode", "totalQty": {"$sum": "$qty"}}}, {"$sort": {"totalQty": -1}}, {"$limit": 3}])',
+    "Count records for member 730110400002":
+        'count_documents({"memberCode": "730110400002"})',
+    "List 5 unique dcs codes where fat is over 4.0":
+        'distinct("dcsCode", {"fat": {"$gt": 4.0}})',
+    "Which member has the highest average SNF?":
+        'aggregate([{"$group": {"_id": "$memberCode", "avgSNF": {"$avg": "$snf"}}}, {"$sort": {"avgSNF": -1}}, {"$limit": 1}])',
+    "Compare average quantity for member 0010000008650047 and 760540500086":
+        'aggregate([{"$match": {"memberCode": {"$in": ["0010000008650047", "760540500086"]}}}, {"$group": {"_id": "$memberCode", "avgQty": {"$avg": "$qty"}}}])',
+    "What is the trend of average fat per month in 2024?":
+        'aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-01-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgFat": {"$avg": "$fat"}}}, {"$sort": {"_id.month": 1}}])',
+    "What is the lowest quantity collected on 09-11-2024?":
+        'aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-11-09T00:00:00Z"), "$lt": ISODate("2024-11-10T00:00:00Z")}}}, {"$sort": {"qty": 1}}, {"$limit": 1}])',
+}
+MEMBER_CODE = re.compile(r'"memberCode":\s*(?:"(\d+)"|\{"\$in":\s*\[([^\]]*)\])')
+DCS_CODE = re.compile(r'"dcsCode":\s*(?:"(\d+)"|\{"\$in":\s*\[([^\]]*)\])')
+STAGE_ORDER = ('route', 'prompt_build', 'llm_call', 'validate', 'parse', 'govern', 'execute', 'count', 'format', 'question')
+
+
+def replay_corpus():
+    """(question, recorded query) pairs from get_sample_questions() and the prompt examples."""
+    corpus = dict(SAMPLE_QUERIES)
+    for question, query in DEFAULT_EXAMPLES:
+        corpus.setdefault(question, query)
+    return list(corpus.items())
+
+
+def corpus_codes(corpus, pattern):
+    """Codes referenced by the recorded queries, so the synthetic data contains them."""
+    codes = []
+    for _, query in corpus:
+        for single, listed in pattern.findall(query):
+            for code in [single] if single else re.findall(r'"(\d+)"', listed):
+                if code not in codes:
+                    codes.append(code)
+    return codes
+
+
+def parse_count(text):
+    """Accepts 10000, 10k, 2.5M."""
+    text = text.strip().lower()
+    scale = {'k': 1_000, 'm': 1_000_000}.get(text[-1:])
+    return int(float(text[:-1]) * scale) if scale else int(text)
+
+
+def load_documents(collection, documents, batch_size=10000):
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def build_bot(args, corpus, instrumentation):
+    documents = generate_milk_collections(
+        args.docs, start=datetime(2024, 1, 1), days=425, seed=args.seed,
+        member_codes=corpus_codes(corpus, MEMBER_CODE), dcs_codes=corpus_codes(corpus, DCS_CODE))
+    if args.mongodb_uri:
+        import pymongo
+        client = pymongo.MongoClient(args.mongodb_uri)
+        if args.load:
+            collection = client['lactalis_db']['milk_collections']
+            collection.drop()
+            load_documents(collection, documents)
+    else:
+        client = FakeMongoClient(documents, latency=args.mongo_latency)
+    model = FakeGeminiModel(dict(corpus), latency=args.llm_latency)
+    # The stand-in's data must not be profiled into (or from) the real schema cache file
+    options = {} if args.mongodb_uri else {'schema_cache_path': None}
+    if args.all_llm:
+        # Every question takes the LLM path (no local routing, no template reuse)
+        options['query_cache_size'] = 0
+    if args.query_policy:
+        options['query_policy_path'] = args.query_policy
+    bot = EnhancedMongoDBBot(None, None, model=model, client=client, instrumentation=instrumentation, **options)
+    if args.all_llm:
+        bot.router.route = lambda question: None
+    return bot
+
+
+def peak_memory(bot, questions):
+    """Largest Python heap growth (tracemalloc) while answering a single question."""
+    tracemalloc.start()
+    peak = 0
+    try:
+        for question in questions:
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            bot.ask_question(question)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run(args):
+    corpus = replay_corpus()
+    questions = [question for question, _ in corpus]
+    instrumentation = Instrumentation()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot = build_bot(args, corpus, instrumentation)
+        load_seconds = time.perf_counter() - started
+        for _ in range(args.warmup):
+            for question in questions:
+                bot.ask_question(question)
+        instrumentation.reset()
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for question in questions:
+                bot.ask_question(question)
+        elapsed = time.perf_counter() - started
+        stages = instrumentation.snapshot()
+        peak_bytes = peak_memory(bot, questions)
+    answered = args.rounds * len(questions)
+    return {
+        "docs": args.docs,
+        "backend": "mongodb" if args.mongodb_uri else "mongomock",
+        "questions": len(questions),
+        "rounds": args.rounds,
+        "all_llm": args.all_llm,
+        "load_seconds": round(load_seconds, 2),
+        "throughput_qps": round(answered / elapsed, 2) if elapsed else 0.0,
+        "peak_question_heap_bytes": peak_bytes,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        "stages": {name: stages[name] for name in STAGE_ORDER if name in stages},
+        "routing": bot.route_stats.snapshot()
+    }
+
+
+def print_report(report):
+    print(f"docs={report['docs']:,} backend={report['backend']} questions={report['questions']} "
+          f"rounds={report['rounds']} (loaded in {report['load_seconds']}s)")
+    print(f"throughput: {report['throughput_qps']} questions/s, LLM avoided: {report['routing']['avoided_llm_rate']:.0%}")
+    print(f"peak heap per question: {report['peak_question_heap_bytes'] / 1024:.1f} KiB, "
+          f"max RSS: {report['max_rss_bytes'] / 2**20:.1f} MiB")
+    print(f"{'stage':<14}{'count':>7}{'avg ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'docs':>9}{'bytes':>11}")
+    for name, s in report['stages'].items():
+        print(f"{name:<14}{s['count']:>7}{s['avg_ms']:>10.3f}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}"
+              f"{s['max_ms']:>10.3f}{s['docs']:>9}{s['bytes']:>11}")
+
+
+def compare(report, baseline, threshold, min_delta_ms=0.1):
+    """
+    Returns the stages (and throughput) that regressed by more than `threshold` (a fraction)
+    and by at least `min_delta_ms`, so sub-millisecond jitter is not reported.
+    """
+    regressions = []
+    for name, stats in report['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if (before and stats['avg_ms'] > before['avg_ms'] * (1 + threshold)
+                and stats['avg_ms'] - before['avg_ms'] >= min_delta_ms):
+            regressions.append(f"{name}: avg {before['avg_ms']:.3f} -> {stats['avg_ms']:.3f} ms")
+    if baseline.get('throughput_qps') and report['throughput_qps'] < baseline['throughput_qps'] * (1 - threshold):
+        regressions.append(f"throughput: {baseline['throughput_qps']} -> {report['throughput_qps']} questions/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of ask_question.")
+    parser.add_argument("--docs", type=parse_count, default=parse_count("10k"), help="synthetic documents, e.g. 10k, 1M")
+    parser.add_argument("--rounds", type=int, default=5, help="times the corpus is replayed")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured replays first")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--all-llm", action="store_true", help="bypass local routing and template reuse")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated LLM latency in seconds")
+    parser.add_argument("--mongo-latency", type=float, default=0.0, help="simulated round trip (mongomock only)")
+    parser.add_argument("--query-policy", help="query governor policy JSON (enables the 'govern' stage)")
+    parser.add_argument("--mongodb-uri", help="benchmark against this MongoDB instead of mongomock")
+    parser.add_argument("--load", action="store_true", help="drop and reload lactalis_db.milk_collections at --mongodb-uri")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regression threshold for --compare")
+    parser.add_argument("--min-delta-ms", type=float, default=0.1, help="ignore smaller stage slowdowns")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold, args.min_delta_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
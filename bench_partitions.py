@@ -0,0 +1,150 @@
+"""
+Checks and times monthly-partitioned milk_collections against a single collection.
+
+Loads the same synthetic documents into lactalis_db.milk_collections and into time partitions
+(milk_collections_YYYY_MM, ...), runs a corpus of find/count/distinct/aggregate queries on
+both, and fails if any partitioned result differs from the single-collection one. Reports
+the time of each query on both layouts and how many partitions were pruned.
+
+Run with:  python bench_partitions.py [--docs 50k] [--granularity monthly] [--mongo-latency 0.002]
+Against a local mongod:  --mongodb-uri mongodb://localhost:27017 (drops and reloads both layouts)
+"""
+import argparse
+import math
+import sys
+import time
+from datetime import datetime
+
+from bench_ask_question import parse_count
+from fakes import FakeDatabase, generate_milk_collections
+from partitions import PartitionedCollection, sort_key
+
+JAN_2025 = {"dateTimeOfCollection": {"$gte": datetime(2025, 1, 1), "$lt": datetime(2025, 2, 1)}}
+NOV_9_2024 = {"dateTimeOfCollection": {"$gte": datetime(2024, 11, 9), "$lt": datetime(2024, 11, 10)}}
+Q2_2024 = {"dateTimeOfCollection": {"$gte": datetime(2024, 4, 1), "$lte": datetime(2024, 6, 30, 23, 59)}}
+
+# (name, method, arguments, whether the result order is significant)
+QUERIES = [
+    ("find sorted top 5 by qty", "find", ({"fat": {"$gt": 4.5}}, {"_id": 0}, [("qty", -1), ("amount", -1)], 2, 5), True),
+    ("find in January 2025", "find", (JAN_2025, {"_id": 0}, [("dateTimeOfCollection", 1), ("memberCode", 1)], 0, 10), True),
+    ("count all", "count_documents", ({},), True),
+    ("count Q2 2024", "count_documents", (Q2_2024,), True),
+    ("count $or of two days", "count_documents", ({"$or": [NOV_9_2024, JAN_2025], "fat": {"$gte": 4.0}},), True),
+    ("distinct dcs fat > 5", "distinct", ("dcsCode", {"fat": {"$gt": 5.0}}), False),
+    ("distinct members on 09-11-2024", "distinct", ("memberCode", NOV_9_2024), False),
+    ("group sum/min/max/avg by dcs", "aggregate", ([
+        {"$group": {"_id": "$dcsCode", "total": {"$sum": "$qty"}, "low": {"$min": "$fat"}, "high": {"$max": "$fat"},
+                    "avgSnf": {"$avg": "$snf"}, "n": {"$sum": 1}}},
+        {"$sort": {"_id": 1}}],), True),
+    ("top 3 members by total qty", "aggregate", ([
+        {"$group": {"_id": "$memberCode", "totalQty": {"$sum": "$qty"}}}, {"$sort": {"totalQty": -1, "_id": 1}}, {"$limit": 3}],), True),
+    ("monthly fat trend 2024", "aggregate", ([
+        {"$match": {"dateTimeOfCollection": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2025, 1, 1)}}},
+        {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgFat": {"$avg": "$fat"}}},
+        {"$sort": {"_id.month": 1}}],), True),
+    ("lowest qty on 09-11-2024", "aggregate", ([
+        {"$match": NOV_9_2024}, {"$sort": {"qty": 1, "amount": 1}}, {"$limit": 1}, {"$project": {"_id": 0}}],), True),
+    ("count stage Q2 2024", "aggregate", ([{"$match": Q2_2024}, {"$count": "n"}],), True),
+    ("empty month", "aggregate", ([{"$match": {"dateTimeOfCollection": {"$gte": datetime(2030, 1, 1)}}},
+                                    {"$group": {"_id": "$dcsCode", "total": {"$sum": "$qty"}}}],), True),
+]
+
+
+def run_query(collection, method, args):
+    if method == "find":
+        filter_query, projection, sort, skip, limit = args
+        return list(collection.find(filter_query, projection).sort(sort).skip(skip).limit(limit))
+    result = getattr(collection, method)(*args)
+    return result if isinstance(result, (int, list)) else list(result)
+
+
+def same_value(a, b):
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same_value(a[k], b[k]) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def same_result(expected, actual, ordered):
+    if not ordered and isinstance(expected, list):
+        key = sort_key([("v", 1)])
+        expected = sorted(expected, key=lambda v: key({"v": v}))
+        actual = sorted(actual, key=lambda v: key({"v": v}))
+    return same_value(expected, actual)
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def load(args):
+    if args.mongodb_uri:
+        import pymongo
+        db = pymongo.MongoClient(args.mongodb_uri)['lactalis_db']
+        for name in db.list_collection_names():
+            if name.startswith('milk_collections'):
+                db.drop_collection(name)
+    else:
+        import mongomock
+        db = FakeDatabase(mongomock.MongoClient()['lactalis_db'], args.mongo_latency)
+    single = db['milk_collections']
+    partitioned = PartitionedCollection(db, 'milk_collections', granularity=args.granularity, workers=args.workers)
+    batch = []
+    for doc in generate_milk_collections(args.docs, start=datetime(2024, 1, 1), days=425, seed=args.seed):
+        batch.append(doc)
+        if len(batch) == 10000:
+            single.insert_many([dict(d) for d in batch])
+            partitioned.insert_many(batch)
+            batch = []
+    if batch:
+        single.insert_many([dict(d) for d in batch])
+        partitioned.insert_many(batch)
+    return single, partitioned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare partitioned and single-collection query results and timings.")
+    parser.add_argument("--docs", type=parse_count, default=parse_count("50k"), help="synthetic documents, e.g. 50k, 1M")
+    parser.add_argument("--granularity", default="monthly", choices=("yearly", "monthly", "daily"))
+    parser.add_argument("--workers", type=int, default=8, help="parallel partition queries")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per query (best is reported)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongo-latency", type=float, default=0.0, help="simulated round trip (mongomock only)")
+    parser.add_argument("--mongodb-uri", help="use this MongoDB instead of mongomock")
+    args = parser.parse_args()
+
+    single, partitioned = load(args)
+    print(f"docs={args.docs:,} partitions={len(partitioned.partitions())} ({args.granularity}) "
+          f"backend={'mongodb' if args.mongodb_uri else 'mongomock'}")
+    print(f"{'query':<34}{'single ms':>11}{'partitioned ms':>16}{'scanned':>9}{'pruned':>8}  result")
+    mismatches = 0
+    for name, method, query_args, ordered in QUERIES:
+        expected, single_seconds = timed(lambda: run_query(single, method, query_args), args.repeat)
+        before = partitioned.stats()
+        actual, partitioned_seconds = timed(lambda: run_query(partitioned, method, query_args), args.repeat)
+        after = partitioned.stats()
+        scanned = (after["partitions_scanned"] - before["partitions_scanned"]) // args.repeat
+        pruned = (after["partitions_pruned"] - before["partitions_pruned"]) // args.repeat
+        ok = same_result(expected, actual, ordered)
+        mismatches += not ok
+        print(f"{name:<34}{single_seconds * 1000:>11.1f}{partitioned_seconds * 1000:>16.1f}{scanned:>9}{pruned:>8}  "
+              f"{'ok' if ok else 'MISMATCH'}")
+        if not ok:
+            print(f"    expected: {expected!r:.300}\n    actual:   {actual!r:.300}")
+    print(f"union fallbacks: {partitioned.stats()['union_fallbacks']}")
+    if mismatches:
+        print(f"{mismatches} queries returned different results")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark: the compiled query parser vs. the previous regex + eval path.
+
+Run with:  python bench_query_parser.py [--number 2000]
+"""
+import argparse
+import re
+import timeit
+from datetime import datetime
+
+from query_parser import parse_query
+
+QUERIES = [
+    'find({"memberCode": "730110400002"})',
+    'count_documents({"dcsCode": "001000001993", "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-02-01T00:00:00Z")}})',
+    'find({"memberCode": "0010000019930016", "fat": {"$gt": 4.1}, "snf": {"$gt": 8.5}, "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-02-01T00:00:00Z")}}, {"qty": 1}).limit(5)',
+    'distinct("memberCode", {"qty": {"$gt": 100}})',
+    'aggregate([{"$group": {"_id": "$memberCode", "totalQty": {"$sum": "$qty"}}}, {"$sort": {"totalQty": -1}}, {"$limit": 5}])',
+    'aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-01-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgFat": {"$avg": "$fat"}}}, {"$sort": {"_id.month": 1}}])',
+    'aggregate([{"$group": {"_id": null, "avgQty": {"$avg": "$qty"}}}])',
+]
+
+
+def legacy_eval(query_string):
+    """The regex rewrite + restricted eval previously used by EnhancedMongoDBBot._safe_eval."""
+    query_string = query_string.strip()
+    if not query_string:
+        return {}
+    query_string = re.sub(r'\bnull\b', 'None', query_string, flags=re.IGNORECASE)
+
+    def iso_to_datetime_str(match):
+        iso_str = match.group(1).replace('Z', '+00:00')
+        if 'T' not in iso_str:
+            iso_str += 'T00:00:00+00:00'
+        return f'datetime.fromisoformat("{iso_str}")'
+
+    processed_string = re.sub(r'ISODate\("([^"]+)"\)', iso_to_datetime_str, query_string)
+    return eval(processed_string, {"__builtins__": {}}, {"datetime": datetime, "None": None, "True": True, "False": False})
+
+
+def legacy_parse(query_text):
+    """The previous per-method regex matching and argument splitting from _execute_mongodb_query."""
+    if query_text.startswith('find('):
+        limit = None
+        match_limit = re.search(r'\.limit\((\d+)\)\s*$', query_text)
+        if match_limit:
+            limit = int(match_limit.group(1))
+            query_text = query_text[:match_limit.start()]
+        args_str = re.match(r'find\((.*)\)$', query_text.strip(), re.DOTALL).group(1).strip()
+        depth = 0
+        filter_str, projection_str = args_str, None
+        for i, c in enumerate(args_str):
+            if c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+            elif c == ',' and depth == 0:
+                filter_str, projection_str = args_str[:i], args_str[i + 1:]
+                break
+        return legacy_eval(filter_str), legacy_eval(projection_str) if projection_str else None, limit
+    if query_text.startswith('aggregate('):
+        return legacy_eval(re.match(r'aggregate\((.*)\)$', query_text, re.DOTALL).group(1))
+    if query_text.startswith('distinct('):
+        match = re.match(r'distinct\("([^"]+)"(?:,\s*(\{.*?\}))?(?:,\s*(\{.*?\}))?\)$', query_text, re.DOTALL)
+        return match.group(1), legacy_eval(match.group(2) or "{}")
+    return legacy_eval(re.match(r'count_documents\((.*)\)$', query_text, re.DOTALL).group(1))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--number', type=int, default=2000, help="iterations over the query corpus")
+    args = arg_parser.parse_args()
+
+    def run_legacy():
+        for q in QUERIES:
+            legacy_parse(q)
+
+    def run_parser_cold():
+        parse_query.cache_clear()
+        for q in QUERIES:
+            parse_query(q)
+
+    def run_parser_cached():
+        for q in QUERIES:
+            parse_query(q)
+
+    print(f"{len(QUERIES)} queries x {args.number} iterations")
+    print(f"{'implementation':<24}{'total s':>10}{'us/query':>12}")
+    baseline = None
+    for name, fn in (("regex + eval (legacy)", run_legacy), ("parser (uncached)", run_parser_cold), ("parser (cached)", run_parser_cached)):
+        fn()
+        seconds = timeit.timeit(fn, number=args.number)
+        per_query = seconds / (args.number * len(QUERIES)) * 1e6
+        baseline = baseline or per_query
+        print(f"{name:<24}{seconds:>10.3f}{per_query:>12.2f}   ({baseline / per_query:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
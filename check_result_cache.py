@@ -0,0 +1,116 @@
+"""
+Checks that cached query results follow inserts, updates and deletes.
+
+For each invalidation mode the bot answers a count with cache_results=True on the in-memory
+MongoDB stand-in, then the collection is changed and the question asked again:
+
+- 'change_stream': every insert, update and delete must show in the next answer (the
+  stand-in emulates change streams for writes made through it).
+- 'watermark': inserts and deletes must show immediately; updates that change neither the
+  newest date nor the document count show once the entry's TTL has expired.
+
+A count bounded by an inclusive $lte date must follow an insert dated exactly at that bound.
+Approximate ($sample-downgraded) results must never be cached.
+
+Run with:  python check_result_cache.py
+"""
+import contextlib
+import io
+import re
+import sys
+import time
+from datetime import datetime
+
+from fakes import FakeGeminiModel, FakeMongoClient, generate_milk_collections
+from query_parser import parse_query
+from v1 import EnhancedMongoDBBot
+
+MEMBER = "730110400002"
+QUESTION = "How many collections did member 730110400002 deliver?"
+QUERY = 'count_documents({"memberCode": "730110400002"})'
+UNTIL_QUESTION = "How many collections did member 730110400002 deliver until 2024-06-30 06:00?"
+UNTIL_QUERY = 'count_documents({"memberCode": "730110400002", "dateTimeOfCollection": {"$lte": ISODate("2024-06-30T06:00:00Z")}})'
+COUNT_TTL = 1
+
+
+def build_bot(invalidation):
+    documents = generate_milk_collections(3000, start=datetime(2024, 1, 1), days=300, member_codes=[MEMBER])
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = FakeMongoClient(documents)
+        bot = EnhancedMongoDBBot(None, None, model=FakeGeminiModel({QUESTION: QUERY, UNTIL_QUESTION: UNTIL_QUERY}), client=client, schema_cache_path=None,
+                                 cache_results=True, result_cache_invalidation=invalidation,
+                                 result_cache_ttls={"count": COUNT_TTL if invalidation == 'watermark' else 300})
+    bot.router.route = lambda question: None
+    bot.result_cache.watermark_interval = 0
+    return bot, client['lactalis_db']['milk_collections']
+
+
+def answer_count(bot, question=QUESTION):
+    time.sleep(0.3)  # lets the change stream thread consume pending events
+    with contextlib.redirect_stdout(io.StringIO()):
+        answer = bot.ask_question(question)
+    return int(re.search(r"Found ([\d,]+) matching", answer).group(1).replace(',', ''))
+
+
+def check(label, actual, expected):
+    ok = actual == expected
+    print(f"{'ok' if ok else 'FAIL'}  {label}: {actual}" + ("" if ok else f" (expected {expected})"))
+    return ok
+
+
+def run_mode(invalidation):
+    print(f"--- {invalidation}")
+    bot, collection = build_bot(invalidation)
+    expected = collection.count_documents({"memberCode": MEMBER})
+    results = [check("initial answer", answer_count(bot), expected)]
+    hits = bot.result_cache.hits
+    results.append(check("repeated answer", answer_count(bot), expected))
+    results.append(check("served from the cache", bot.result_cache.hits - hits, 1))
+
+    collection.insert_one({"memberCode": MEMBER, "dcsCode": "001000019900", "qty": 10.0, "fat": 4.2, "snf": 8.5,
+                           "amount": 300.0, "dateTimeOfCollection": datetime(2025, 1, 5, 6, 0)})
+    expected += 1
+    results.append(check("after insert", answer_count(bot), expected))
+
+    collection.update_one({"memberCode": MEMBER, "dateTimeOfCollection": {"$lt": datetime(2025, 1, 1)}},
+                          {"$set": {"memberCode": "730110499999"}})
+    expected -= 1
+    if invalidation == 'watermark':
+        time.sleep(COUNT_TTL)
+    results.append(check("after update" + (" (TTL expired)" if invalidation == 'watermark' else ""), answer_count(bot), expected))
+
+    collection.delete_one({"memberCode": MEMBER})
+    expected -= 1
+    results.append(check("after delete", answer_count(bot), expected))
+    bot.result_cache.stop()
+    return results
+
+
+def check_inclusive_end():
+    print("--- inclusive end date")
+    bot, collection = build_bot('change_stream')
+    expected = collection.count_documents({"memberCode": MEMBER, "dateTimeOfCollection": {"$lte": datetime(2024, 6, 30, 6, 0)}})
+    results = [check("initial answer", answer_count(bot, UNTIL_QUESTION), expected)]
+    collection.insert_one({"memberCode": MEMBER, "dcsCode": "001000019900", "qty": 10.0, "fat": 4.2, "snf": 8.5,
+                           "amount": 300.0, "dateTimeOfCollection": datetime(2024, 6, 30, 6, 0)})
+    results.append(check("after insert at the $lte bound", answer_count(bot, UNTIL_QUESTION), expected + 1))
+    bot.result_cache.stop()
+    return results
+
+
+def check_approximate():
+    print("--- approximate results")
+    bot, _ = build_bot(None)
+    parsed = parse_query(QUERY)
+    bot.result_cache.put(parsed, {"type": "count", "results": 42, "sampled": 100, "approximate": True})
+    return [check("approximate result cached", bot.result_cache.get(parsed) is not None, False)]
+
+
+def main():
+    results = run_mode('change_stream') + run_mode('watermark') + check_inclusive_end() + check_approximate()
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Checks that the schema profile never turns a matching query into "no record can match".
+
+Builds the bot on synthetic documents dated 2024-01 to 2024-10 (exact ranges profiled
+synchronously), then inserts documents the profile has not seen and asks about them: a
+collection dated after the profiled maximum must be counted, and so must one with an
+out-of-range fat value once an index on fat lets the rejection be confirmed. Without that
+index the profile is trusted (no collection scan). Filters that really cannot match (fat > 50
+on the original data, dates before the first collection) must still be answered as impossible.
+The prompt schema must not change when the profile does.
+
+Run with:  python check_schema_profiler.py
+"""
+import contextlib
+import io
+import sys
+from datetime import datetime
+
+from fakes import FakeGeminiModel, FakeMongoClient, generate_milk_collections
+from v1 import EnhancedMongoDBBot
+
+MEMBER = "730110400002"
+QUERIES = {
+    "How many collections did member 730110400002 deliver in June 2025?":
+        'count_documents({"memberCode": "730110400002", "dateTimeOfCollection": {"$gte": ISODate("2025-06-01T00:00:00Z"), "$lt": ISODate("2025-07-01T00:00:00Z")}})',
+    "How many collections had fat above 50?":
+        'count_documents({"fat": {"$gt": 50}})',
+    "How many collections were made before 2023?":
+        'count_documents({"dateTimeOfCollection": {"$lt": ISODate("2023-01-01T00:00:00Z")}})',
+}
+
+
+def ask(bot, question):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return bot.ask_question(question)
+
+
+def expect(answer, text, label):
+    ok = text in answer
+    print(f"{'ok' if ok else 'FAIL'}  {label}")
+    if not ok:
+        print(f"      expected {text!r} in: {answer[:300]!r}")
+    return ok
+
+
+def main():
+    documents = generate_milk_collections(2000, start=datetime(2024, 1, 1), days=300, member_codes=[MEMBER])
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = FakeMongoClient(documents)
+        bot = EnhancedMongoDBBot(None, None, model=FakeGeminiModel(QUERIES), client=client,
+                                  schema_cache_path=None)
+        bot.router.route = lambda question: None
+        bot.schema_profiler.refresh(full=True)
+    questions = list(QUERIES)
+    results = [
+        expect(ask(bot, questions[1]), "No record can match", "fat > 50 is impossible on the profiled data"),
+        expect(ask(bot, questions[2]), "No record can match", "dates before the first collection are impossible"),
+    ]
+    prompt_schema = bot.schema_profiler.prompt_schema()
+
+    collection = client['lactalis_db']['milk_collections']
+    collection.insert_one({"memberCode": MEMBER, "dcsCode": "001000019900", "qty": 10.0, "fat": 4.2, "snf": 8.5,
+                           "amount": 300.0, "dateTimeOfCollection": datetime(2025, 6, 1, 6, 30)})
+    collection.insert_one({"memberCode": MEMBER, "dcsCode": "001000019900", "qty": 10.0, "fat": 55.0, "snf": 8.5,
+                           "amount": 300.0, "dateTimeOfCollection": datetime(2024, 5, 1, 6, 30)})
+    results += [
+        expect(ask(bot, questions[0]), "Found 1 matching", "a collection inserted after profiling is counted"),
+        expect(ask(bot, questions[1]), "No record can match", "an unindexed fat filter is rejected on the profile alone"),
+    ]
+    collection.create_index([("fat", 1)])
+    results.append(expect(ask(bot, questions[1]), "Found 1 matching", "a fat value beyond the profiled maximum is counted"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.schema_profiler.refresh(full=True)
+    unchanged = bot.schema_profiler.prompt_schema() == prompt_schema
+    print(f"{'ok' if unchanged else 'FAIL'}  the prompt schema is the same after re-profiling")
+    results.append(unchanged)
+    print(f"schema stats: {bot.schema_profiler.stats()}")
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
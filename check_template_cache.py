@@ -0,0 +1,40 @@
+"""
+Checks that questions differing only in their comparison operator never share a template.
+
+Stores the generated query of "fat > 4.1" style questions for each operator, then asks the
+same shapes with another number: each must get back its own operator with the new number, and
+a question with an operator that was never stored must miss.
+
+Run with:  python check_template_cache.py
+"""
+import sys
+
+from template_cache import QueryTemplateCache, extract_literals
+
+OPERATORS = {">": "$gt", ">=": "$gte", "<": "$lt", "<=": "$lte", "!=": "$ne", "=": "$eq"}
+
+
+def check(label, actual, expected):
+    ok = actual == expected
+    print(f"{'ok' if ok else 'FAIL'}  {label}: {actual!r}" + ("" if ok else f" (expected {expected!r})"))
+    return ok
+
+
+def main():
+    keys = {extract_literals(f"How many collections had fat {op} 4.1?")[0] for op in OPERATORS}
+    results = [check("distinct keys for the operator variants", len(keys), len(OPERATORS))]
+
+    cache = QueryTemplateCache()
+    for op, mongo_op in OPERATORS.items():
+        if op == "<=":
+            continue
+        cache.put(f"How many collections had fat {op} 4.1?", f'count_documents({{"fat": {{"{mongo_op}": 4.1}}}})')
+    for op, mongo_op in OPERATORS.items():
+        expected = None if op == "<=" else f'count_documents({{"fat": {{"{mongo_op}": 3.9}}}})'
+        results.append(check(f"fat {op} 3.9", cache.get(f"How many collections had fat {op} 3.9?"), expected))
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
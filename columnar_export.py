@@ -0,0 +1,264 @@
+"""
+Columnar bulk export of large query results.
+
+Instead of materializing every document as a dict and rendering JSON, cursor batches are
+fetched as raw BSON (find_raw_batches/aggregate_raw_batches), decoded one batch at a time
+and turned into column buffers: plain lists, NumPy arrays or Arrow record batches. Batches
+are streamed to CSV, Parquet or Arrow IPC files, so memory stays bounded by the batch size
+whatever the result size.
+
+NumPy and pyarrow are optional: CSV export needs neither, Parquet/Arrow IPC need pyarrow.
+"""
+import csv
+import time
+from datetime import datetime
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.objectid import ObjectId
+
+from query_parser import ParsedQuery
+
+# Known milk_collections columns; other fields are typed from the first batch
+COLUMN_TYPES = {
+    'memberCode': 'string',
+    'dcsCode': 'string',
+    'qty': 'float',
+    'fat': 'float',
+    'snf': 'float',
+    'amount': 'float',
+    'dateTimeOfCollection': 'datetime',
+}
+DEFAULT_COLUMNS = list(COLUMN_TYPES)
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.ipc': 'arrow', '.feather': 'arrow'}
+DECODE_OPTIONS = CodecOptions(tz_aware=False)
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return 'string'
+    if isinstance(value, (int, float)):
+        return 'float'
+    if isinstance(value, datetime):
+        return 'datetime'
+    return 'string'
+
+
+def infer_column_types(columns, docs):
+    """Column kinds ('string', 'float', 'datetime') from COLUMN_TYPES or the first non-null value."""
+    types = {}
+    for name in columns:
+        if name in COLUMN_TYPES:
+            types[name] = COLUMN_TYPES[name]
+            continue
+        value = next((doc[name] for doc in docs if doc.get(name) is not None), None)
+        types[name] = _value_type(value)
+    return types
+
+
+def _raw_cursor(method, *args, **kwargs):
+    """Calls a *_raw_batches method, or returns None where it is unavailable (e.g. mongomock)."""
+    if method is None:
+        return None
+    try:
+        return method(*args, **kwargs)
+    except NotImplementedError:
+        return None
+
+
+def _raw_batches(collection, parsed, batch_size):
+    """Yields lists of decoded documents, one server batch at a time."""
+    if parsed.method == 'aggregate':
+        options = {'allowDiskUse': True, 'batchSize': batch_size}
+        raw_cursor = _raw_cursor(getattr(collection, 'aggregate_raw_batches', None), parsed.args[0], **options)
+        cursor = None if raw_cursor is not None else collection.aggregate(parsed.args[0], **options)
+    else:
+        find_args = (parsed.arg(0, {}), parsed.arg(1))
+        find_options = {'batch_size': batch_size}
+        if parsed.modifiers.get('sort'):
+            find_options['sort'] = parsed.modifiers['sort']
+        for modifier in ('skip', 'limit'):
+            if parsed.modifiers.get(modifier):
+                find_options[modifier] = parsed.modifiers[modifier]
+        raw_cursor = _raw_cursor(getattr(collection, 'find_raw_batches', None), *find_args, **find_options)
+        cursor = None if raw_cursor is not None else collection.find(*find_args, **find_options)
+    if raw_cursor is not None:
+        for raw in raw_cursor:
+            yield bson.decode_all(raw, DECODE_OPTIONS)
+        return
+    # Without raw batch support the documents arrive decoded; they are still chunked
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _export_columns(parsed):
+    """Columns implied by a find projection, or None to use the defaults/the first batch."""
+    projection = parsed.arg(1) if parsed.method == 'find' else None
+    if not projection or not any(v for k, v in projection.items() if k != '_id'):
+        return None
+    columns = [name for name, include in projection.items() if include and name != '_id']
+    if projection.get('_id', 0):
+        columns.insert(0, '_id')
+    return columns
+
+
+def iter_column_batches(collection, parsed, columns=None, batch_size=50000):
+    """
+    Yields (column_types, {column: list_of_values}) for each batch of a parsed find/aggregate
+    query. Missing fields are None; ObjectIds become strings.
+    """
+    if parsed.method not in ('find', 'aggregate'):
+        raise ValueError(f"Only find(...) and aggregate(...) results can be exported, got {parsed.method}(...)")
+    columns = columns or _export_columns(parsed)
+    if columns is None and parsed.method == 'find':
+        columns = DEFAULT_COLUMNS
+    if parsed.method == 'find' and columns:
+        # Only the exported fields are transferred and decoded (parsed queries are shared: copy)
+        projection = {name: 1 for name in columns}
+        if '_id' not in columns:
+            projection['_id'] = 0
+        parsed = ParsedQuery('find', [parsed.arg(0, {}), projection], parsed.modifiers)
+    types = None
+    for docs in _raw_batches(collection, parsed, batch_size):
+        if types is None:
+            if columns is None:
+                columns = list(dict.fromkeys(key for doc in docs[:100] for key in doc))
+            types = infer_column_types(columns, docs)
+        batch = {}
+        for name in columns:
+            values = [doc.get(name) for doc in docs]
+            if types[name] == 'string':
+                values = [str(v) if isinstance(v, ObjectId) else v for v in values]
+            batch[name] = values
+        yield types, batch
+
+
+def to_numpy(types, batch):
+    """Converts a column batch to NumPy arrays (float64 with NaN, datetime64[ms] with NaT, object)."""
+    import numpy as np
+    arrays = {}
+    for name, values in batch.items():
+        if types[name] == 'float':
+            arrays[name] = np.array(values, dtype=np.float64)
+        elif types[name] == 'datetime':
+            arrays[name] = np.array(values, dtype='datetime64[ms]')
+        else:
+            arrays[name] = np.array(values, dtype=object)
+    return arrays
+
+
+def arrow_schema(types):
+    import pyarrow as pa
+    arrow_types = {'float': pa.float64(), 'datetime': pa.timestamp('ms'), 'string': pa.string()}
+    return pa.schema([(name, arrow_types[kind]) for name, kind in types.items()])
+
+
+def to_arrow(types, batch, schema=None):
+    """Converts a column batch to a pyarrow RecordBatch."""
+    import pyarrow as pa
+    schema = schema or arrow_schema(types)
+    arrays = []
+    for field in schema:
+        values = batch[field.name]
+        if types[field.name] == 'string':
+            values = [None if v is None else str(v) for v in values]
+        elif types[field.name] == 'float':
+            values = [v if isinstance(v, (int, float)) and not isinstance(v, bool) else None for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_numpy_batches(collection, parsed, columns=None, batch_size=50000):
+    for types, batch in iter_column_batches(collection, parsed, columns, batch_size):
+        yield to_numpy(types, batch)
+
+
+def iter_arrow_batches(collection, parsed, columns=None, batch_size=50000):
+    schema = None
+    for types, batch in iter_column_batches(collection, parsed, columns, batch_size):
+        schema = schema or arrow_schema(types)
+        yield to_arrow(types, batch, schema)
+
+
+def export_format(path, fmt=None):
+    if fmt:
+        return fmt
+    for suffix, name in FORMATS.items():
+        if path.lower().endswith(suffix):
+            return name
+    raise ValueError(f"Cannot tell the export format from '{path}'; use .csv, .parquet or .arrow")
+
+
+def _write_csv(path, batches):
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = None
+        for types, batch in batches:
+            if writer is None:
+                writer = csv.writer(f)
+                writer.writerow(list(batch))
+            columns = list(batch.values())
+            for row in zip(*columns):
+                writer.writerow(['' if v is None else v.isoformat() if isinstance(v, datetime) else v for v in row])
+            rows += len(columns[0]) if columns else 0
+    return rows
+
+
+def _write_arrow(path, batches, fmt):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError(f"{fmt} export needs pyarrow: pip install pyarrow (or export to .csv)")
+    rows = 0
+    writer = None
+    schema = None
+    try:
+        for types, batch in batches:
+            if writer is None:
+                schema = arrow_schema(types)
+                if fmt == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(path, schema)
+                else:
+                    writer = pa.ipc.new_file(path, schema)
+            record_batch = to_arrow(types, batch, schema)
+            if fmt == 'parquet':
+                writer.write_batch(record_batch)
+            else:
+                writer.write(record_batch)
+            rows += record_batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # No rows: still leave a valid, empty file behind
+        schema = pa.schema([])
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(schema.empty_table(), path)
+        else:
+            with pa.ipc.new_file(path, schema):
+                pass
+    return rows
+
+
+def export_query(collection, parsed, path, fmt=None, columns=None, batch_size=50000):
+    """Streams a parsed find/aggregate query to a CSV/Parquet/Arrow IPC file. Returns export stats."""
+    fmt = export_format(path, fmt)
+    started = time.perf_counter()
+    batches = iter_column_batches(collection, parsed, columns, batch_size)
+    if fmt == 'csv':
+        rows = _write_csv(path, batches)
+    elif fmt in ('parquet', 'arrow'):
+        rows = _write_arrow(path, batches, fmt)
+    else:
+        raise ValueError(f"Unknown export format '{fmt}'")
+    elapsed = time.perf_counter() - started
+    return {"path": path, "format": fmt, "rows": rows, "seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed, 1) if elapsed else 0.0}
@@ -0,0 +1,225 @@
+"""
+Offline stand-ins for Gemini and MongoDB, for testing and load/benchmark runs without an
+API key or a cluster.
+
+FakeGeminiModel answers generate_content(prompt[, stream=True]) with a recorded query for
+the question embedded in the prompt, optionally after a simulated latency, and can stream
+the answer in small chunks followed by trailing text to exercise early stopping.
+
+A synthetic milk_collections generator and an in-memory MongoDB stand-in with simulated
+round-trip latency are provided as well. The stand-in also emulates change streams
+(collection.watch()) for writes made through it, which mongomock lacks.
+"""
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+QUESTION_PATTERN = re.compile(r'\*\*USER QUESTION:\*\* "(.*)"')
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens=None):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt_tokens) if prompt_tokens else None
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = cached_content_token_count
+
+
+class FakeGeminiModel:
+    """
+    `answers` maps a question (exact, case-insensitive) to the query to return; unknown
+    questions get `default`. `latency` is the simulated time to first token and
+    `chunk_latency` the delay between streamed chunks.
+    """
+
+    def __init__(self, answers=None, default='count_documents({})', latency=0.0, chunk_latency=0.0,
+                 chunk_size=16, trailing_text="\n```\nThis query returns the requested records."):
+        self.answers = {q.lower(): a for q, a in (answers or {}).items()}
+        self.default = default
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.chunk_size = chunk_size
+        self.trailing_text = trailing_text
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.chunks_sent = 0
+
+    def answer_for(self, prompt):
+        match = QUESTION_PATTERN.search(prompt)
+        question = match.group(1) if match else prompt
+        return self.answers.get(question.lower(), self.default)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        answer = self.answer_for(prompt)
+        if self.latency:
+            time.sleep(self.latency)
+        text = "```python\n" + answer + self.trailing_text
+        if not stream:
+            # A blocking call returns only after the whole response has been generated
+            time.sleep(self.chunk_latency * -(-len(text) // self.chunk_size))
+            return FakeResponse(text, prompt_tokens=len(prompt) // 4)
+        return self._stream(text, len(prompt) // 4)
+
+    def _stream(self, text, prompt_tokens):
+        for i in range(0, len(text), self.chunk_size):
+            if self.chunk_latency:
+                time.sleep(self.chunk_latency)
+            with self._lock:
+                self.chunks_sent += 1
+            # Like Gemini, every streamed chunk carries the prompt's usage metadata
+            yield FakeResponse(text[i:i + self.chunk_size], prompt_tokens=prompt_tokens)
+
+
+def generate_milk_collections(count, members=None, dcs_count=None, start=datetime(2024, 1, 1), days=365, seed=42,
+                              member_codes=(), dcs_codes=()):
+    """
+    Yields `count` synthetic milk_collections documents. By default the member count scales
+    like a real union (about one member per morning/evening shift slot over `days` days, at
+    least 200) with ~40 members per DCS. Every member delivers to one DCS; collections are
+    spread uniformly over the days with morning/evening shifts. `member_codes`/`dcs_codes`
+    are used for the first members/DCSs, so recorded questions find data.
+    """
+    rnd = random.Random(seed)
+    if members is None:
+        members = max(200, count // (2 * days))
+    if dcs_count is None:
+        dcs_count = max(10, members // 40)
+    dcs_codes = (list(dcs_codes) + [f"0010000{19900 + i:05d}" for i in range(dcs_count)])[:dcs_count]
+    member_codes = (list(member_codes) + [f"{dcs_codes[i % dcs_count]}{i // dcs_count:04d}" for i in range(members)])[:members]
+    for i in range(count):
+        member = rnd.randrange(members)
+        fat = round(rnd.gauss(4.3, 0.5), 1)
+        snf = round(rnd.gauss(8.5, 0.2), 1)
+        qty = round(max(0.5, rnd.gauss(12, 6)), 1)
+        moment = start + timedelta(days=rnd.randrange(days), hours=rnd.choice((6, 18)), minutes=rnd.randrange(60))
+        yield {
+            "memberCode": member_codes[member],
+            "dcsCode": dcs_codes[member % dcs_count],
+            "qty": qty,
+            "fat": fat,
+            "snf": snf,
+            "amount": round(qty * (fat * 6.5 + snf * 2.5), 2),
+            "dateTimeOfCollection": moment
+        }
+
+
+class FakeChangeStream:
+    """Change events for writes made through the stand-in, with pymongo's try_next()/close() interface."""
+
+    def __init__(self, subscribers):
+        self._subscribers = subscribers
+        self._events = queue.Queue()
+        subscribers.append(self)
+
+    def publish(self, event):
+        self._events.put(event)
+
+    def try_next(self):
+        try:
+            return self._events.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if self in self._subscribers:
+            self._subscribers.remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SlowCollection:
+    """Proxy adding a fixed per-operation latency, standing in for the network round trip to MongoDB."""
+    SLOW_METHODS = {'find', 'find_one', 'aggregate', 'distinct', 'count_documents', 'estimated_document_count'}
+    WRITE_OPERATIONS = {'insert_one': 'insert', 'insert_many': 'insert', 'update_one': 'update', 'update_many': 'update',
+                        'replace_one': 'replace', 'delete_one': 'delete', 'delete_many': 'delete'}
+
+    def __init__(self, collection, latency, subscribers=None):
+        self._collection = collection
+        self._latency = latency
+        self._subscribers = subscribers if subscribers is not None else []
+
+    def watch(self, pipeline=None, full_document=None, **kwargs):
+        return FakeChangeStream(self._subscribers)
+
+    def _publish(self, operation, args):
+        if not self._subscribers:
+            return
+        if operation == 'insert':
+            documents = args[0] if isinstance(args[0], list) else [args[0]]
+            events = [{"operationType": "insert", "fullDocument": doc} for doc in documents]
+        else:
+            # Updates, replacements and deletes are reported without the document
+            events = [{"operationType": operation}]
+        for subscriber in list(self._subscribers):
+            for event in events:
+                subscriber.publish(event)
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self.SLOW_METHODS and self._latency:
+            def call(*args, **kwargs):
+                time.sleep(self._latency)
+                return attr(*args, **kwargs)
+            return call
+        if name in self.WRITE_OPERATIONS:
+            def write(*args, **kwargs):
+                result = attr(*args, **kwargs)
+                self._publish(self.WRITE_OPERATIONS[name], args)
+                return result
+            return write
+        return attr
+
+
+class FakeDatabase:
+    def __init__(self, database, latency, subscribers=None):
+        self._database = database
+        self._latency = latency
+        # Change stream subscribers per collection name, shared by every proxy of the collection
+        self._subscribers = subscribers if subscribers is not None else {}
+
+    def __getitem__(self, name):
+        return SlowCollection(self._database[name], self._latency, self._subscribers.setdefault(name, []))
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class FakeMongoClient:
+    """In-memory MongoDB stand-in (mongomock) with simulated per-operation latency."""
+
+    def __init__(self, documents=(), latency=0.0, database='lactalis_db', collection='milk_collections'):
+        try:
+            import mongomock
+        except ImportError:
+            raise RuntimeError("The MongoDB stand-in needs mongomock: pip install mongomock")
+        self._client = mongomock.MongoClient()
+        self._latency = latency
+        self._subscribers = {}
+        target = self._client[database][collection]
+        batch = []
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) == 10000:
+                target.insert_many(batch)
+                batch = []
+        if batch:
+            target.insert_many(batch)
+
+    def __getitem__(self, name):
+        return FakeDatabase(self._client[name], self._latency, self._subscribers.setdefault(name, {}))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -0,0 +1,266 @@
+"""
+Explain-plan checking and index recommendations for generated queries.
+
+Every analyzed query is explained on the server; COLLSCANs, docs-examined/returned ratios
+and winning plans are recorded per query shape. Shapes that scan too much are turned into
+compound index recommendations following the Equality, Sort, Range (ESR) rule.
+"""
+import threading
+import time
+
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$exists', '$regex'}
+
+
+def _filter_fields(filter_query):
+    """Splits a filter into equality and range fields (top-level fields only)."""
+    equality, ranges = [], []
+    for field, value in (filter_query or {}).items():
+        if field.startswith('$'):
+            continue
+        if isinstance(value, dict) and any(op in RANGE_OPERATORS for op in value):
+            ranges.append(field)
+        else:
+            equality.append(field)
+    return equality, ranges
+
+
+def query_shape(parsed):
+    """Returns (equality_fields, sort_fields, range_fields) for the part of a query an index can serve."""
+    sort = []
+    if parsed.method == 'aggregate':
+        pipeline = parsed.args[0]
+        filter_query = pipeline[0].get('$match', {}) if pipeline else {}
+        if filter_query and len(pipeline) > 1 and '$sort' in pipeline[1]:
+            sort = list(pipeline[1]['$sort'].items())
+    elif parsed.method == 'distinct':
+        filter_query = parsed.arg(1, {})
+    else:
+        filter_query = parsed.arg(0, {})
+        sort = parsed.modifiers.get('sort') or []
+    equality, ranges = _filter_fields(filter_query)
+    return tuple(sorted(equality)), tuple(sort), tuple(sorted(ranges))
+
+
+def index_keys(equality, sort, ranges):
+    """Compound index keys for a query shape in ESR order (equality, sort, range fields)."""
+    keys = [(field, 1) for field in equality]
+    keys += [(field, direction) for field, direction in sort if field not in equality and isinstance(direction, int)]
+    keys += [(field, 1) for field in ranges if field not in equality and field not in dict(sort)]
+    return keys
+
+
+def explain_command(collection, parsed):
+    """Builds the explain command body for a parsed query."""
+    name = collection.name
+    if parsed.method == 'find':
+        command = {'find': name, 'filter': parsed.arg(0, {})}
+        if parsed.arg(1):
+            command['projection'] = parsed.arg(1)
+        for modifier in ('skip', 'limit'):
+            if parsed.modifiers.get(modifier):
+                command[modifier] = parsed.modifiers[modifier]
+        if parsed.modifiers.get('sort'):
+            command['sort'] = dict(parsed.modifiers['sort'])
+        return command
+    if parsed.method == 'aggregate':
+        return {'aggregate': name, 'pipeline': parsed.args[0], 'cursor': {}}
+    if parsed.method == 'distinct':
+        return {'distinct': name, 'key': parsed.args[0], 'query': parsed.arg(1, {})}
+    return {'count': name, 'query': parsed.arg(0, {})}
+
+
+def _find_key(node, key):
+    """Depth-first search for the first value stored under `key` in a nested explain document."""
+    if isinstance(node, dict):
+        if key in node:
+            return node[key]
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+    for child in children:
+        found = _find_key(child, key)
+        if found is not None:
+            return found
+    return None
+
+
+def _plan_stages(plan):
+    stages = []
+    while isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for child in plan.get('inputStages', []):
+            stages.extend(_plan_stages(child))
+        plan = plan.get('inputStage') or plan.get('queryPlan')
+    return stages
+
+
+def summarize_explain(explain):
+    """Extracts the winning plan stages and execution counters from an explain result."""
+    winning_plan = _find_key(explain, 'winningPlan') or {}
+    stats = _find_key(explain, 'executionStats') or {}
+    stages = _plan_stages(winning_plan)
+    return {
+        "stages": stages,
+        "collscan": 'COLLSCAN' in stages,
+        "index": _find_key(winning_plan, 'indexName'),
+        "docs_examined": stats.get('totalDocsExamined'),
+        "keys_examined": stats.get('totalKeysExamined'),
+        "returned": stats.get('nReturned'),
+        "execution_ms": stats.get('executionTimeMillis')
+    }
+
+
+class IndexAdvisor:
+    def __init__(self, collection, verbosity='queryPlanner', max_examined_ratio=10, auto_create=False, auto_create_after=5):
+        """
+        `verbosity='queryPlanner'` only plans the query (cheap, flags COLLSCANs); 'executionStats'
+        also runs it to get docs-examined counts, which doubles the load of every analyzed
+        query. With `auto_create`, the index of a shape is created on a background thread when
+        the shape scans badly for the `auto_create_after`-th time.
+        """
+        self.collection = collection
+        self.verbosity = verbosity
+        self.max_examined_ratio = max_examined_ratio
+        self.auto_create = auto_create
+        self.auto_create_after = auto_create_after
+        self._lock = threading.Lock()
+        self.profile = {}
+        self.explain_errors = 0
+        self.created_indexes = []
+
+    def analyze(self, parsed):
+        """Explains a parsed query and records it in the workload profile. Returns the plan summary."""
+        try:
+            explain = self.collection.database.command('explain', explain_command(self.collection, parsed), verbosity=self.verbosity)
+        except Exception as e:
+            with self._lock:
+                self.explain_errors += 1
+            return {"error": str(e)}
+        summary = summarize_explain(explain)
+        shape = (parsed.method,) + query_shape(parsed)
+        with self._lock:
+            entry = self.profile.setdefault(shape, {
+                "queries": 0, "collscans": 0, "inefficient": 0, "docs_examined": 0,
+                "returned": 0, "execution_ms": 0, "winning_plans": {}, "last_seen": None
+            })
+            entry["queries"] += 1
+            entry["last_seen"] = time.time()
+            plan = " <- ".join(summary["stages"]) or "unknown"
+            entry["winning_plans"][plan] = entry["winning_plans"].get(plan, 0) + 1
+            entry["docs_examined"] += summary["docs_examined"] or 0
+            entry["returned"] += summary["returned"] or 0
+            entry["execution_ms"] += summary["execution_ms"] or 0
+            if summary["collscan"]:
+                entry["collscans"] += 1
+            inefficient = self._is_inefficient(summary)
+            if inefficient:
+                entry["inefficient"] += 1
+            # Only the threshold crossing triggers creation, not every later query of the shape
+            should_create = self.auto_create and inefficient and entry["inefficient"] == self.auto_create_after
+        if should_create:
+            threading.Thread(target=self._create_shape_index, args=(shape,), name="index-create", daemon=True).start()
+        return summary
+
+    def _create_shape_index(self, shape):
+        """Creates the ESR index of one query shape unless an existing index prefix already serves it."""
+        keys = index_keys(*shape[1:])
+        if not keys or any(existing[:len(keys)] == keys for existing in self._existing_index_keys()):
+            return
+        try:
+            name = self.collection.create_index(keys)
+        except Exception as e:
+            print(f" Could not create index {keys}: {e}")
+            return
+        print(f"🗂️ Created index {name}")
+        with self._lock:
+            self.created_indexes.append(name)
+
+    def _is_inefficient(self, summary):
+        if summary["collscan"]:
+            return True
+        examined, returned = summary["docs_examined"], summary["returned"]
+        if examined is None:
+            return False
+        return examined > self.max_examined_ratio * max(returned or 0, 1)
+
+    def _existing_index_keys(self):
+        try:
+            return [list(info['key']) for info in self.collection.index_information().values()]
+        except Exception:
+            return []
+
+    def recommend(self):
+        """
+        Returns compound index recommendations for inefficient query shapes, most costly first.
+        Keys follow ESR order; indexes already covered by an existing index prefix are skipped.
+        """
+        with self._lock:
+            profile = {shape: dict(entry) for shape, entry in self.profile.items()}
+        candidates = {}
+        for (method, equality, sort, ranges), entry in profile.items():
+            if not entry["inefficient"]:
+                continue
+            keys = index_keys(equality, sort, ranges)
+            if not keys:
+                continue
+            key = tuple(keys)
+            rec = candidates.setdefault(key, {"keys": keys, "queries": 0, "collscans": 0, "docs_examined": 0, "shapes": []})
+            rec["queries"] += entry["queries"]
+            rec["collscans"] += entry["collscans"]
+            rec["docs_examined"] += entry["docs_examined"]
+            rec["shapes"].append(method)
+
+        existing = self._existing_index_keys()
+        recommendations = []
+        for key, rec in candidates.items():
+            # An index whose leading keys match the recommendation already serves it
+            if any(index_keys[:len(key)] == list(key) for index_keys in existing):
+                continue
+            # So does a longer recommendation that starts with the same keys
+            if any(other != key and other[:len(key)] == key for other in candidates):
+                continue
+            recommendations.append(rec)
+        recommendations.sort(key=lambda r: (r["docs_examined"], r["collscans"], r["queries"]), reverse=True)
+        return recommendations
+
+    def create_recommended_indexes(self, limit=None):
+        """Creates the recommended indexes (opt-in). Returns the names of the created indexes."""
+        created = []
+        for rec in self.recommend()[:limit]:
+            try:
+                name = self.collection.create_index(rec["keys"])
+            except Exception as e:
+                print(f" Could not create index {rec['keys']}: {e}")
+                continue
+            print(f"🗂️ Created index {name}")
+            created.append(name)
+        with self._lock:
+            self.created_indexes.extend(created)
+        return created
+
+    def stats(self):
+        with self._lock:
+            return {
+                "analyzed": sum(e["queries"] for e in self.profile.values()),
+                "collscans": sum(e["collscans"] for e in self.profile.values()),
+                "inefficient": sum(e["inefficient"] for e in self.profile.values()),
+                "shapes": len(self.profile),
+                "explain_errors": self.explain_errors,
+                "created_indexes": list(self.created_indexes)
+            }
+
+    def workload_profile(self):
+        """The recorded profile as a list of JSON-friendly dicts, one per query shape."""
+        with self._lock:
+            return [
+                {
+                    "method": method, "equality": list(equality), "sort": [list(s) for s in sort], "range": list(ranges),
+                    **{k: v for k, v in entry.items() if k != "winning_plans"},
+                    "winning_plans": dict(entry["winning_plans"]),
+                    "avg_examined_per_returned": entry["docs_examined"] / max(entry["returned"], 1)
+                }
+                for (method, equality, sort, ranges), entry in self.profile.items()
+            ]
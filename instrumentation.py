@@ -0,0 +1,333 @@
+"""
+Per-stage latency instrumentation for the ask_question pipeline.
+
+Each stage (route, prompt_build, llm_call, validate, parse, govern, execute, count, format) is
+timed with `with instrumentation.stage(name) as span:`; spans can carry byte and document
+counts via span.set(bytes=..., docs=...). Timings feed in-process histograms that can be
+exported as Prometheus text, and every question's spans can be written as one JSON line.
+
+Hooks receive stage/question events and can attach profilers or tracing spans. Disabled
+instrumentation hands out a shared no-op span, so the pipeline pays one attribute check
+and a method call per stage.
+"""
+import contextvars
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+from datetime import datetime, timezone
+
+# Upper bounds in seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUESTION = 'question'
+
+_current_trace = contextvars.ContextVar('mongobot_trace', default=None)
+
+
+class _NullSpan:
+    """Returned by disabled instrumentation: every operation is a no-op."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.docs = 0
+        self.errors = 0
+
+    def observe(self, seconds, fields, failed):
+        i = 0
+        for bound in self.buckets:
+            if seconds <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.bytes += fields.get('bytes', 0)
+        self.docs += fields.get('docs', 0)
+        self.errors += failed
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (the max for the +Inf bucket)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.5) * 1000, 3),
+            "p95_ms": round(self.quantile(0.95) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "bytes": self.bytes,
+            "docs": self.docs,
+            "errors": self.errors
+        }
+
+
+class Span:
+    __slots__ = ('instrumentation', 'name', 'fields', 'started', 'seconds', 'trace', 'hook_state')
+
+    def __init__(self, instrumentation, name, fields):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.fields = fields
+        self.started = 0.0
+        self.seconds = None
+        self.trace = None
+        self.hook_state = {}
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        for hook in self.instrumentation._on_stage_started:
+            hook(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.instrumentation._record(self, exc_type is not None)
+        for hook in self.instrumentation._on_stage_finished:
+            hook(self)
+        return False
+
+
+class QuestionTrace:
+    """All spans of one question; becomes one JSON line when the question finishes."""
+    __slots__ = ('instrumentation', 'question', 'started_at', 'started', 'seconds', 'spans', 'token', 'fields')
+
+    def __init__(self, instrumentation, question):
+        self.instrumentation = instrumentation
+        self.question = question
+        self.started_at = None
+        self.started = 0.0
+        self.seconds = None
+        self.spans = []
+        self.token = None
+        self.fields = {}
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.token = _current_trace.set(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.started
+        _current_trace.reset(self.token)
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.instrumentation._finish_question(self, exc_type is not None)
+        return False
+
+    def to_dict(self):
+        return {
+            "ts": self.started_at.isoformat(),
+            "question": self.question,
+            "total_ms": round(self.seconds * 1000, 3),
+            **self.fields,
+            "stages": [{"stage": span.name, "ms": round(span.seconds * 1000, 3), **span.fields} for span in self.spans]
+        }
+
+
+class Instrumentation:
+    def __init__(self, enabled=True, hooks=(), jsonl_path=None, buckets=DEFAULT_BUCKETS, namespace='mongobot'):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.namespace = namespace
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._on_stage_started = []
+        self._on_stage_finished = []
+        self._on_question_finished = []
+        for hook in hooks:
+            self.add_hook(hook)
+
+    def add_hook(self, hook):
+        """
+        Registers an object implementing any of stage_started(span), stage_finished(span)
+        and question_finished(trace). Hooks run synchronously on the calling thread.
+        """
+        for method, registry in (('stage_started', self._on_stage_started),
+                                 ('stage_finished', self._on_stage_finished),
+                                 ('question_finished', self._on_question_finished)):
+            callback = getattr(hook, method, None)
+            if callback is not None:
+                registry.append(callback)
+
+    def stage(self, name, **fields):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, fields)
+
+    def question(self, question):
+        if not self.enabled:
+            return NULL_SPAN
+        return QuestionTrace(self, question)
+
+    def bind(self, fn):
+        """Wraps fn to run in the current context, so spans in worker threads join the current question."""
+        if not self.enabled:
+            return fn
+        return _ContextBound(contextvars.copy_context(), fn)
+
+    def _histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms.setdefault(name, Histogram(self.buckets))
+        return histogram
+
+    def _record(self, span, failed):
+        with self._lock:
+            self._histogram(span.name).observe(span.seconds, span.fields, failed)
+        if span.trace is not None:
+            span.trace.spans.append(span)
+
+    def _finish_question(self, trace, failed):
+        with self._lock:
+            self._histogram(QUESTION).observe(trace.seconds, trace.fields, failed)
+        if self.jsonl_path:
+            line = json.dumps(trace.to_dict(), default=str)
+            with self._lock, open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        for hook in self._on_question_finished:
+            hook(trace)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+
+    def prometheus_text(self):
+        """Renders the histograms in the Prometheus text exposition format."""
+        ns = self.namespace
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            lines = [f"# HELP {ns}_stage_seconds Latency of ask_question pipeline stages ('{QUESTION}' is end to end).",
+                     f"# TYPE {ns}_stage_seconds histogram"]
+            for name, h in histograms:
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append(f'{ns}_stage_seconds_bucket{{stage="{name}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{ns}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'{ns}_stage_seconds_sum{{stage="{name}"}} {h.sum:.6f}')
+                lines.append(f'{ns}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            for metric, attr, help_text in (('stage_bytes_total', 'bytes', 'Bytes handled by each stage.'),
+                                            ('stage_documents_total', 'docs', 'Documents handled by each stage.'),
+                                            ('stage_errors_total', 'errors', 'Stage executions that raised.')):
+                lines.append(f"# HELP {ns}_{metric} {help_text}")
+                lines.append(f"# TYPE {ns}_{metric} counter")
+                for name, h in histograms:
+                    lines.append(f'{ns}_{metric}{{stage="{name}"}} {getattr(h, attr)}')
+        return '\n'.join(lines) + '\n'
+
+
+class _ContextBound:
+    __slots__ = ('context', 'fn')
+
+    def __init__(self, context, fn):
+        self.context = context
+        self.fn = fn
+
+    def __call__(self, *args, **kwargs):
+        return self.context.run(self.fn, *args, **kwargs)
+
+
+class CProfileHook:
+    """
+    Profiles the selected stages with cProfile and accumulates the statistics. Only one
+    stage is profiled at a time; overlapping stages on other threads are skipped.
+    """
+
+    def __init__(self, stages=('llm_call', 'execute', 'format')):
+        self.stages = set(stages)
+        self.profile = cProfile.Profile()
+        self._busy = threading.Lock()
+        self.profiled = 0
+        self.skipped = 0
+
+    def stage_started(self, span):
+        if span.name not in self.stages:
+            return
+        if self._busy.acquire(blocking=False):
+            span.hook_state['cprofile'] = True
+            self.profile.enable()
+        else:
+            self.skipped += 1
+
+    def stage_finished(self, span):
+        if span.hook_state.pop('cprofile', False):
+            self.profile.disable()
+            self.profiled += 1
+            self._busy.release()
+
+    def report(self, sort='cumulative', limit=25):
+        out = io.StringIO()
+        with self._busy:
+            pstats.Stats(self.profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class OpenTelemetryHook:
+    """Emits one OpenTelemetry span per stage (requires opentelemetry-api)."""
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise RuntimeError("OpenTelemetryHook needs opentelemetry-api: pip install opentelemetry-api")
+        self.tracer = tracer or trace.get_tracer("mongobot")
+
+    def stage_started(self, span):
+        otel_span = self.tracer.start_span(f"mongobot.{span.name}")
+        span.hook_state['otel'] = otel_span
+
+    def stage_finished(self, span):
+        otel_span = span.hook_state.pop('otel', None)
+        if otel_span is None:
+            return
+        for key, value in span.fields.items():
+            otel_span.set_attribute(f"mongobot.{key}", value)
+        otel_span.end()
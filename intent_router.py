@@ -0,0 +1,233 @@
+"""
+Deterministic fast-path router for common question shapes.
+
+Questions like "count records for member X", "top 5 members by total quantity" or
+"trend of average fat per month in 2024" are parsed locally with the bot's field
+mappings and the code/date extractors from the template cache, and turned straight
+into a query string. Anything the rules do not fully understand falls back to the LLM.
+"""
+import json
+import threading
+from datetime import datetime
+
+from template_cache import extract_literals
+
+ENTITY_FIELDS = {'memberCode', 'dcsCode', 'plantCode', 'unionCode'}
+METRIC_FIELDS = {'qty': 'Qty', 'fat': 'Fat', 'snf': 'SNF', 'amount': 'Amount'}
+# Ranking without an aggregate word totals quantities but averages percentages ("members with highest fat")
+DEFAULT_ACCUMULATOR = {'qty': '$sum', 'amount': '$sum', 'fat': '$avg', 'snf': '$avg'}
+AGGREGATE_WORDS = {
+    'total': '$sum', 'sum': '$sum',
+    'average': '$avg', 'avg': '$avg', 'mean': '$avg',
+    'minimum': '$min', 'min': '$min', 'lowest': '$min', 'least': '$min',
+    'maximum': '$max', 'max': '$max', 'highest': '$max'
+}
+ACCUMULATOR_PREFIX = {'$sum': 'total', '$avg': 'avg', '$min': 'min', '$max': 'max'}
+RANK_WORDS = {'top': -1, 'highest': -1, 'bottom': 1, 'lowest': 1, 'least': 1}
+TREND_WORDS = {'trend', 'monthly', 'month', 'months', 'wise'}
+FIND_WORDS = {'show', 'list', 'find', 'get', 'give', 'display', 'details', 'detail'}
+COUNT_WORDS = {'count', 'many', 'number'}
+FILLER_WORDS = {
+    'what', 'is', 'are', 'was', 'the', 'of', 'for', 'in', 'on', 'by', 'me', 'a', 'an', 'how',
+    'all', 'which', 'who', 'has', 'have', 'had', 'with', 'per', 'during', 'records', 'record',
+    'collections', 'collection', 'collected', 'entries', 'documents', 'overall', 'each', 'please',
+    'data', 'value', 'values', 'there', 'do', 'does', 'i', 'can', 'see', 'to', 'rows', 'results'
+}
+
+
+def to_query_literal(value):
+    """Serializes a filter/pipeline into the same shell-style syntax the LLM emits."""
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{json.dumps(k)}: {to_query_literal(v)}" for k, v in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(to_query_literal(v) for v in value) + "]"
+    if isinstance(value, datetime):
+        return f'ISODate("{value.strftime("%Y-%m-%dT%H:%M:%SZ")}")'
+    return json.dumps(value)
+
+
+class RouteStats:
+    """Counts and latency per answering path (local route name, template cache, llm)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, seconds):
+        with self._lock:
+            entry = self._routes.setdefault(route, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += seconds * 1000
+            entry["max_ms"] = max(entry["max_ms"], seconds * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(e["count"] for e in self._routes.values())
+            llm = self._routes.get("llm", {}).get("count", 0)
+            routes = {
+                name: {
+                    "count": e["count"],
+                    "avg_ms": round(e["total_ms"] / e["count"], 3),
+                    "max_ms": round(e["max_ms"], 3)
+                }
+                for name, e in self._routes.items()
+            }
+            return {
+                "questions": total,
+                "avoided_llm": total - llm,
+                "avoided_llm_rate": (total - llm) / total if total else 0.0,
+                "routes": routes
+            }
+
+
+class IntentRouter:
+    def __init__(self, field_mappings):
+        # Multi-word aliases ("member code", "milk qty") are matched before single words
+        self.phrases = sorted(
+            ((tuple(alias.split()), field) for alias, field in field_mappings.items()),
+            key=lambda p: len(p[0]), reverse=True
+        )
+
+    def _tag(self, words):
+        """Maps each word (or alias phrase) to a (kind, value) token. Returns None on an unknown word."""
+        tokens = []
+        i = 0
+        while i < len(words):
+            for phrase, field in self.phrases:
+                if tuple(words[i:i + len(phrase)]) == phrase:
+                    if field in ENTITY_FIELDS:
+                        tokens.append(('entity', field))
+                    elif field in METRIC_FIELDS:
+                        tokens.append(('metric', field))
+                    else:
+                        return None
+                    i += len(phrase)
+                    break
+            else:
+                word = words[i]
+                if word in ('<code>', '<num>'):
+                    tokens.append((word.strip('<>'), None))
+                elif word in ('<day>', '<month>', '<year>'):
+                    tokens.append(('period', None))
+                elif word in AGGREGATE_WORDS or word in RANK_WORDS:
+                    tokens.append(('agg', word))
+                elif word in TREND_WORDS:
+                    tokens.append(('trend', word))
+                elif word in COUNT_WORDS:
+                    tokens.append(('count', word))
+                elif word in FIND_WORDS:
+                    tokens.append(('find', word))
+                elif word not in FILLER_WORDS:
+                    return None
+                i += 1
+        return tokens
+
+    def route(self, question):
+        """Returns (route_name, query_text) when confident, otherwise None."""
+        key, literals = extract_literals(question)
+        if not key:
+            return None
+        tokens = self._tag(key.split())
+        if tokens is None:
+            return None
+
+        codes = [lit for lit in literals if lit['kind'] == 'code']
+        numbers = [lit for lit in literals if lit['kind'] == 'num']
+        periods = [lit for lit in literals if 'start' in lit]
+        if len(codes) > 1 or len(periods) > 1 or len(numbers) > 1:
+            return None
+
+        kinds = [kind for kind, _ in tokens]
+        metrics = {value for kind, value in tokens if kind == 'metric'}
+        agg_words = [value for kind, value in tokens if kind == 'agg']
+        if len(metrics) > 1:
+            return None
+        metric = next(iter(metrics), None)
+
+        # A code must be introduced by an entity word ("member 7301..."); other entity words are group keys.
+        match_filter = {}
+        group_fields = []
+        for idx, (kind, value) in enumerate(tokens):
+            if kind == 'entity':
+                if idx + 1 < len(tokens) and tokens[idx + 1][0] == 'code':
+                    match_filter[value] = codes[0]['text']
+                else:
+                    group_fields.append(value)
+            elif kind == 'code' and (idx == 0 or tokens[idx - 1][0] != 'entity'):
+                return None
+        if len(set(group_fields)) > 1:
+            return None
+        group_field = group_fields[0] if group_fields else None
+        if periods:
+            match_filter['dateTimeOfCollection'] = {"$gte": periods[0]['start'], "$lt": periods[0]['end']}
+        filter_text = to_query_literal(match_filter)
+
+        if 'count' in kinds:
+            if metric or group_field or agg_words or numbers or 'trend' in kinds:
+                return None
+            return "count", f"count_documents({filter_text})"
+
+        if 'trend' in kinds:
+            if not metric or group_field or numbers or len(agg_words) > 1:
+                return None
+            if agg_words and agg_words[0] not in AGGREGATE_WORDS:
+                return None
+            accumulator = AGGREGATE_WORDS[agg_words[0]] if agg_words else '$avg'
+            pipeline = []
+            if match_filter:
+                pipeline.append({"$match": match_filter})
+            pipeline.append({"$group": {
+                "_id": {"month": {"$month": "$dateTimeOfCollection"}},
+                ACCUMULATOR_PREFIX[accumulator] + METRIC_FIELDS[metric]: {accumulator: f"${metric}"}
+            }})
+            pipeline.append({"$sort": {"_id.month": 1}})
+            return "trend", f"aggregate({to_query_literal(pipeline)})"
+
+        if group_field:
+            # "top 5 members by total quantity", "which member has the highest average snf"
+            if not metric or not agg_words:
+                return None
+            rank_words = [w for w in agg_words if w in RANK_WORDS]
+            if not rank_words:
+                return None
+            direction = RANK_WORDS[rank_words[0]]
+            remaining = [w for w in agg_words if w != rank_words[0]]
+            if len(remaining) > 1:
+                return None
+            accumulator = AGGREGATE_WORDS[remaining[0]] if remaining else DEFAULT_ACCUMULATOR[metric]
+            limit = int(numbers[0]['text']) if numbers else 1
+            if numbers and '.' in numbers[0]['text']:
+                return None
+            name = ACCUMULATOR_PREFIX[accumulator] + METRIC_FIELDS[metric]
+            pipeline = []
+            if match_filter:
+                pipeline.append({"$match": match_filter})
+            pipeline += [
+                {"$group": {"_id": f"${group_field}", name: {accumulator: f"${metric}"}}},
+                {"$sort": {name: direction}},
+                {"$limit": limit}
+            ]
+            return "top_n", f"aggregate({to_query_literal(pipeline)})"
+
+        if metric:
+            # "minimum snf for dcs X", "average quantity per collection overall"
+            if len(agg_words) != 1 or agg_words[0] not in AGGREGATE_WORDS or numbers:
+                return None
+            accumulator = AGGREGATE_WORDS[agg_words[0]]
+            entity = next(iter(f for f in match_filter if f in ENTITY_FIELDS), None)
+            name = ACCUMULATOR_PREFIX[accumulator] + METRIC_FIELDS[metric]
+            pipeline = []
+            if match_filter:
+                pipeline.append({"$match": match_filter})
+            pipeline.append({"$group": {"_id": f"${entity}" if entity else None, name: {accumulator: f"${metric}"}}})
+            return "metric", f"aggregate({to_query_literal(pipeline)})"
+
+        if 'find' in kinds and match_filter and not agg_words:
+            query = f"find({filter_text})"
+            if numbers:
+                if '.' in numbers[0]['text']:
+                    return None
+                query += f".limit({int(numbers[0]['text'])})"
+            return "find", query
+
+        return None
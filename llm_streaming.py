@@ -0,0 +1,117 @@
+"""
+Incremental assembly of a streamed LLM response into a query string.
+
+Chunks are scanned as they arrive, tracking bracket depth and string/escape state. As soon
+as a complete find(...)/aggregate([...])/distinct(...)/count_documents(...) expression has
+arrived (including chained .sort/.skip/.limit on find), the query is returned and the rest
+of the stream can be abandoned.
+"""
+import re
+
+QUERY_START = re.compile(r'\b(find|aggregate|distinct|count_documents)\s*\(')
+OPENERS = '([{'
+CLOSERS = ')]}'
+
+
+class QueryStreamAssembler:
+    def __init__(self):
+        self.buffer = ''
+        self.method = None
+        self.start = None
+        self.pos = 0
+        self.depth = 0
+        self.quote = None
+        self.escape = False
+        self.candidate_end = None
+
+    def feed(self, text):
+        """Adds a chunk of model output. Returns the complete query once it has arrived, else None."""
+        self.buffer += text
+        if self.start is None:
+            match = QUERY_START.search(self.buffer)
+            if match is None:
+                return None
+            self.method = match.group(1)
+            self.start = self.pos = match.start()
+        return self._scan()
+
+    def _scan(self):
+        buffer = self.buffer
+        i = self.pos
+        while i < len(buffer):
+            c = buffer[i]
+            if self.candidate_end is not None and self.depth == 0:
+                # Only find() may continue with a chained cursor method
+                if c.isspace():
+                    i += 1
+                    continue
+                if c == '.':
+                    self.candidate_end = None
+                else:
+                    return self._complete()
+            if self.quote:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == self.quote:
+                    self.quote = None
+            elif c in '"\'':
+                self.quote = c
+            elif c in OPENERS:
+                self.depth += 1
+            elif c in CLOSERS:
+                self.depth -= 1
+                if self.depth == 0 and c == ')':
+                    self.candidate_end = i + 1
+                    if self.method != 'find':
+                        self.pos = i + 1
+                        return self._complete()
+                elif self.depth < 0:
+                    self.depth = 0
+            i += 1
+        self.pos = i
+        return None
+
+    def _complete(self):
+        return self.buffer[self.start:self.candidate_end].strip()
+
+    @property
+    def complete(self):
+        return self.candidate_end is not None and self.depth == 0
+
+    def finish(self):
+        """Called when the stream ends: returns the best available query text."""
+        if self.complete:
+            return self._complete()
+        if self.start is not None:
+            return self.buffer[self.start:].strip().rstrip('`').strip()
+        # No recognizable query; clean up markdown the same way as non-streamed responses
+        text = re.sub(r"^(```(json|mongodb|python)?\n?)", "", self.buffer.strip())
+        return re.sub(r"```$", "", text).strip('`').strip()
+
+
+def read_streamed_query(chunks):
+    """
+    Consumes an iterable of response chunks (objects with a .text attribute) until a complete
+    query has arrived. Returns (query_text, stopped_early, chars_read, usage_chunk), where
+    usage_chunk is the last chunk read that carried usage_metadata (or None).
+    """
+    assembler = QueryStreamAssembler()
+    usage_chunk = None
+    for chunk in chunks:
+        if getattr(chunk, 'usage_metadata', None) is not None:
+            usage_chunk = chunk
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. a final usage-only chunk) raise in the Gemini SDK
+            continue
+        query_text = assembler.feed(text or '')
+        if query_text is not None:
+            # Stop generating the rest of the response where the stream supports it
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            return query_text, True, len(assembler.buffer), usage_chunk
+    return assembler.finish(), False, len(assembler.buffer), usage_chunk
@@ -0,0 +1,150 @@
+"""
+Load test for the HTTP service mode (server.py).
+
+By default an in-process server is started on an ephemeral port, backed by the offline
+Gemini/MongoDB stand-ins with configurable latency, so the effect of connection sharing and
+request coalescing can be measured without credentials. Point --url at a running server to
+load-test a real deployment instead.
+
+    python load_test.py --requests 500 --concurrency 32 --distinct-questions 8
+    python load_test.py --url http://127.0.0.1:8080 --requests 200
+"""
+import argparse
+import contextlib
+import io
+import json
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from prompt_builder import DEFAULT_EXAMPLES
+
+CODE_PATTERN = re.compile(r'\d{12,16}')
+
+
+def question_corpus(distinct):
+    """
+    Returns `distinct` (question, query) pairs built from the prompt examples; beyond the
+    example count, variants are produced by substituting the member/DCS codes.
+    """
+    corpus = []
+    for i in range(distinct):
+        question, query = DEFAULT_EXAMPLES[i % len(DEFAULT_EXAMPLES)]
+        variant = i // len(DEFAULT_EXAMPLES)
+        if variant:
+            def substitute(match):
+                return match.group()[:-3] + f"{variant % 1000:03d}"
+            question, query = CODE_PATTERN.sub(substitute, question), CODE_PATTERN.sub(substitute, query)
+        corpus.append((question, query))
+    return corpus
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def post_question(url, question, timeout):
+    body = json.dumps({"question": question}).encode('utf-8')
+    request = urllib.request.Request(url + "/ask", data=body, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = json.loads(response.read())
+            status = response.status
+    except urllib.error.HTTPError as e:
+        payload, status = {}, e.code
+    except (urllib.error.URLError, TimeoutError, OSError):
+        payload, status = {}, 'error'
+    return status, time.perf_counter() - started, payload.get("coalesced", False)
+
+
+def get_json(url, path):
+    with urllib.request.urlopen(url + path, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def run_load(url, questions, requests, concurrency, timeout):
+    latencies = []
+    statuses = Counter()
+    coalesced = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal coalesced
+        status, elapsed, was_coalesced = post_question(url, questions[i % len(questions)], timeout)
+        with lock:
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(elapsed)
+                coalesced += was_coalesced
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(requests / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "statuses": dict(statuses),
+        "coalesced_responses": coalesced
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the EnhancedMongoDBBot HTTP service.")
+    parser.add_argument("--url", help="target server; default starts an in-process offline server")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--distinct-questions", type=int, default=len(DEFAULT_EXAMPLES))
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--documents", type=int, default=20000, help="synthetic documents (in-process server)")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="simulated LLM latency in seconds")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="simulated MongoDB round trip in seconds")
+    args = parser.parse_args()
+
+    corpus = question_corpus(args.distinct_questions)
+    questions = [question for question, _ in corpus]
+    server = None
+    url = args.url
+    if url is None:
+        from server import BotService, make_fake_bot, make_server
+        with contextlib.redirect_stdout(io.StringIO()):
+            bot = make_fake_bot(args.documents, args.llm_latency, args.mongo_latency, answers=dict(corpus))
+        service = BotService(bot, timeout=args.timeout, workers=args.concurrency)
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        # The bot's per-question progress output would swamp the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = run_load(url, questions, args.requests, args.concurrency, args.timeout)
+        stats = get_json(url, "/stats")
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    print(json.dumps(report, indent=2))
+    print(json.dumps({
+        "service": stats.get("service"),
+        "query_coalescing": stats.get("bot", {}).get("query_coalescing"),
+        "routing": stats.get("bot", {}).get("routing")
+    }, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
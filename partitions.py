@@ -0,0 +1,563 @@
+"""
+Time-partitioned milk_collections: one collection per month (or year/day), e.g.
+milk_collections_2024_11, behind a collection-like facade.
+
+Queries are planned against the partitions whose time span can satisfy the
+dateTimeOfCollection conditions of the filter; the rest are pruned. Counts, distinct and
+aggregations run on the surviving partitions in parallel and the partial results are merged:
+
+* count_documents / $count     sum of the partition counts
+* distinct                     ordered set union
+* $group                       per-partition partial groups, merged by _id: $sum/$min/$max
+                               directly, $avg from a partial sum and numeric count
+* $sort (+ $skip/$limit)       each partition returns its own top N, k-way merged
+* $sample                      per-partition sample sizes proportional to partition size
+
+Stages after the merge point run in Python when they are $sort/$skip/$limit/$count/$project
+(inclusion or exclusion). Other pipelines run on the server in one aggregation using
+$unionWith across the surviving partitions (MongoDB 4.4+), so results stay exact.
+"""
+import copy
+import functools
+import heapq
+import itertools
+import math
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import bson
+
+DATE_FIELD = 'dateTimeOfCollection'
+GRANULARITIES = ('yearly', 'monthly', 'daily')
+PER_DOCUMENT_STAGES = {'$match', '$project', '$addFields', '$set', '$unset', '$unwind'}
+MERGEABLE_ACCUMULATORS = {'$sum', '$min', '$max', '$avg', '$count'}
+
+
+class UnsupportedPipeline(Exception):
+    """Raised when partial results of a pipeline cannot be merged in Python."""
+
+
+def _naive_utc(value):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _get_path(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+# MongoDB's cross-type sort order, for the types that occur here
+_TYPE_ORDER = ((type(None), 0), (bool, 7), ((int, float), 1), (str, 2), (dict, 3), (list, 4), (bson.ObjectId, 6), (datetime, 8))
+
+
+def _type_rank(value):
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            return rank
+    return 9
+
+
+def _compare_values(a, b):
+    a, b = _naive_utc(a), _naive_utc(b)
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    try:
+        return -1 if a < b else (1 if a > b else 0)
+    except TypeError:
+        return 0
+
+
+def sort_key(sort):
+    """A key function ordering documents by a [(field, direction), ...] sort specification."""
+    sort = list(sort.items()) if isinstance(sort, dict) else list(sort)
+
+    def compare(a, b):
+        for field, direction in sort:
+            result = _compare_values(_get_path(a, field), _get_path(b, field))
+            if result:
+                return result if direction >= 0 else -result
+        return 0
+    return functools.cmp_to_key(compare)
+
+
+def _condition_allows(condition, start, end):
+    """Whether a dateTimeOfCollection condition can match a value in [start, end)."""
+    if isinstance(condition, datetime):
+        value = _naive_utc(condition)
+        return start <= value < end
+    if not isinstance(condition, dict) or not all(k.startswith('$') for k in condition):
+        return True
+    for op, value in condition.items():
+        value = _naive_utc(value)
+        if op == '$in' and isinstance(value, list):
+            dates = [_naive_utc(v) for v in value]
+            if all(isinstance(v, datetime) for v in dates) and not any(start <= v < end for v in dates):
+                return False
+        if not isinstance(value, datetime):
+            continue
+        if (op in ('$gt', '$gte') and end <= value) or (op == '$lt' and start >= value) or (op == '$lte' and start > value) \
+                or (op == '$eq' and not start <= value < end):
+            return False
+    return True
+
+
+def filter_allows(filter_query, start, end):
+    """False only if no document dated in [start, end) can match the filter."""
+    if not isinstance(filter_query, dict):
+        return True
+    for field, condition in filter_query.items():
+        if field == DATE_FIELD and not _condition_allows(condition, start, end):
+            return False
+        if field == '$and' and isinstance(condition, list) and not all(filter_allows(c, start, end) for c in condition):
+            return False
+        if field == '$or' and isinstance(condition, list) and condition and not any(filter_allows(c, start, end) for c in condition):
+            return False
+    return True
+
+
+class Partition:
+    __slots__ = ('name', 'start', 'end')
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"Partition({self.name!r}, {self.start:%Y-%m-%d}, {self.end:%Y-%m-%d})"
+
+
+class PartitionedCursor:
+    """Chainable find() cursor over the partitions (sort/skip/limit/max_time_ms like pymongo)."""
+
+    def __init__(self, collection, filter_query, projection=None, batch_size=None, sort=None, skip=0, limit=0):
+        self._collection = collection
+        self._filter = filter_query or {}
+        self._projection = projection
+        self._batch_size = batch_size
+        self._sort = list(sort.items()) if isinstance(sort, dict) else sort
+        self._skip = skip or 0
+        self._limit = limit or 0
+        self._max_time_ms = None
+        self._iterator = None
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction or 1)]
+        else:
+            self._sort = list(key_or_list.items()) if isinstance(key_or_list, dict) else list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self._max_time_ms = max_time_ms
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def _partition_cursor(self, partition):
+        options = {}
+        if self._batch_size:
+            options['batch_size'] = self._batch_size
+        # Each partition query gets its own projection: some clients normalize it in place
+        projection = dict(self._projection) if isinstance(self._projection, dict) else self._projection
+        cursor = self._collection.db[partition.name].find(self._filter, projection, **options)
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._limit:
+            # Rows skipped overall may come from any partition, so each returns skip + limit
+            cursor = cursor.limit(self._skip + self._limit)
+        if self._max_time_ms:
+            cursor = cursor.max_time_ms(self._max_time_ms)
+        return cursor
+
+    def _documents(self):
+        partitions = self._collection.prune(self._filter)
+        if self._limit:
+            # Bounded: fetch every partition's share in parallel, then merge
+            parts = self._collection._map(lambda p: list(self._partition_cursor(p)), partitions)
+        else:
+            # Unbounded: stream partition cursors lazily to keep memory flat
+            parts = [self._partition_cursor(p) for p in partitions]
+        if self._sort:
+            documents = heapq.merge(*parts, key=sort_key(self._sort))
+        else:
+            documents = itertools.chain.from_iterable(parts)
+        stop = self._skip + self._limit if self._limit else None
+        return itertools.islice(documents, self._skip, stop)
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = self._documents()
+        return self._iterator
+
+    def __next__(self):
+        return next(iter(self))
+
+    def close(self):
+        self._iterator = iter(())
+
+
+class PartitionedCollection:
+    def __init__(self, db, base_name='milk_collections', granularity='monthly', workers=8, discovery_ttl=60):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"granularity must be one of {GRANULARITIES}")
+        self.db = db
+        self.database = db
+        self.name = base_name
+        self.granularity = granularity
+        self.discovery_ttl = discovery_ttl
+        self._pattern = re.compile(rf"^{re.escape(base_name)}_(\d{{4}})" + {
+            'yearly': r"$", 'monthly': r"_(\d{2})$", 'daily': r"_(\d{2})_(\d{2})$"}[granularity])
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="partition")
+        self._lock = threading.Lock()
+        self._partitions = None
+        self._discovered_at = 0.0
+        self.queries = 0
+        self.partitions_scanned = 0
+        self.partitions_pruned = 0
+        self.union_fallbacks = 0
+
+    # --- partition layout ------------------------------------------------------------------
+
+    def period_bounds(self, moment):
+        moment = _naive_utc(moment)
+        if self.granularity == 'yearly':
+            start = datetime(moment.year, 1, 1)
+            return start, datetime(moment.year + 1, 1, 1)
+        if self.granularity == 'monthly':
+            start = datetime(moment.year, moment.month, 1)
+            return start, datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+        start = datetime(moment.year, moment.month, moment.day)
+        return start, start + timedelta(days=1)
+
+    def partition_name(self, moment):
+        moment = _naive_utc(moment)
+        suffix = {'yearly': f"{moment.year:04d}", 'monthly': f"{moment.year:04d}_{moment.month:02d}",
+                  'daily': f"{moment.year:04d}_{moment.month:02d}_{moment.day:02d}"}[self.granularity]
+        return f"{self.name}_{suffix}"
+
+    def partitions(self, refresh=False):
+        """The existing partitions in time order (collection names are re-listed every discovery_ttl seconds)."""
+        with self._lock:
+            if not refresh and self._partitions is not None and time.monotonic() - self._discovered_at < self.discovery_ttl:
+                return self._partitions
+        found = []
+        for name in self.db.list_collection_names():
+            match = self._pattern.match(name)
+            if match:
+                parts = [int(g) for g in match.groups()] + [1, 1]
+                start, end = self.period_bounds(datetime(parts[0], parts[1], parts[2]))
+                found.append(Partition(name, start, end))
+        found.sort(key=lambda p: p.start)
+        with self._lock:
+            self._partitions = found
+            self._discovered_at = time.monotonic()
+        return found
+
+    def prune(self, filter_query):
+        """The partitions that may hold documents matching the filter."""
+        partitions = self.partitions()
+        kept = [p for p in partitions if filter_allows(filter_query, p.start, p.end)]
+        with self._lock:
+            self.queries += 1
+            self.partitions_scanned += len(kept)
+            self.partitions_pruned += len(partitions) - len(kept)
+        return kept
+
+    def _map(self, fn, partitions):
+        if len(partitions) <= 1:
+            return [fn(p) for p in partitions]
+        return list(self._executor.map(fn, partitions))
+
+    # --- writes ----------------------------------------------------------------------------
+
+    def insert_many(self, documents, batch_size=10000, **kwargs):
+        """Routes documents to their partitions by dateTimeOfCollection."""
+        pending = {}
+        created = False
+        for doc in documents:
+            name = self.partition_name(doc[DATE_FIELD])
+            batch = pending.setdefault(name, [])
+            batch.append(doc)
+            if len(batch) == batch_size:
+                self.db[name].insert_many(batch, **kwargs)
+                pending[name] = []
+                created = True
+        for name, batch in pending.items():
+            if batch:
+                self.db[name].insert_many(batch, **kwargs)
+                created = True
+        if created:
+            self.partitions(refresh=True)
+
+    def insert_one(self, document, **kwargs):
+        result = self.db[self.partition_name(document[DATE_FIELD])].insert_one(document, **kwargs)
+        self.partitions(refresh=True)
+        return result
+
+    def watch(self, pipeline=None, **kwargs):
+        """Change stream over every partition, including ones created later."""
+        match = [{"$match": {"ns.coll": {"$regex": self._pattern.pattern}}}]
+        return self.db.watch(match + list(pipeline or []), **kwargs)
+
+    def create_index(self, keys, **kwargs):
+        """Creates the index on every partition; returns its name."""
+        names = self._map(lambda p: self.db[p.name].create_index(keys, **kwargs), self.partitions(refresh=True))
+        return names[0] if names else None
+
+    def index_information(self):
+        partitions = self.partitions()
+        return self.db[partitions[-1].name].index_information() if partitions else {}
+
+    # --- reads -----------------------------------------------------------------------------
+
+    def find(self, filter=None, projection=None, batch_size=None, sort=None, skip=0, limit=0, **kwargs):
+        return PartitionedCursor(self, filter, projection, batch_size=batch_size, sort=sort, skip=skip, limit=limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        return next(iter(self.find(filter, projection, sort=sort, limit=1)), None)
+
+    def count_documents(self, filter, **kwargs):
+        return sum(self._map(lambda p: self.db[p.name].count_documents(filter, **kwargs), self.prune(filter)))
+
+    def estimated_document_count(self, **kwargs):
+        return sum(self._map(lambda p: self.db[p.name].estimated_document_count(**kwargs), self.partitions()))
+
+    def distinct(self, key, filter=None, **kwargs):
+        parts = self._map(lambda p: self.db[p.name].distinct(key, filter or {}, **kwargs), self.prune(filter or {}))
+        values, seen = [], set()
+        for value in itertools.chain.from_iterable(parts):
+            marker = bson.encode({"v": value})
+            if marker not in seen:
+                seen.add(marker)
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline, **kwargs):
+        pipeline = list(pipeline)
+        prune_filter = {"$and": [stage['$match'] for stage in itertools.takewhile(lambda s: '$match' in s, pipeline)]}
+        partitions = self.prune(prune_filter)
+        if not partitions:
+            return iter([])
+        try:
+            return iter(self._aggregate_merged(partitions, pipeline, kwargs))
+        except UnsupportedPipeline:
+            with self._lock:
+                self.union_fallbacks += 1
+            return self._aggregate_union(partitions, pipeline, kwargs)
+
+    def _run(self, partitions, pipeline, options, sizes=None):
+        """Runs a per-partition pipeline everywhere in parallel; `sizes` adjusts $sample per partition."""
+        def run(partition):
+            stages = copy.deepcopy(pipeline)
+            if sizes is not None:
+                stages = [{"$sample": {"size": sizes[partition.name]}} if '$sample' in s else s for s in stages]
+            return list(self.db[partition.name].aggregate(stages, **options))
+        return self._map(run, partitions)
+
+    def _sample_sizes(self, partitions, size):
+        """Splits a $sample size across partitions in proportion to their sizes (largest remainders)."""
+        counts = self._map(lambda p: self.db[p.name].estimated_document_count(), partitions)
+        total = sum(counts) or 1
+        shares = [size * count / total for count in counts]
+        sizes = [math.floor(share) for share in shares]
+        by_remainder = sorted(range(len(shares)), key=lambda i: (sizes[i] - shares[i], random.random()))
+        for i in by_remainder[:size - sum(sizes)]:
+            sizes[i] += 1
+        return {p.name: n for p, n in zip(partitions, sizes)}
+
+    def _aggregate_merged(self, partitions, pipeline, options):
+        options = {k: v for k, v in options.items() if k != 'batchSize'}
+        local = []
+        sizes = None
+        i = 0
+        while i < len(pipeline):
+            stage = pipeline[i]
+            op = next(iter(stage))
+            if op in PER_DOCUMENT_STAGES:
+                local.append(stage)
+            elif op == '$sample':
+                # Proportional per-partition samples together form a sample of the whole
+                if sizes is not None:
+                    raise UnsupportedPipeline(op)
+                sizes = self._sample_sizes(partitions, stage['$sample']['size'])
+                partitions = [p for p in partitions if sizes[p.name]]
+                local.append(stage)
+            else:
+                break
+            i += 1
+        rest = pipeline[i:]
+
+        if not rest:
+            return list(itertools.chain.from_iterable(self._run(partitions, local, options, sizes)))
+
+        op = next(iter(rest[0]))
+        if sizes is not None and op not in ('$group', '$count', '$facet', '$limit'):
+            raise UnsupportedPipeline('$sample')
+        if op == '$group':
+            results = self._merge_groups(partitions, local, rest[0]['$group'], options, sizes)
+            return self._apply_post_stages(results, rest[1:])
+        if op == '$count':
+            totals = self._run(partitions, local + [rest[0]], options, sizes)
+            name = rest[0]['$count']
+            total = sum(docs[0][name] for docs in totals if docs)
+            return self._apply_post_stages([{name: total}] if total else [], rest[1:])
+        if op == '$facet':
+            if len(rest) > 1:
+                raise UnsupportedPipeline(op)
+            # Each facet is planned on its own (after $sample, each draws its own sample)
+            return [{name: self._aggregate_merged(partitions, local + sub_pipeline, options)
+                     for name, sub_pipeline in rest[0]['$facet'].items()}]
+        if op == '$sort':
+            bound = self._leading_bound(rest[1:])
+            per_partition = local + [rest[0]] + ([{"$limit": bound}] if bound else [])
+            parts = self._run(partitions, per_partition, options, sizes)
+            merged = list(heapq.merge(*parts, key=sort_key(rest[0]['$sort'])))
+            return self._apply_post_stages(merged, rest[1:])
+        if op == '$limit':
+            documents = list(itertools.chain.from_iterable(self._run(partitions, local + [rest[0]], options, sizes)))
+            if sizes is not None:
+                # Without this the first partitions would fill the limit of a sample
+                random.shuffle(documents)
+            return self._apply_post_stages(documents, rest)
+        raise UnsupportedPipeline(op)
+
+    @staticmethod
+    def _leading_bound(stages):
+        """skip + limit of the $skip/$limit stages directly after a $sort (0 if unbounded)."""
+        skip = 0
+        for stage in stages:
+            if '$skip' in stage:
+                skip += stage['$skip']
+            elif '$limit' in stage:
+                return skip + stage['$limit']
+            else:
+                break
+        return 0
+
+    def _merge_groups(self, partitions, local, group, options, sizes):
+        partial = {"_id": group.get('_id')}
+        plan = []
+        for name, accumulator in group.items():
+            if name == '_id':
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                raise UnsupportedPipeline(name)
+            op, arg = next(iter(accumulator.items()))
+            if op not in MERGEABLE_ACCUMULATORS:
+                raise UnsupportedPipeline(op)
+            if op == '$count':
+                partial[name] = {"$sum": 1}
+                op = '$sum'
+            elif op == '$avg':
+                partial[f"{name}__sum"] = {"$sum": arg}
+                partial[f"{name}__count"] = {"$sum": {"$cond": [{"$isNumber": arg}, 1, 0]}}
+            else:
+                partial[name] = {op: arg}
+            plan.append((name, op))
+
+        parts = self._run(partitions, local + [{"$group": partial}], options, sizes)
+        groups = {}
+        for doc in itertools.chain.from_iterable(parts):
+            key = bson.encode({"k": doc["_id"]})
+            merged = groups.get(key)
+            if merged is None:
+                groups[key] = dict(doc)
+                continue
+            for name, op in plan:
+                if op == '$avg':
+                    merged[f"{name}__sum"] = (merged[f"{name}__sum"] or 0) + (doc[f"{name}__sum"] or 0)
+                    merged[f"{name}__count"] += doc[f"{name}__count"]
+                elif op == '$sum':
+                    merged[name] = (merged[name] or 0) + (doc[name] or 0)
+                elif doc[name] is not None:
+                    # $min/$max ignore missing values
+                    if merged[name] is None:
+                        merged[name] = doc[name]
+                    else:
+                        order = _compare_values(doc[name], merged[name])
+                        if (op == '$min' and order < 0) or (op == '$max' and order > 0):
+                            merged[name] = doc[name]
+
+        results = []
+        for merged in groups.values():
+            doc = {"_id": merged["_id"]}
+            for name, op in plan:
+                if op == '$avg':
+                    count = merged.pop(f"{name}__count")
+                    total = merged.pop(f"{name}__sum")
+                    doc[name] = total / count if count else None
+                else:
+                    doc[name] = merged[name]
+            results.append(doc)
+        return results
+
+    def _apply_post_stages(self, documents, stages):
+        """Runs the stages MongoDB would run after the merge point, in Python."""
+        for stage in stages:
+            op, spec = next(iter(stage.items()))
+            if op == '$sort':
+                documents = sorted(documents, key=sort_key(spec))
+            elif op == '$skip':
+                documents = documents[spec:]
+            elif op == '$limit':
+                documents = documents[:spec]
+            elif op == '$count':
+                documents = [{spec: len(documents)}] if documents else []
+            elif op == '$project' and all(v in (0, 1, True, False) for v in spec.values()):
+                documents = [self._project(doc, spec) for doc in documents]
+            else:
+                raise UnsupportedPipeline(op)
+        return documents
+
+    @staticmethod
+    def _project(doc, spec):
+        include_id = spec.get('_id', 1)
+        fields = {k: v for k, v in spec.items() if k != '_id'}
+        if fields and all(fields.values()):
+            projected = {k: doc[k] for k in fields if k in doc}
+            if include_id and '_id' in doc:
+                projected = {"_id": doc["_id"], **projected}
+            return projected
+        projected = {k: v for k, v in doc.items() if k not in fields}
+        if not include_id:
+            projected.pop('_id', None)
+        return projected
+
+    def _aggregate_union(self, partitions, pipeline, options):
+        """Exact fallback: one server-side aggregation over the partitions via $unionWith."""
+        first, others = partitions[0], partitions[1:]
+        leading_match = list(itertools.takewhile(lambda s: '$match' in s, pipeline))
+        union = [{"$unionWith": {"coll": p.name, "pipeline": leading_match}} for p in others]
+        return self.db[first.name].aggregate(leading_match + union + pipeline[len(leading_match):], **options)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "partitions": len(self._partitions or []),
+                "granularity": self.granularity,
+                "queries": self.queries,
+                "partitions_scanned": self.partitions_scanned,
+                "partitions_pruned": self.partitions_pruned,
+                "union_fallbacks": self.union_fallbacks
+            }
@@ -0,0 +1,207 @@
+"""
+Prompt construction for NL -> MongoDB query generation with dynamic few-shot selection.
+
+The prompt is split into a static prefix (instructions and schema, byte-identical across
+requests so provider-side prefix caching applies) and a short dynamic suffix with the k
+examples most similar to the question plus the question itself. Similarity is a local
+TF-IDF over word uni/bigrams and character trigrams of the question shape (codes, numbers
+and dates replaced by placeholders), so selecting examples needs no network call.
+"""
+import json
+import math
+import re
+import threading
+from collections import Counter
+
+from template_cache import extract_literals
+
+RULES = """You are an expert MongoDB query generator. Your ONLY task is to convert a user's natural language question into a single, executable PyMongo query string.
+
+**DATABASE SCHEMA**
+- Collection Name: `milk_collections`
+- Schema for your reference:
+%s
+
+**KEY FIELDS & ALIASES**
+- `memberCode` (string): member, member code
+- `dcsCode` (string): dcs, dcs code
+- `qty` (float/int): quantity, qty, milk, milk quantity
+- `fat` (float): fat
+- `snf` (float): snf
+- `dateTimeOfCollection` (datetime): date, datetime, collection date, time
+
+**OUTPUT RULES**
+1.  **OUTPUT ONLY THE QUERY STRING.** Start your response IMMEDIATELY with `find({...})`, `aggregate([...])`, `distinct("field", {...})`, or `count_documents({...})`.
+2.  **NO EXTRA TEXT.** Do not include explanations, comments, markdown, or language names (like "python" or "json").
+3.  **USE CORRECT FIELD NAMES.** Use the schema field names (`memberCode`, `qty`), not user aliases (`member`, `quantity`).
+4.  **CORRECT TYPES.** Numbers should be numbers (`4.1`), codes and other non-numeric IDs must be strings (`"730110400002"`).
+5.  **VALID SYNTAX.** All keys and string values must be in double quotes.
+6.  **DATE HANDLING:**
+    - Always use `ISODate`. A specific date like "on 01/01/2025" becomes a full-day range: `{"dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-01-02T00:00:00Z")}}`.
+    - A date range like "between 01/01/2025 and 03/01/2025" becomes `{"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-03-02T00:00:00Z")}`.
+7.  **AGGREGATION LOGIC:**
+    - **Top/Bottom N:** Use `$sort` and `$limit`. For "top", sort descending (`-1`). For "bottom/lowest/least", sort ascending (`1`).
+    - **Grouped Operations:** Use `$group` with accumulators like `$sum`, `$avg`, `$min`, `$max`. For a global average/sum (not grouped by a field), use `"_id": None`.
+    - **Trends:** Group by time unit (e.g., `{"month": {"$month": "$dateTimeOfCollection"}}`) and `$sort` by it.
+    - **Comparisons:** For comparing entities (e.g., member A vs member B), use `$match` with `{"$in": ["A", "B"]}` and then `$group` by the entity field.
+8.  **AVOID INVALID QUERIES:** Never start a filter with an operator.
+    - WRONG: `find({"$gt": 4.1})`
+    - RIGHT: `find({"fat": {"$gt": 4.1}})`
+"""
+
+DEFAULT_EXAMPLES = [
+    ('Show me collections for member 730110400002',
+     'find({"memberCode": "730110400002"})'),
+    ('Count records for dcs 001000001993 for Jan 2025',
+     'count_documents({"dcsCode": "001000001993", "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-02-01T00:00:00Z")}})'),
+    ('Find records with fat > 4.1 and snf > 8.5 for member 0010000019930016 in january 2025',
+     'find({"memberCode": "0010000019930016", "fat": {"$gt": 4.1}, "snf": {"$gt": 8.5}, "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-02-01T00:00:00Z")}})'),
+    ('List 10 unique member codes with qty over 100',
+     'distinct("memberCode", {"qty": {"$gt": 100}})'),
+    ('What is the lowest quantity collected on 09/11/2024?',
+     'aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-11-09T00:00:00Z"), "$lt": ISODate("2024-11-10T00:00:00Z")}}}, {"$sort": {"qty": 1}}, {"$limit": 1}])'),
+    ('Minimum SNF for DCS 001000001993',
+     'aggregate([{"$match": {"dcsCode": "001000001993"}}, {"$group": {"_id": "$dcsCode", "minSNF": {"$min": "$snf"}}}])'),
+    ('Top 5 members by total quantity',
+     'aggregate([{"$group": {"_id": "$memberCode", "totalQty": {"$sum": "$qty"}}}, {"$sort": {"totalQty": -1}}, {"$limit": 5}])'),
+    ('Which member has the highest average SNF?',
+     'aggregate([{"$group": {"_id": "$memberCode", "avgSNF": {"$avg": "$snf"}}}, {"$sort": {"avgSNF": -1}}, {"$limit": 1}])'),
+    ('What is the average quantity per collection overall?',
+     'aggregate([{"$group": {"_id": null, "avgQty": {"$avg": "$qty"}}}])'),
+    ('Trend of average fat per month in 2024',
+     'aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-01-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgFat": {"$avg": "$fat"}}}, {"$sort": {"_id.month": 1}}])'),
+    ('Compare average qty for member 0010000008650047 and member 760540500086',
+     'aggregate([{"$match": {"memberCode": {"$in": ["0010000008650047", "760540500086"]}}}, {"$group": {"_id": "$memberCode", "avgQty": {"$avg": "$qty"}}}])'),
+    ('Compare average quantity for member 0010000008650047 in November and December 2024',
+     'aggregate([{"$match": {"memberCode": "0010000008650047", "dateTimeOfCollection": {"$gte": ISODate("2024-11-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgQty": {"$avg": "$qty"}}}, {"$sort": {"_id.month": 1}}])'),
+    ('Compare total quantity for DCS 001000001993 and 001000002000 in 2024',
+     'aggregate([{"$match": {"dcsCode": {"$in": ["001000001993", "001000002000"]}, "dateTimeOfCollection": {"$gte": ISODate("2024-01-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": "$dcsCode", "totalQty": {"$sum": "$qty"}}}])'),
+]
+
+
+def _features(question):
+    """Word unigrams/bigrams and character trigrams of the question's shape."""
+    key, _ = extract_literals(question)
+    if not key:
+        key = re.sub(r'[^a-z0-9<>]+', ' ', question.lower()).strip()
+    words = key.split()
+    features = Counter(words)
+    features.update(' '.join(pair) for pair in zip(words, words[1:]))
+    for word in words:
+        if word.startswith('<'):
+            continue
+        padded = f" {word} "
+        features.update('#' + padded[i:i + 3] for i in range(len(padded) - 2))
+    return features
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token) for prompts we have not sent yet."""
+    return max(1, len(text) // 4)
+
+
+class PromptBuilder:
+    def __init__(self, schema_info, examples=None, k=4):
+        self.k = k
+        self._lock = threading.Lock()
+        self.examples = []
+        self._vectors = []
+        self._idf = {}
+        # Built once: every prompt starts with exactly these bytes
+        self.static_prefix = "\n" + RULES % json.dumps(schema_info, sort_keys=True) + "\n"
+        self.static_prefix_tokens = estimate_tokens(self.static_prefix)
+        self.requests = 0
+        self.total_estimated_tokens = 0
+        self.total_reported_tokens = 0
+        self.reported_requests = 0
+        self.cached_tokens = 0
+        for question, query in (DEFAULT_EXAMPLES if examples is None else examples):
+            self.add_example(question, query, reindex=False)
+        self._reindex()
+
+    def add_example(self, question, query, reindex=True):
+        with self._lock:
+            self.examples.append((question, query))
+        if reindex:
+            self._reindex()
+
+    def load_examples(self, path):
+        """Adds examples from a JSON file holding a list of {"question": ..., "query": ...} objects."""
+        with open(path, encoding='utf-8') as f:
+            for item in json.load(f):
+                self.add_example(item["question"], item["query"], reindex=False)
+        self._reindex()
+
+    def _reindex(self):
+        with self._lock:
+            features = [_features(question) for question, _ in self.examples]
+            df = Counter(f for feats in features for f in feats)
+            n = len(features)
+            self._idf = {f: math.log((1 + n) / (1 + count)) + 1 for f, count in df.items()}
+            self._vectors = [self._weigh(feats) for feats in features]
+
+    def _weigh(self, features):
+        vector = {f: (1 + math.log(tf)) * self._idf[f] for f, tf in features.items() if f in self._idf}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {f: w / norm for f, w in vector.items()}
+
+    def select_examples(self, question, k=None):
+        """The k stored examples most similar to the question, most similar first."""
+        k = self.k if k is None else k
+        with self._lock:
+            query_vector = self._weigh(_features(question))
+            scored = []
+            for i, vector in enumerate(self._vectors):
+                score = sum(w * vector.get(f, 0.0) for f, w in query_vector.items())
+                scored.append((-score, i))
+            scored.sort()
+            return [self.examples[i] for _, i in scored[:k]]
+
+    def build(self, question):
+        """Returns (prompt, info) where info describes the request's prompt size."""
+        examples = self.select_examples(question)
+        lines = ["**EXAMPLES**"]
+        for example_question, example_query in examples:
+            lines.append(f'- User: "{example_question}"')
+            lines.append(f"  -> `{example_query}`")
+        lines.append("")
+        lines.append(f'**USER QUESTION:** "{question}"')
+        suffix = "\n".join(lines) + "\n"
+        prompt = self.static_prefix + "---\n" + suffix
+        info = {
+            "examples": len(examples),
+            "estimated_tokens": estimate_tokens(prompt),
+            "static_prefix_tokens": self.static_prefix_tokens,
+            "dynamic_tokens": estimate_tokens(suffix)
+        }
+        with self._lock:
+            self.requests += 1
+            self.total_estimated_tokens += info["estimated_tokens"]
+        return prompt, info
+
+    def record_usage(self, response, info):
+        """Adds the provider-reported token counts (if the response carries them) to `info`."""
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', None)
+        if not prompt_tokens:
+            return info
+        cached = getattr(usage, 'cached_content_token_count', None) or 0
+        info["prompt_tokens"] = prompt_tokens
+        info["cached_tokens"] = cached
+        with self._lock:
+            self.reported_requests += 1
+            self.total_reported_tokens += prompt_tokens
+            self.cached_tokens += cached
+        return info
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "examples_in_store": len(self.examples),
+                "examples_per_prompt": self.k,
+                "static_prefix_tokens": self.static_prefix_tokens,
+                "avg_estimated_tokens": self.total_estimated_tokens / self.requests if self.requests else 0,
+                "avg_prompt_tokens": self.total_reported_tokens / self.reported_requests if self.reported_requests else None,
+                "cached_tokens": self.cached_tokens
+            }
@@ -0,0 +1,253 @@
+"""
+Cost guardrails for generated queries.
+
+Before a query reaches the collection the governor bounds it: every operation gets a
+maxTimeMS, find() gets a cursor limit (the requested sample size, capped), aggregations get
+a trailing $limit (reported to the user when it truncates), and allowDiskUse follows the
+deployment policy. Optionally the query is explained first; if the estimated docs/keys
+examined exceed the budget it is rejected (default), or downgraded to an answer computed
+from a $sample of the documents matching the query's filter.
+
+Policies are plain dicts (or JSON files) so each deployment can tune them.
+"""
+import copy
+import itertools
+import json
+import threading
+import time
+
+import pymongo
+
+from index_advisor import explain_command, summarize_explain
+from query_parser import ParsedQuery
+
+DEFAULT_POLICY = {
+    # Server-side time limit for every operation (None disables)
+    "max_time_ms": 30000,
+    # Cursor limit for find() when the query has none (and cap for the ones it has)
+    "max_find_documents": 1000,
+    # Trailing $limit for aggregations (None disables)
+    "max_aggregate_results": 1000,
+    # True/False forces allowDiskUse on aggregations; None keeps what the query asked for
+    "allow_disk_use": False,
+    # Explain each query before running it and enforce the budget below
+    "estimate_cost": False,
+    "explain_verbosity": "queryPlanner",
+    "explain_max_time_ms": 2000,
+    "max_docs_examined": 1000000,
+    "max_keys_examined": None,
+    # What to do with queries over budget: 'reject', 'sample' or 'allow'
+    "over_budget": "reject",
+    # Matching documents drawn with $sample for downgraded (approximate) aggregations
+    "sample_documents": 10000,
+}
+OVER_BUDGET_ACTIONS = ('reject', 'sample', 'allow')
+
+
+class QueryRejected(Exception):
+    """Raised for queries whose estimated cost exceeds the budget under the 'reject' policy."""
+
+
+def load_policy(path):
+    """Reads a policy from a JSON file of DEFAULT_POLICY keys."""
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class QueryGovernor:
+    def __init__(self, collection, policy=None):
+        self.collection = collection
+        self.policy = dict(DEFAULT_POLICY)
+        unknown = set(policy or {}) - set(DEFAULT_POLICY)
+        if unknown:
+            raise ValueError(f"Unknown query policy settings: {', '.join(sorted(unknown))}")
+        self.policy.update(policy or {})
+        if self.policy["over_budget"] not in OVER_BUDGET_ACTIONS:
+            raise ValueError(f"over_budget must be one of {OVER_BUDGET_ACTIONS}")
+        self._lock = threading.Lock()
+        self._collection_size = (0.0, None)
+        self.counters = {"governed": 0, "limits_added": 0, "limits_capped": 0, "estimated": 0,
+                         "over_budget": 0, "rejected": 0, "sampled": 0, "explain_errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def time_limit(self):
+        """Keyword arguments adding the policy's maxTimeMS to a pymongo call."""
+        max_time_ms = self.policy["max_time_ms"]
+        return {"maxTimeMS": max_time_ms} if max_time_ms else {}
+
+    def apply_limits(self, parsed, sample_size=None):
+        """Returns a bounded copy of a parsed query (parsed queries are shared, so never modified)."""
+        governed = ParsedQuery(parsed.method, copy.deepcopy(parsed.args), dict(parsed.modifiers))
+        policy = self.policy
+        if policy["max_time_ms"]:
+            governed.modifiers['max_time_ms'] = policy["max_time_ms"]
+
+        if governed.method == 'find':
+            cap = policy["max_find_documents"]
+            limit = governed.modifiers.get('limit')
+            if not limit:
+                governed.modifiers['limit'] = min(sample_size or cap, cap) if cap else sample_size
+                if governed.modifiers['limit']:
+                    self._count("limits_added")
+            elif cap and limit > cap:
+                governed.modifiers['limit'] = cap
+                self._count("limits_capped")
+
+        elif governed.method == 'aggregate':
+            pipeline = governed.args[0]
+            cap = policy["max_aggregate_results"]
+            last = pipeline[-1] if pipeline else {}
+            if cap and not ({'$count', '$out', '$merge'} & set(last)):
+                if '$limit' not in last:
+                    pipeline.append({"$limit": cap})
+                    governed.modifiers['result_cap'] = cap
+                    self._count("limits_added")
+                elif last['$limit'] > cap:
+                    last['$limit'] = cap
+                    governed.modifiers['result_cap'] = cap
+                    self._count("limits_capped")
+            options = dict(governed.arg(1, {}))
+            options.update(self.time_limit())
+            if policy["allow_disk_use"] is not None:
+                options['allowDiskUse'] = policy["allow_disk_use"]
+            governed.args = [pipeline, options]
+        return governed
+
+    def collection_size(self):
+        """estimated_document_count(), cached for a minute."""
+        fetched_at, size = self._collection_size
+        if size is None or time.monotonic() - fetched_at > 60:
+            size = self.collection.estimated_document_count()
+            self._collection_size = (time.monotonic(), size)
+        return size
+
+    def estimate(self, parsed):
+        """
+        Explains the query and returns its estimated docs/keys examined. With 'queryPlanner'
+        verbosity nothing is executed: a COLLSCAN is assumed to read the whole collection and
+        index scans are treated as within budget.
+        """
+        self._count("estimated")
+        verbosity = self.policy["explain_verbosity"]
+        command = explain_command(self.collection, parsed)
+        try:
+            explain = self.collection.database.command('explain', command, verbosity=verbosity,
+                                                       maxTimeMS=self.policy["explain_max_time_ms"])
+        except pymongo.errors.ExecutionTimeout:
+            # Explaining with executionStats runs the query: if that alone times out it is too expensive
+            return {"timed_out": True, "docs_examined": None, "keys_examined": None}
+        except Exception as e:
+            self._count("explain_errors")
+            return {"error": str(e)}
+        summary = summarize_explain(explain)
+        if summary["docs_examined"] is None and summary["collscan"]:
+            summary["docs_examined"] = self.collection_size()
+        return summary
+
+    def over_budget(self, estimate):
+        """Returns why an estimate exceeds the budget, or None."""
+        if estimate.get("timed_out"):
+            return f"explain did not finish within {self.policy['explain_max_time_ms']} ms"
+        for key, limit_key in (("docs_examined", "max_docs_examined"), ("keys_examined", "max_keys_examined")):
+            limit = self.policy[limit_key]
+            if limit is not None and (estimate.get(key) or 0) > limit:
+                return f"estimated {estimate[key]:,} {key.replace('_', ' ')} exceeds the budget of {limit:,}"
+        return None
+
+    def govern(self, parsed, sample_size=None):
+        """
+        Bounds a parsed query and checks it against the budget. Returns (governed_query, verdict)
+        with verdict 'run' or 'sample'; raises QueryRejected under the 'reject' policy.
+        """
+        self._count("governed")
+        governed = self.apply_limits(parsed, sample_size)
+        if not self.policy["estimate_cost"]:
+            return governed, 'run'
+        reason = self.over_budget(self.estimate(governed))
+        if reason is None:
+            return governed, 'run'
+        self._count("over_budget")
+        action = self.policy["over_budget"]
+        if action == 'reject':
+            self._count("rejected")
+            raise QueryRejected(reason)
+        if action == 'sample':
+            self._count("sampled")
+            return governed, 'sample'
+        return governed, 'run'
+
+    @staticmethod
+    def _additive_fields(stages):
+        """Output fields holding totals ($sum/$count) of the single $group or trailing $count stage."""
+        groups = [stage['$group'] for stage in stages if '$group' in stage]
+        fields = set()
+        if len(groups) == 1:
+            fields = {name for name, acc in groups[0].items()
+                      if name != '_id' and isinstance(acc, dict) and {'$sum', '$count'} & set(acc)}
+        if stages and '$count' in stages[-1]:
+            fields.add(stages[-1]['$count'])
+        return fields
+
+    @staticmethod
+    def _scale(doc, fields, scale):
+        for name in fields:
+            value = doc.get(name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                doc[name] = round(value * scale) if isinstance(value, int) else value * scale
+        return doc
+
+    def run_sampled(self, parsed, sample_size=None):
+        """
+        Answers a governed query from a random sample of the documents matching its filter: the
+        filter ($match) runs first, `sample_documents` of the matches are drawn with $sample and
+        the rest of the pipeline runs on them. $sum/$count totals are scaled up by
+        matched/sampled. Counts and find() results need no sample and are exact.
+        """
+        size = self.policy["sample_documents"]
+        options = self.time_limit()
+
+        if parsed.method == 'aggregate':
+            match = list(itertools.takewhile(lambda stage: '$match' in stage, parsed.args[0]))
+            rest = parsed.args[0][len(match):]
+        elif parsed.method == 'distinct':
+            match, rest = [{"$match": parsed.arg(1, {})}], [{"$group": {"_id": f"${parsed.args[0]}"}}]
+        else:
+            match, rest = [{"$match": parsed.arg(0, {})}], None
+
+        if parsed.method == 'find':
+            docs = []
+            if parsed.modifiers.get('sort'):
+                docs.append({"$sort": dict(parsed.modifiers['sort'])})
+            docs.append({"$limit": parsed.modifiers.get('limit') or sample_size or 10})
+            if parsed.arg(1):
+                docs.append({"$project": parsed.arg(1)})
+            facets = {"docs": docs, "matched": [{"$count": "n"}]}
+        elif rest is None:
+            facets = {"matched": [{"$count": "n"}]}
+        else:
+            facets = {"docs": [{"$sample": {"size": size}}] + rest, "matched": [{"$count": "n"}]}
+        facet = next(iter(self.collection.aggregate(match + [{"$facet": facets}], **options)), {})
+        matched = facet["matched"][0]["n"] if facet.get("matched") else 0
+
+        if parsed.method == 'find':
+            results = facet.get("docs", [])
+            return {"type": "find", "results": results, "count": len(results), "total_count": matched}
+        if rest is None:
+            return {"type": "count", "results": matched}
+
+        sampled = {"sampled": min(size, matched), "matched": matched, "approximate": matched > size}
+        if parsed.method == 'distinct':
+            results = [doc["_id"] for doc in facet.get("docs", []) if doc["_id"] is not None]
+            return {"type": "distinct", "field": parsed.args[0], "results": results, "count": len(results), **sampled}
+        results = facet.get("docs", [])
+        if matched > size:
+            fields = self._additive_fields(rest)
+            results = [self._scale(doc, fields, matched / size) for doc in results]
+        return {"type": "aggregate", "results": results, "count": len(results), **sampled}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
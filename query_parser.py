@@ -0,0 +1,337 @@
+"""
+Single-pass parser for the Mongo shell-style query dialect the LLM is asked to emit:
+
+    find({...}[, {...}])[.sort({...})][.skip(n)][.limit(n)]
+    aggregate([...][, {...}])
+    distinct("field"[, {...}])
+    count_documents([{...}])
+
+Values may use ISODate/Date/ObjectId/NumberInt/NumberLong/NumberDecimal, null/true/false
+(or their Python spellings) and extended JSON ({"$date": ...}, {"$oid": ...}, ...).
+The result is a ParsedQuery holding plain Python/BSON values, so nothing is ever eval'd.
+"""
+import ast
+import json
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from bson import Decimal128, ObjectId
+
+QUERY_METHODS = ('find', 'aggregate', 'distinct', 'count_documents')
+CURSOR_MODIFIERS = ('limit', 'skip', 'sort')
+
+# One compiled scanner; leading whitespace is consumed as part of each token.
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    ("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | ([A-Za-z_$][\w$]*)
+  | ([{}\[\](),:.;])
+)""", re.VERBOSE)
+TOKEN_KINDS = (None, 'string', 'number', 'ident', 'punct')
+
+CONSTANTS = {
+    'null': None, 'None': None, 'undefined': None,
+    'true': True, 'True': True, 'false': False, 'False': False
+}
+
+
+class QueryParseError(ValueError):
+    pass
+
+
+class ParsedQuery:
+    """AST of one query: the collection method, its positional arguments and any cursor modifiers."""
+    __slots__ = ('method', 'args', 'modifiers')
+
+    def __init__(self, method, args, modifiers=None):
+        self.method = method
+        self.args = args
+        self.modifiers = modifiers or {}
+
+    def arg(self, index, default=None):
+        return self.args[index] if len(self.args) > index else default
+
+    def __repr__(self):
+        return f"ParsedQuery({self.method!r}, {self.args!r}, {self.modifiers!r})"
+
+
+def _parse_isodate(text):
+    iso_str = text.replace('Z', '+00:00')
+    if 'T' not in iso_str:  # Handle date-only strings
+        iso_str += 'T00:00:00+00:00'
+    try:
+        value = datetime.fromisoformat(iso_str)
+    except ValueError:
+        raise QueryParseError(f"Invalid ISODate value: {text!r}")
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _from_extended_json(obj):
+    """Converts single-key extended JSON wrappers ({"$date": ...}, {"$oid": ...}) to BSON values."""
+    if len(obj) != 1:
+        return obj
+    key, value = next(iter(obj.items()))
+    try:
+        if key == '$date':
+            if isinstance(value, dict) and '$numberLong' in value:
+                value = int(value['$numberLong'])
+            if isinstance(value, (int, float)):
+                return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+            return _parse_isodate(value)
+        if key == '$oid':
+            return ObjectId(value)
+        if key in ('$numberLong', '$numberInt'):
+            return int(value)
+        if key == '$numberDouble':
+            return float(value)
+        if key == '$numberDecimal':
+            return Decimal128(value)
+    except (TypeError, ValueError) as e:
+        raise QueryParseError(f"Invalid extended JSON value {obj!r}: {e}")
+    return obj
+
+
+class _Parser:
+    def __init__(self, text):
+        self.text = text
+        # Set when ISODate()/Date() without arguments (the current time) is parsed
+        self.uses_now = False
+        self.tokens = tokens = []
+        pos = 0
+        for m in TOKEN_PATTERN.finditer(text):
+            if m.start() != pos:
+                break
+            pos = m.end()
+            index = m.lastindex
+            tokens.append((TOKEN_KINDS[index], m.group(index), m.start(index)))
+        rest = text[pos:]
+        if rest.strip():
+            pos += len(rest) - len(rest.lstrip())
+            raise QueryParseError(f"Unexpected character {text[pos]!r} at position {pos}")
+        self.tokens.append(('end', None, len(text)))
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i]
+
+    def next(self):
+        token = self.tokens[self.i]
+        self.i += 1
+        return token
+
+    def error(self, message, token=None):
+        token = token or self.peek()
+        found = 'end of query' if token[0] == 'end' else repr(token[1])
+        return QueryParseError(f"{message} at position {token[2]}, found {found}")
+
+    def expect(self, punct):
+        token = self.next()
+        if token[0] != 'punct' or token[1] != punct:
+            raise self.error(f"Expected {punct!r}", token)
+        return token
+
+    def accept(self, punct):
+        token = self.peek()
+        if token[0] == 'punct' and token[1] == punct:
+            self.i += 1
+            return True
+        return False
+
+    def parse_arguments(self):
+        self.expect('(')
+        args = []
+        if not self.accept(')'):
+            while True:
+                args.append(self.parse_value())
+                if self.accept(')'):
+                    break
+                self.expect(',')
+                if self.accept(')'):  # tolerate a trailing comma
+                    break
+        return args
+
+    def parse_value(self):
+        kind, value, pos = self.next()
+        if kind == 'punct':
+            if value == '{':
+                return self.parse_object()
+            if value == '[':
+                return self.parse_array()
+        elif kind == 'string':
+            return self.decode_string(value)
+        elif kind == 'number':
+            if any(c in value for c in '.eE'):
+                return float(value)
+            return int(value)
+        elif kind == 'ident':
+            if value in CONSTANTS:
+                return CONSTANTS[value]
+            if value == 'new':
+                kind, value, pos = self.next()
+                if kind != 'ident':
+                    raise self.error("Expected constructor after 'new'")
+            return self.parse_constructor(value)
+        self.i -= 1
+        raise self.error("Expected a value")
+
+    def parse_constructor(self, name):
+        args = self.parse_arguments()
+        if name in ('ISODate', 'Date'):
+            if not args:
+                self.uses_now = True
+                return datetime.now(timezone.utc)
+            if len(args) == 1 and isinstance(args[0], str):
+                return _parse_isodate(args[0])
+        elif name == 'ObjectId' and len(args) == 1 and isinstance(args[0], str):
+            try:
+                return ObjectId(args[0])
+            except Exception as e:
+                raise QueryParseError(f"Invalid ObjectId {args[0]!r}: {e}")
+        elif name in ('NumberInt', 'NumberLong') and len(args) == 1:
+            try:
+                return int(args[0])
+            except (TypeError, ValueError):
+                pass
+        elif name == 'NumberDecimal' and len(args) == 1:
+            return Decimal128(str(args[0]))
+        raise QueryParseError(f"Unsupported constructor {name}({', '.join(map(repr, args))})")
+
+    def parse_object(self):
+        obj = {}
+        if self.accept('}'):
+            return obj
+        while True:
+            kind, key, pos = self.next()
+            if kind == 'string':
+                key = self.decode_string(key)
+            elif kind not in ('ident', 'number'):
+                raise self.error("Expected an object key", (kind, key, pos))
+            self.expect(':')
+            obj[key] = self.parse_value()
+            if self.accept('}'):
+                break
+            self.expect(',')
+            if self.accept('}'):
+                break
+        return _from_extended_json(obj)
+
+    def parse_array(self):
+        items = []
+        if self.accept(']'):
+            return items
+        while True:
+            items.append(self.parse_value())
+            if self.accept(']'):
+                break
+            self.expect(',')
+            if self.accept(']'):
+                break
+        return items
+
+    def decode_string(self, token):
+        if '\\' not in token:
+            return token[1:-1]
+        try:
+            if token[0] == '"':
+                return json.loads(token)
+            return ast.literal_eval(token)
+        except (ValueError, SyntaxError) as e:
+            raise QueryParseError(f"Invalid string literal {token}: {e}")
+
+    def parse_query(self):
+        kind, name, pos = self.next()
+        # Tolerate a shell-style "db.milk_collections." prefix
+        if kind == 'ident' and name == 'db' and self.accept('.'):
+            self.next()
+            self.expect('.')
+            kind, name, pos = self.next()
+        if kind != 'ident' or name not in QUERY_METHODS:
+            raise QueryParseError(
+                "Query must start with find(...), aggregate(...), distinct(...), or count_documents(...). "
+                f"Found {name!r} at position {pos}"
+            )
+        args = self.parse_arguments()
+        modifiers = {}
+        while self.accept('.'):
+            kind, modifier, pos = self.next()
+            if name != 'find' or modifier not in CURSOR_MODIFIERS:
+                raise QueryParseError(f"Unsupported method .{modifier}() on {name}(...)")
+            modifier_args = self.parse_arguments()
+            if modifier == 'sort':
+                modifiers['sort'] = _sort_spec(modifier_args)
+            else:
+                if len(modifier_args) != 1 or not isinstance(modifier_args[0], int) or modifier_args[0] < 0:
+                    raise QueryParseError(f".{modifier}() expects a single non-negative integer")
+                modifiers[modifier] = modifier_args[0]
+        self.accept(';')
+        if self.peek()[0] != 'end':
+            raise self.error("Unexpected trailing input")
+        _check_arguments(name, args)
+        return ParsedQuery(name, args, modifiers)
+
+
+def _sort_spec(args):
+    if len(args) == 1 and isinstance(args[0], dict):
+        return list(args[0].items())
+    if len(args) == 2 and isinstance(args[0], str):
+        return [(args[0], args[1])]
+    raise QueryParseError(".sort() expects a {field: direction} document")
+
+
+def _check_arguments(method, args):
+    if method in ('find', 'count_documents'):
+        if len(args) > (2 if method == 'find' else 1):
+            raise QueryParseError(f"Too many arguments for {method}(...)")
+        for arg in args:
+            if not isinstance(arg, dict):
+                raise QueryParseError(f"{method}(...) arguments must be documents, got {type(arg).__name__}")
+    elif method == 'aggregate':
+        if not args or not isinstance(args[0], list):
+            raise QueryParseError(f"Aggregation pipeline must be a list, but got {type(args[0]).__name__ if args else 'nothing'}")
+        if any(not isinstance(stage, dict) for stage in args[0]):
+            raise QueryParseError("Every aggregation stage must be a document")
+        if len(args) > 2 or (len(args) == 2 and not isinstance(args[1], dict)):
+            raise QueryParseError("aggregate(...) accepts a pipeline and an optional options document")
+    elif method == 'distinct':
+        if not args or not isinstance(args[0], str):
+            raise QueryParseError('distinct(...) must start with a field name, e.g. distinct("memberCode", {...})')
+        if len(args) > 1 and not isinstance(args[1], dict):
+            raise QueryParseError("distinct(...) filter must be a document")
+
+
+@lru_cache(maxsize=1024)
+def _parse_cached(query_text):
+    parser = _Parser(query_text)
+    return parser.parse_query(), parser.uses_now
+
+
+def parse_query(query_text):
+    """
+    Parses a full query string into a ParsedQuery. Results are cached by text, so the
+    returned object is shared: callers must copy arguments before modifying them. Queries
+    using ISODate()/Date() for "now" are parsed again on every call so the time is current.
+    """
+    query_text = query_text.strip()
+    parsed, uses_now = _parse_cached(query_text)
+    if uses_now:
+        return _Parser(query_text).parse_query()
+    return parsed
+
+
+parse_query.cache_clear = _parse_cached.cache_clear
+parse_query.cache_info = _parse_cached.cache_info
+
+
+def parse_value(text):
+    """Parses a single value (a filter document, pipeline, ...). An empty string is an empty filter."""
+    text = text.strip()
+    if not text:
+        return {}
+    parser = _Parser(text)
+    value = parser.parse_value()
+    if parser.peek()[0] != 'end':
+        raise parser.error("Unexpected trailing input")
+    return value
@@ -0,0 +1,36 @@
+"""
+Token-bucket rate limiter for asyncio code, used to keep concurrent LLM calls under the
+provider's requests-per-second quota.
+"""
+import asyncio
+import time
+
+
+class AsyncRateLimiter:
+    def __init__(self, rate, burst=None):
+        """Allows `rate` acquisitions per second on average, with bursts of up to `burst`."""
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
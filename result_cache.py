@@ -0,0 +1,259 @@
+"""
+Cache of executed query results keyed on the normalized parsed query.
+
+Entries are evicted LRU once the cache holds more than `max_bytes` (BSON-encoded size) or
+`max_entries`, and expire after a per-query-type TTL. Optional invalidation keeps answers
+fresh when data changes:
+
+- 'change_stream': a background thread watches the collection; an insert only invalidates
+  entries whose date range contains the new document, updates/deletes invalidate everything.
+  Requires a replica set; falls back to 'watermark' when change streams are unavailable.
+- 'watermark': at most every `watermark_interval` seconds the newest dateTimeOfCollection
+  and the estimated document count are checked. A newer watermark invalidates entries
+  whose range is open past the old one; any other count change invalidates everything.
+  Updates that change neither are only picked up when the entry's TTL expires.
+
+Approximate answers (from the governor's $sample downgrade) are never cached.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import timezone
+
+import bson
+from bson import json_util
+
+DATE_FIELD = 'dateTimeOfCollection'
+DEFAULT_TTLS = {"find": 60, "count": 300, "aggregate": 300, "distinct": 600}
+
+
+def _normalize_filter(filter_query):
+    """Filter key order is irrelevant for top-level fields and operator documents, so sort them."""
+    if not isinstance(filter_query, dict):
+        return filter_query
+    normalized = {}
+    for key in sorted(filter_query):
+        value = filter_query[key]
+        if isinstance(value, dict) and value and all(k.startswith('$') for k in value):
+            value = {k: _normalize_filter(v) if k in ('$and', '$or', '$nor', '$not', '$elemMatch') else v for k, v in sorted(value.items())}
+        elif key in ('$and', '$or', '$nor') and isinstance(value, list):
+            value = [_normalize_filter(v) for v in value]
+        normalized[key] = value
+    return normalized
+
+
+def query_key(parsed, sample_size=None):
+    """Canonical text of a parsed query; formatting, quoting and filter key order don't matter."""
+    args = list(parsed.args)
+    if parsed.method in ('find', 'count_documents') and args:
+        args[0] = _normalize_filter(args[0])
+    elif parsed.method == 'distinct' and len(args) > 1:
+        args[1] = _normalize_filter(args[1])
+    elif parsed.method == 'aggregate':
+        args[0] = [{'$match': _normalize_filter(stage['$match'])} if '$match' in stage and len(stage) == 1 else stage for stage in args[0]]
+    key = [parsed.method, args, sorted(parsed.modifiers.items())]
+    if parsed.method == 'find':
+        key.append(sample_size)
+    return json_util.dumps(key)
+
+
+def _naive_utc(value):
+    if value is not None and getattr(value, 'tzinfo', None) is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def date_range(parsed):
+    """
+    The dateTimeOfCollection range a query is restricted to as (start, end, end_inclusive):
+    [start, end) for $lt and [start, end] for $lte. None bounds are unbounded.
+    """
+    if parsed.method == 'aggregate':
+        pipeline = parsed.args[0]
+        filter_query = pipeline[0].get('$match', {}) if pipeline else {}
+    elif parsed.method == 'distinct':
+        filter_query = parsed.arg(1, {})
+    else:
+        filter_query = parsed.arg(0, {})
+    condition = filter_query.get(DATE_FIELD) if isinstance(filter_query, dict) else None
+    if not isinstance(condition, dict):
+        return None, None, False
+    start = condition.get('$gte', condition.get('$gt'))
+    end_inclusive = '$lt' not in condition
+    end = condition['$lt'] if not end_inclusive else condition.get('$lte')
+    if not hasattr(end, 'year'):
+        end, end_inclusive = None, False
+    return _naive_utc(start) if hasattr(start, 'year') else None, _naive_utc(end), end_inclusive
+
+
+def _result_size(result):
+    try:
+        return len(bson.encode({"result": result}))
+    except Exception:
+        return len(repr(result))
+
+
+class QueryResultCache:
+    def __init__(self, collection, max_bytes=64 * 1024 * 1024, max_entries=10000, ttls=None,
+                 invalidation=None, watermark_interval=5):
+        self.collection = collection
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.watermark_interval = watermark_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._watermark = None
+        self._doc_count = None
+        self._last_check = 0.0
+        self._watch_thread = None
+        self._stop = threading.Event()
+        self.invalidation = invalidation
+        if invalidation == 'change_stream':
+            self.start_change_stream()
+        elif invalidation not in (None, 'watermark'):
+            raise ValueError(f"Unknown invalidation mode: {invalidation!r}")
+
+    # --- lookups -----------------------------------------------------------------------
+
+    def get(self, parsed, sample_size=None):
+        if self.invalidation == 'watermark':
+            self.check_watermark()
+        key = query_key(parsed, sample_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            entry["hits"] += 1
+            return entry["result"]
+
+    def put(self, parsed, result, sample_size=None):
+        # Approximate ($sample-downgraded) answers must not be served for the exact query later
+        if "error" in result or result.get("approximate"):
+            return
+        ttl = self.ttls.get(result.get("type"), self.ttls.get(parsed.method, 60))
+        if not ttl:
+            return
+        size = _result_size(result)
+        if size > self.max_bytes:
+            return
+        start, end, end_inclusive = date_range(parsed)
+        key = query_key(parsed, sample_size)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "result": result, "size": size, "expires": time.monotonic() + ttl,
+                "start": start, "end": end, "end_inclusive": end_inclusive, "type": result.get("type"), "hits": 0
+            }
+            self.bytes += size
+            while self._entries and (self.bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry["size"]
+
+    # --- invalidation ------------------------------------------------------------------
+
+    def invalidate(self, predicate=None):
+        """Drops every entry (or those matching `predicate(entry)`). Returns the number dropped."""
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if predicate is None or predicate(e)]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def invalidate_date(self, value):
+        """Drops entries whose date range could include a document dated `value`."""
+        value = _naive_utc(value)
+        return self.invalidate(lambda e: (e["start"] is None or e["start"] <= value)
+                               and (e["end"] is None or value < e["end"] or (e["end_inclusive"] and value == e["end"])))
+
+    def check_watermark(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_check < self.watermark_interval:
+            return
+        self._last_check = now
+        latest = self.collection.find_one({}, {DATE_FIELD: 1}, sort=[(DATE_FIELD, -1)])
+        watermark = _naive_utc(latest.get(DATE_FIELD)) if latest else None
+        doc_count = self.collection.estimated_document_count()
+        previous_watermark, previous_count = self._watermark, self._doc_count
+        self._watermark, self._doc_count = watermark, doc_count
+        if previous_count is None or (watermark == previous_watermark and doc_count == previous_count):
+            return
+        if previous_watermark is not None and watermark is not None and watermark > previous_watermark:
+            # New documents are dated after the old watermark
+            self.invalidate(lambda e: e["end"] is None or e["end"] > previous_watermark)
+        else:
+            self.invalidate()
+
+    def start_change_stream(self):
+        try:
+            stream = self.collection.watch(full_document='updateLookup')
+        except Exception as e:
+            print(f" Change streams unavailable ({e}); falling back to watermark invalidation.")
+            self.invalidation = 'watermark'
+            return
+
+        def loop():
+            with stream:
+                while not self._stop.is_set():
+                    try:
+                        change = stream.try_next()
+                    except Exception as e:
+                        print(f" Change stream stopped ({e}); falling back to watermark invalidation.")
+                        self.invalidate()
+                        self.invalidation = 'watermark'
+                        return
+                    if change is None:
+                        self._stop.wait(0.1)
+                        continue
+                    document = change.get('fullDocument') or {}
+                    if change.get('operationType') == 'insert' and DATE_FIELD in document:
+                        self.invalidate_date(document[DATE_FIELD])
+                    else:
+                        self.invalidate()
+
+        self._watch_thread = threading.Thread(target=loop, name="result-cache-watch", daemon=True)
+        self._watch_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            by_type = {}
+            for entry in self._entries.values():
+                t = by_type.setdefault(entry["type"], {"entries": 0, "bytes": 0})
+                t["entries"] += 1
+                t["bytes"] += entry["size"]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "invalidation_mode": self.invalidation,
+                "by_type": by_type
+            }
@@ -0,0 +1,332 @@
+"""
+Pre-aggregated rollups of milk_collections with transparent query rewriting.
+
+Daily and monthly summaries per member and per DCS (count plus sum/min/max and a numeric
+count of qty, fat, snf and amount) are maintained by incremental $merge jobs. Eligible
+count_documents(...) and $group aggregations are rewritten to read the rollups instead of
+rescanning raw documents; $sum/$min/$max/count are carried over directly and $avg is
+recomputed from sum and numeric count, so answers match the raw query.
+
+The raw collection is assumed to be append-only with increasing dateTimeOfCollection:
+only days from the last refresh watermark onwards are recomputed. Use refresh(full=True)
+after backfills, updates or deletes.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+DATE_FIELD = 'dateTimeOfCollection'
+ENTITY_FIELDS = ('memberCode', 'dcsCode')
+METRICS = ('qty', 'fat', 'snf', 'amount')
+GRAINS = ('monthly', 'daily')
+DATE_PART_OPERATORS = {'monthly': {'$year', '$month'}, 'daily': {'$year', '$month', '$dayOfMonth', '$dayOfWeek', '$dayOfYear'}}
+POST_GROUP_STAGES = {'$sort', '$limit', '$skip', '$project', '$addFields', '$set', '$match'}
+
+
+def _naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _day_start(value):
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _month_start(value):
+    return _day_start(value).replace(day=1)
+
+
+def _is_aligned(value, grain):
+    if value is None:
+        return True
+    if grain == 'monthly':
+        return value == _month_start(value)
+    return value == _day_start(value)
+
+
+def _period_expression(source, grain):
+    parts = {"year": {"$year": source}, "month": {"$month": source}}
+    if grain == 'daily':
+        parts["day"] = {"$dayOfMonth": source}
+    return {"$dateFromParts": parts}
+
+
+class RollupManager:
+    def __init__(self, db, source_collection='milk_collections', max_staleness=0):
+        """
+        Queries without an upper date bound are answered from rollups only if nothing was
+        collected after the watermark. A positive `max_staleness` (seconds) opts in to also
+        serving them while the last refresh is at most that old, missing collections since.
+        """
+        self.db = db
+        self.source = db[source_collection]
+        self.source_name = source_collection
+        self.max_staleness = max_staleness
+        self.state_collection = db['rollup_state']
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._stop = threading.Event()
+        self.rewrites = 0
+        self.skipped = 0
+        self._state = self.state_collection.find_one({"_id": self.source_name})
+
+    def collection_name(self, grain, entity):
+        return f"{self.source_name}_{grain}_{'member' if entity == 'memberCode' else 'dcs'}"
+
+    # --- maintenance -------------------------------------------------------------------
+
+    def _daily_pipeline(self, entity, since):
+        group = {"_id": {entity: f"${entity}", "period": _period_expression(f"${DATE_FIELD}", 'daily')}, "count": {"$sum": 1}}
+        for metric in METRICS:
+            group[f"{metric}_sum"] = {"$sum": f"${metric}"}
+            group[f"{metric}_min"] = {"$min": f"${metric}"}
+            group[f"{metric}_max"] = {"$max": f"${metric}"}
+            group[f"{metric}_count"] = {"$sum": {"$cond": [{"$isNumber": f"${metric}"}, 1, 0]}}
+        pipeline = [{"$match": {DATE_FIELD: {"$gte": since}}}] if since else []
+        return pipeline + [
+            {"$group": group},
+            {"$addFields": {entity: f"$_id.{entity}", "period": "$_id.period"}},
+            {"$merge": {"into": self.collection_name('daily', entity), "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ]
+
+    def _monthly_pipeline(self, entity, since):
+        group = {"_id": {entity: f"${entity}", "period": _period_expression("$period", 'monthly')}, "count": {"$sum": "$count"}}
+        for metric in METRICS:
+            group[f"{metric}_sum"] = {"$sum": f"${metric}_sum"}
+            group[f"{metric}_min"] = {"$min": f"${metric}_min"}
+            group[f"{metric}_max"] = {"$max": f"${metric}_max"}
+            group[f"{metric}_count"] = {"$sum": f"${metric}_count"}
+        pipeline = [{"$match": {"period": {"$gte": _month_start(since)}}}] if since else []
+        return pipeline + [
+            {"$group": group},
+            {"$addFields": {entity: f"$_id.{entity}", "period": "$_id.period"}},
+            {"$merge": {"into": self.collection_name('monthly', entity), "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ]
+
+    def ensure_indexes(self):
+        for grain in GRAINS:
+            for entity in ENTITY_FIELDS:
+                rollup = self.db[self.collection_name(grain, entity)]
+                rollup.create_index([(entity, 1), ("period", 1)])
+                rollup.create_index([("period", 1)])
+
+    def refresh(self, full=False):
+        """
+        Recomputes rollups from the day of the previous watermark onwards (everything on
+        `full`). Whole days are recomputed and replaced, so the job is idempotent.
+        """
+        started = time.perf_counter()
+        with self._lock:
+            state = self.state_collection.find_one({"_id": self.source_name})
+            since = None if full or not state else _day_start(_naive_utc(state["watermark"]))
+            latest = self.source.find_one({}, {DATE_FIELD: 1}, sort=[(DATE_FIELD, -1)])
+            if latest is None:
+                return None
+            self.ensure_indexes()
+            for entity in ENTITY_FIELDS:
+                self.source.aggregate(self._daily_pipeline(entity, since), allowDiskUse=True)
+                self.db[self.collection_name('daily', entity)].aggregate(self._monthly_pipeline(entity, since), allowDiskUse=True)
+            self._state = {"_id": self.source_name, "watermark": _naive_utc(latest[DATE_FIELD]), "refreshed_at": time.time()}
+            self.state_collection.replace_one({"_id": self.source_name}, self._state, upsert=True)
+        print(f"📦 Rollups refreshed {'fully' if since is None else 'from ' + since.date().isoformat()} in {time.perf_counter() - started:.2f}s")
+        return self._state
+
+    def start_background_refresh(self, interval_seconds=900):
+        """Runs refresh() now and then every `interval_seconds` on a daemon thread."""
+        def loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f" Rollup refresh failed: {e}")
+                if self._stop.wait(interval_seconds):
+                    break
+        if self._refresh_thread is None:
+            self._refresh_thread = threading.Thread(target=loop, name="rollup-refresh", daemon=True)
+            self._refresh_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # --- rewriting ---------------------------------------------------------------------
+
+    def _covers(self, end):
+        """Whether everything before `end` (None = unbounded) is already in the rollups."""
+        if not self._state:
+            return False
+        if end is None:
+            if self.max_staleness and time.time() - self._state["refreshed_at"] <= self.max_staleness:
+                return True
+            newer = self.source.find_one({DATE_FIELD: {"$gt": self._state["watermark"]}}, {"_id": 1})
+            return newer is None
+        # Later inserts land on or after the watermark's day, so earlier days are complete
+        return end <= _day_start(_naive_utc(self._state["watermark"]))
+
+    def _split_filter(self, filter_query):
+        """Returns (entity, entity_filter, start, end) or None if the filter can't be served by a rollup."""
+        entity, entity_filter, start, end = None, {}, None, None
+        for field, value in filter_query.items():
+            if field in ENTITY_FIELDS:
+                if entity is not None:
+                    return None
+                if isinstance(value, dict) and not set(value) <= {'$in', '$eq'}:
+                    return None
+                entity, entity_filter = field, {field: value}
+            elif field == DATE_FIELD:
+                if not isinstance(value, dict) or not value or not set(value) <= {'$gte', '$lt'}:
+                    return None
+                if not all(isinstance(v, datetime) for v in value.values()):
+                    return None
+                start, end = _naive_utc(value.get('$gte')), _naive_utc(value.get('$lt'))
+            else:
+                return None
+        return entity, entity_filter, start, end
+
+    def _pick_grain(self, start, end, needed_parts=()):
+        for grain in GRAINS:
+            if _is_aligned(start, grain) and _is_aligned(end, grain) and set(needed_parts) <= DATE_PART_OPERATORS[grain]:
+                return grain
+        return None
+
+    def _rollup_match(self, entity_filter, start, end):
+        match = dict(entity_filter)
+        period = {}
+        if start is not None:
+            period["$gte"] = start
+        if end is not None:
+            period["$lt"] = end
+        if period:
+            match["period"] = period
+        return match
+
+    def _translate_group_id(self, expression, entities, date_parts):
+        """Maps a raw $group _id onto rollup fields, collecting the entity and date parts it uses."""
+        if expression is None or isinstance(expression, (int, float, bool)):
+            return expression
+        if isinstance(expression, str):
+            if expression.lstrip('$') in ENTITY_FIELDS and expression.startswith('$'):
+                entities.add(expression[1:])
+                return expression
+            if not expression.startswith('$'):
+                return expression
+            raise LookupError(expression)
+        if isinstance(expression, dict):
+            if len(expression) == 1:
+                op, arg = next(iter(expression.items()))
+                if op.startswith('$'):
+                    if arg != f"${DATE_FIELD}":
+                        raise LookupError(op)
+                    date_parts.add(op)
+                    return {op: "$period"}
+            return {k: self._translate_group_id(v, entities, date_parts) for k, v in expression.items()}
+        raise LookupError(expression)
+
+    def rewrite_aggregate(self, pipeline):
+        """Returns (rollup_collection_name, pipeline) for an eligible aggregation, else None."""
+        try:
+            rewritten = self._rewrite_aggregate(pipeline)
+        except LookupError:
+            rewritten = None
+        with self._lock:
+            if rewritten is None:
+                self.skipped += 1
+            else:
+                self.rewrites += 1
+        return rewritten
+
+    def _rewrite_aggregate(self, pipeline):
+        stages = list(pipeline)
+        match = {}
+        if stages and '$match' in stages[0]:
+            match = stages.pop(0)['$match']
+        if not stages or '$group' not in stages[0] or len(stages[0]) != 1:
+            return None
+        group = stages[0]['$group']
+        rest = stages[1:]
+        if any(len(stage) != 1 or next(iter(stage)) not in POST_GROUP_STAGES for stage in rest):
+            return None
+        split = self._split_filter(match)
+        if split is None:
+            return None
+        entity, entity_filter, start, end = split
+        if not self._covers(end):
+            return None
+
+        entities, date_parts = set(), set()
+        group_id = self._translate_group_id(group.get('_id'), entities, date_parts)
+        if entity:
+            entities.add(entity)
+        if len(entities) > 1:
+            return None
+        entity = next(iter(entities), 'dcsCode')
+        grain = self._pick_grain(start, end, date_parts)
+        if grain is None:
+            return None
+
+        rollup_group = {"_id": group_id}
+        averages = {}
+        for name, accumulator in group.items():
+            if name == '_id':
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                return None
+            op, arg = next(iter(accumulator.items()))
+            metric = arg[1:] if isinstance(arg, str) and arg.startswith('$') else None
+            if op == '$count' and arg == {}:
+                rollup_group[name] = {"$sum": "$count"}
+            elif op == '$sum' and isinstance(arg, (int, float)) and not isinstance(arg, bool):
+                rollup_group[name] = {"$sum": "$count" if arg == 1 else {"$multiply": ["$count", arg]}}
+            elif metric not in METRICS:
+                return None
+            elif op in ('$sum', '$min', '$max'):
+                rollup_group[name] = {op: f"${metric}_{op[1:]}"}
+            elif op == '$avg':
+                averages[name] = (f"__{name}_sum", f"__{name}_count")
+                rollup_group[f"__{name}_sum"] = {"$sum": f"${metric}_sum"}
+                rollup_group[f"__{name}_count"] = {"$sum": f"${metric}_count"}
+            else:
+                return None
+
+        new_pipeline = []
+        rollup_match = self._rollup_match(entity_filter, start, end)
+        if rollup_match:
+            new_pipeline.append({"$match": rollup_match})
+        new_pipeline.append({"$group": rollup_group})
+        if averages:
+            new_pipeline.append({"$addFields": {
+                name: {"$cond": [{"$gt": [f"${count}", 0]}, {"$divide": [f"${total}", f"${count}"]}, None]}
+                for name, (total, count) in averages.items()
+            }})
+            new_pipeline.append({"$project": {field: 0 for pair in averages.values() for field in pair}})
+        return self.collection_name(grain, entity), new_pipeline + rest
+
+    def rewrite_count(self, filter_query):
+        """Returns (rollup_collection_name, pipeline) computing count_documents(filter), else None."""
+        split = self._split_filter(filter_query)
+        rewritten = None
+        if split is not None:
+            entity, entity_filter, start, end = split
+            grain = self._pick_grain(start, end)
+            if grain is not None and self._covers(end):
+                pipeline = []
+                rollup_match = self._rollup_match(entity_filter, start, end)
+                if rollup_match:
+                    pipeline.append({"$match": rollup_match})
+                pipeline.append({"$group": {"_id": None, "count": {"$sum": "$count"}}})
+                rewritten = self.collection_name(grain, entity or 'dcsCode'), pipeline
+        with self._lock:
+            if rewritten is None:
+                self.skipped += 1
+            else:
+                self.rewrites += 1
+        return rewritten
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rewrites": self.rewrites,
+                "skipped": self.skipped,
+                "watermark": self._state["watermark"].isoformat() if self._state else None,
+                "refreshed_at": self._state["refreshed_at"] if self._state else None
+            }
@@ -0,0 +1,445 @@
+"""
+Sampled schema profiling of milk_collections.
+
+A $sample of the collection is profiled per top-level field: presence, type distribution,
+distinct values in the sample, string lengths and min/max. Numeric and date ranges are then
+made exact with one $group pass (run in the background), so they can be used to reject
+filters no document can match, e.g. fat > 50 or dates before the first collection. The
+profile is a snapshot: the upper bound of dateTimeOfCollection is never enforced (new
+collections extend it), and a rejection is confirmed with a find_one() when an index can
+answer it; on unindexed fields the profile is trusted rather than scanning the collection.
+
+Only the stable part of the profile (types, optional fields, small value sets) goes into the
+prompt, which is cached as a byte-identical prefix; ranges, string lengths, presence rates and
+the newest date change with every sample and insert, so they stay out of it.
+
+The profile is persisted to a JSON cache file (DEFAULT_SCHEMA_CACHE_PATH by default) with a
+format version, the collection name, the document count and a timestamp. A fresh cache lets
+startup skip the probe entirely; a stale one is still used while a background refresh samples
+only documents newer than the stored watermark.
+"""
+import copy
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from bson import json_util
+
+SCHEMA_CACHE_VERSION = 1
+DEFAULT_SCHEMA_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lactalis_bot', 'schema_profile.json')
+DATE_FIELD = 'dateTimeOfCollection'
+NUMBER_TYPES = {'int', 'float', 'Int64', 'Decimal128'}
+# Fields whose maximum grows with every insert: their profiled upper bound is never enforced
+GROWING_FIELDS = {DATE_FIELD}
+# Cached datetimes are read back naive (UTC), like documents from pymongo
+JSON_OPTIONS = json_util.JSONOptions(json_mode=json_util.JSONMode.RELAXED, tz_aware=False)
+
+
+def _naive_utc(value):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _kind(value):
+    """Comparable kind of a value: 'number', 'string', 'date' or None for anything else."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, datetime):
+        return 'date'
+    return None
+
+
+def _type_kind(type_name):
+    if type_name in NUMBER_TYPES:
+        return 'number'
+    return {'str': 'string', 'datetime': 'date'}.get(type_name)
+
+
+def _format_bound(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value)
+
+
+class SchemaProfiler:
+    def __init__(self, collection, sample_size=1000, cache_path=None, max_age=24 * 3600, max_values=20):
+        """
+        `max_age` (seconds) is how long a profile counts as fresh; stale profiles are still
+        served but refreshed. Fields with at most `max_values` distinct sampled values keep
+        them (e.g. codes of a small union) for the prompt.
+        """
+        self.collection = collection
+        self.sample_size = sample_size
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.max_values = max_values
+        self.namespace = f"{collection.database.name}.{collection.name}"
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._stop = threading.Event()
+        self.profile = None
+        self.loaded_from_cache = False
+        self.rejected_filters = 0
+        self.stale_rejections = 0
+        self._refreshing = threading.Event()
+
+    # --- profiling -------------------------------------------------------------------------
+
+    def _empty_profile(self):
+        return {"version": SCHEMA_CACHE_VERSION, "namespace": self.namespace, "profiled_at": None,
+                "sampled": 0, "doc_count": 0, "watermark": None, "exact_ranges_at": None, "fields": {}}
+
+    def _add_documents(self, profile, docs):
+        fields = profile["fields"]
+        for doc in docs:
+            profile["sampled"] += 1
+            for name, value in doc.items():
+                if name == '_id':
+                    continue
+                field = fields.setdefault(name, {"present": 0, "types": {}, "values": [], "distinct": 0,
+                                                 "min": None, "max": None, "exact_range": False})
+                field["present"] += 1
+                type_name = type(value).__name__
+                field["types"][type_name] = field["types"].get(type_name, 0) + 1
+                kind = _kind(value)
+                if kind == 'string':
+                    field["min_length"] = min(field.get("min_length", len(value)), len(value))
+                    field["max_length"] = max(field.get("max_length", len(value)), len(value))
+                if kind in ('number', 'date') and not field["exact_range"]:
+                    value = _naive_utc(value)
+                    if field["min"] is None or (_kind(field["min"]) == kind and value < field["min"]):
+                        field["min"] = value
+                    if field["max"] is None or (_kind(field["max"]) == kind and value > field["max"]):
+                        field["max"] = value
+                # Distinct values are tracked up to max_values; beyond that only "more than" is known
+                if field["distinct"] <= self.max_values and isinstance(value, (str, int, float)) and value not in field["values"]:
+                    field["distinct"] += 1
+                    if field["distinct"] <= self.max_values:
+                        field["values"].append(value)
+                    else:
+                        field["values"] = []
+            if isinstance(doc.get(DATE_FIELD), datetime):
+                moment = _naive_utc(doc[DATE_FIELD])
+                if profile["watermark"] is None or moment > profile["watermark"]:
+                    profile["watermark"] = moment
+
+    def _sample(self, since=None):
+        pipeline = [{"$match": {DATE_FIELD: {"$gt": since}}}] if since is not None else []
+        pipeline.append({"$sample": {"size": self.sample_size}})
+        return list(self.collection.aggregate(pipeline))
+
+    def _exact_ranges(self, profile, since=None):
+        """Replaces sampled min/max of numeric and date fields with exact values from a $group pass."""
+        ranged = [name for name, field in profile["fields"].items()
+                  if {_type_kind(t) for t in field["types"]} & {'number', 'date'}]
+        if not ranged:
+            return
+        group = {"_id": None}
+        for i, name in enumerate(ranged):
+            group[f"min{i}"] = {"$min": f"${name}"}
+            group[f"max{i}"] = {"$max": f"${name}"}
+        pipeline = [{"$match": {DATE_FIELD: {"$gt": since}}}] if since is not None else []
+        pipeline.append({"$group": group})
+        totals = list(self.collection.aggregate(pipeline, allowDiskUse=True))
+        if not totals:
+            return
+        for i, name in enumerate(ranged):
+            field = profile["fields"][name]
+            low, high = _naive_utc(totals[0][f"min{i}"]), _naive_utc(totals[0][f"max{i}"])
+            if since is not None:
+                if not field["exact_range"]:
+                    # New documents alone cannot make the range of older ones exact
+                    continue
+                # Incremental: widen the exact range with the new documents' range
+                low = min((v for v in (low, field["min"]) if v is not None), default=None)
+                high = max((v for v in (high, field["max"]) if v is not None), default=None)
+            field["min"], field["max"], field["exact_range"] = low, high, True
+        profile["exact_ranges_at"] = time.time()
+
+    def refresh(self, full=False, exact_ranges=True):
+        """
+        Profiles the collection: a full $sample, or (incrementally) only documents newer than
+        the profile's watermark, merged into the existing statistics. Persists the result.
+        """
+        started = time.perf_counter()
+        with self._lock:
+            current = self.profile
+        incremental = not full and current is not None and current.get("watermark") is not None
+        if incremental:
+            profile = copy.deepcopy(current)
+            since = profile["watermark"]
+        else:
+            profile = self._empty_profile()
+            since = None
+        self._add_documents(profile, self._sample(since))
+        if exact_ranges:
+            self._exact_ranges(profile, since)
+        profile["doc_count"] = self.collection.estimated_document_count()
+        profile["profiled_at"] = time.time()
+        with self._lock:
+            self.profile = profile
+        self.save()
+        print(f"🔎 Schema profiled {'incrementally' if incremental else 'from a full sample'} in {time.perf_counter() - started:.2f}s")
+        return profile
+
+    # --- persistence -----------------------------------------------------------------------
+
+    def load(self):
+        """Loads the cached profile if its version and collection match. Returns True if loaded."""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                profile = json_util.loads(f.read(), json_options=JSON_OPTIONS)
+        except (OSError, ValueError) as e:
+            print(f" Ignoring unreadable schema cache {self.cache_path}: {e}")
+            return False
+        if profile.get("version") != SCHEMA_CACHE_VERSION or profile.get("namespace") != self.namespace:
+            return False
+        # Fewer documents than profiled: deletes, or a different deployment with the same namespace
+        if self.collection.estimated_document_count() < profile.get("doc_count", 0):
+            return False
+        with self._lock:
+            self.profile = profile
+        self.loaded_from_cache = True
+        return True
+
+    def save(self):
+        if not self.cache_path:
+            return
+        with self._lock:
+            text = json_util.dumps(self.profile, json_options=JSON_OPTIONS)
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, self.cache_path)
+
+    def is_stale(self):
+        with self._lock:
+            profile = self.profile
+        return profile is None or time.time() - profile["profiled_at"] > self.max_age
+
+    def ensure_profile(self, background_exact_ranges=True):
+        """
+        Startup entry point: uses a cached profile when there is one (refreshing it in the
+        background if stale), otherwise samples now and computes exact ranges in the background.
+        """
+        if self.load():
+            if self.is_stale():
+                self._run_in_background(self.refresh)
+            return self.profile
+        self.refresh(full=True, exact_ranges=not background_exact_ranges)
+        if background_exact_ranges:
+            self._run_in_background(self._complete_ranges)
+        return self.profile
+
+    def _complete_ranges(self):
+        with self._lock:
+            profile = copy.deepcopy(self.profile)
+        self._exact_ranges(profile)
+        with self._lock:
+            self.profile = profile
+        self.save()
+
+    def _run_in_background(self, fn):
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                print(f" Schema refresh failed: {e}")
+        threading.Thread(target=run, name="schema-refresh", daemon=True).start()
+
+    def start_background_refresh(self, interval_seconds=3600):
+        """Runs an incremental refresh() every `interval_seconds` on a daemon thread."""
+        def loop():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f" Schema refresh failed: {e}")
+        if self._refresh_thread is None:
+            self._refresh_thread = threading.Thread(target=loop, name="schema-refresh-loop", daemon=True)
+            self._refresh_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # --- consumers -------------------------------------------------------------------------
+
+    def prompt_schema(self):
+        """
+        Field -> description for the prompt, e.g. {"dcsCode": 'str (one of "0010", "0011")',
+        "plantCode": "str (optional)"}. Variably typed fields list every type. Only details that
+        stay the same from one sample to the next are included, so the prompt prefix is stable.
+        """
+        with self._lock:
+            profile = self.profile
+        if not profile or not profile["sampled"]:
+            return {}
+        schema = {}
+        for name, field in profile["fields"].items():
+            description = "|".join(sorted(field["types"]))
+            details = []
+            if field["present"] / profile["sampled"] < 0.995:
+                details.append("optional")
+            if field["values"] and field["distinct"] <= self.max_values and len(field["values"]) <= 5:
+                values = sorted(field["values"], key=lambda v: (_kind(v) or '', v))
+                details.append("one of " + ", ".join(json.dumps(v) for v in values))
+            schema[name] = description + (f" ({', '.join(details)})" if details else "")
+        return schema
+
+    @staticmethod
+    def _range_reason(name, low, high):
+        if high is None:
+            return f"'{name}' starts at {_format_bound(low)}"
+        return f"'{name}' only ranges from {_format_bound(low)} to {_format_bound(high)}"
+
+    def _field_conflict(self, name, condition, field):
+        """Reason why `condition` on a profiled field can never match, or None."""
+        kinds = {_type_kind(t) for t in field["types"]}
+        if len(kinds) != 1 or None in kinds:
+            return None
+        kind = next(iter(kinds))
+        operators = condition if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition) else {'$eq': condition}
+
+        equals = []
+        if '$eq' in operators:
+            equals = [operators['$eq']]
+        elif '$in' in operators and isinstance(operators['$in'], list) and operators['$in']:
+            equals = operators['$in']
+        typed = [v for v in equals if _kind(v) is not None]
+        if equals and len(typed) == len(equals) and all(_kind(v) != kind for v in typed):
+            stored = 'text' if kind == 'string' else kind
+            return f"'{name}' is stored as {stored}, but the filter compares it with {json.dumps(equals[0], default=str)}"
+
+        if kind not in ('number', 'date') or not field["exact_range"] or field["min"] is None:
+            return None
+        low, high = field["min"], field["max"]
+        if name in GROWING_FIELDS:
+            # Documents inserted after profiling may lie past the profiled maximum
+            high = None
+        for op, value in operators.items():
+            values = [value] if op != '$in' else (value if isinstance(value, list) else [])
+            values = [_naive_utc(v) for v in values if _kind(v) == kind]
+            if not values:
+                continue
+            if op in ('$eq', '$in') and all(v < low or (high is not None and v > high) for v in values):
+                return self._range_reason(name, low, high)
+            value = values[0]
+            if (high is not None and ((op == '$gt' and value >= high) or (op == '$gte' and value > high))) \
+                    or (op == '$lt' and value <= low) or (op == '$lte' and value < low):
+                return self._range_reason(name, low, high)
+        lower = [(_naive_utc(v), op) for op, v in operators.items() if op in ('$gt', '$gte') and _kind(v) == kind]
+        upper = [(_naive_utc(v), op) for op, v in operators.items() if op in ('$lt', '$lte') and _kind(v) == kind]
+        for low_value, low_op in lower:
+            for high_value, high_op in upper:
+                if low_value > high_value or (low_value == high_value and (low_op == '$gt' or high_op == '$lt')):
+                    return f"the range on '{name}' is empty"
+        return None
+
+    def check_filter(self, filter_query):
+        """
+        Returns why no document can match `filter_query` according to the profile, or None
+        when it may match (or the profile cannot tell). Only type mismatches on consistently
+        typed fields and ranges outside exact min/max are treated as impossible.
+        """
+        with self._lock:
+            profile = self.profile
+        if not profile or not isinstance(filter_query, dict):
+            return None
+        for name, condition in filter_query.items():
+            if name == '$and' and isinstance(condition, list):
+                for clause in condition:
+                    reason = self.check_filter(clause)
+                    if reason:
+                        return reason
+            elif name == '$or' and isinstance(condition, list) and condition:
+                reasons = [self.check_filter(clause) for clause in condition]
+                if all(reasons):
+                    return reasons[0]
+            elif not name.startswith('$') and name in profile["fields"]:
+                reason = self._field_conflict(name, condition, profile["fields"][name])
+                if reason:
+                    return reason
+        return None
+
+    @classmethod
+    def _uses_index(cls, filter_query, indexed):
+        """Whether the server can narrow `filter_query` with an index led by one of `indexed`."""
+        for name, condition in filter_query.items():
+            if name == '$and' and isinstance(condition, list):
+                if any(isinstance(c, dict) and cls._uses_index(c, indexed) for c in condition):
+                    return True
+            elif name == '$or' and isinstance(condition, list) and condition:
+                if all(isinstance(c, dict) and cls._uses_index(c, indexed) for c in condition):
+                    return True
+            elif name in indexed:
+                return True
+        return False
+
+    def _confirmable(self, filter_query):
+        try:
+            indexed = {info['key'][0][0] for info in self.collection.index_information().values()}
+        except Exception:
+            return False
+        return self._uses_index(filter_query, indexed)
+
+    def check_query(self, parsed):
+        """
+        check_filter() on a parsed query's filter (for aggregations, the leading $match). When
+        an index can answer it, find_one() confirms that nothing matches; if something does, the
+        profile is out of date, None is returned and a full refresh starts in the background.
+        Filters on unindexed fields are rejected on the profile alone instead of a collection scan.
+        """
+        if parsed.method == 'aggregate':
+            pipeline = parsed.args[0]
+            filter_query = pipeline[0].get('$match') if pipeline and isinstance(pipeline[0], dict) else None
+        elif parsed.method == 'distinct':
+            filter_query = parsed.arg(1, {})
+        else:
+            filter_query = parsed.arg(0, {})
+        reason = self.check_filter(filter_query) if filter_query else None
+        if reason and self._confirmable(filter_query) and self.collection.find_one(filter_query, {"_id": 1}) is not None:
+            # The profile predates documents that do match: answer normally and re-profile
+            with self._lock:
+                self.stale_rejections += 1
+            if not self._refreshing.is_set():
+                self._refreshing.set()
+                self._run_in_background(self._refresh_stale)
+            return None
+        if reason:
+            with self._lock:
+                self.rejected_filters += 1
+        return reason
+
+    def _refresh_stale(self):
+        try:
+            self.refresh(full=True)
+        finally:
+            self._refreshing.clear()
+
+    def stats(self):
+        with self._lock:
+            profile = self.profile or {}
+            return {
+                "fields": len(profile.get("fields", {})),
+                "sampled": profile.get("sampled", 0),
+                "doc_count": profile.get("doc_count", 0),
+                "age_seconds": round(time.time() - profile["profiled_at"], 1) if profile.get("profiled_at") else None,
+                "exact_ranges": profile.get("exact_ranges_at") is not None,
+                "loaded_from_cache": self.loaded_from_cache,
+                "rejected_filters": self.rejected_filters,
+                "stale_rejections": self.stale_rejections
+            }
@@ -0,0 +1,194 @@
+"""
+Multi-user HTTP/JSON service mode for EnhancedMongoDBBot.
+
+One bot (one MongoClient connection pool, one Gemini model handle, one schema probe) is
+shared by all requests. Identical questions arriving at the same time share one answer,
+and identical generated queries share one MongoDB execution.
+
+    POST /ask     {"question": "..."}  ->  {"answer": "...", "elapsed_ms": 12.3, "coalesced": false}
+    GET  /stats   routing/cache/coalescing statistics
+    GET  /metrics per-stage latency histograms in the Prometheus text format
+    GET  /health
+
+Run with credentials from the environment:
+    GEMINI_API_KEY=... MONGODB_CONNECTION_STRING=... python server.py --port 8080
+or fully offline with stand-ins for Gemini and MongoDB:
+    python server.py --fake
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import Instrumentation
+from singleflight import SingleFlight
+
+MAX_BODY_BYTES = 64 * 1024
+
+
+class BotService:
+    def __init__(self, bot, timeout=30.0, workers=32):
+        self.bot = bot
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ask")
+        self._question_flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    @staticmethod
+    def question_key(question):
+        return ' '.join(question.lower().split())
+
+    def _answer(self, question):
+        return self._question_flight.do(self.question_key(question), self.bot.ask_question, question)
+
+    def ask(self, question):
+        """Returns (answer, coalesced). Raises TimeoutError if the answer takes longer than the timeout."""
+        with self._lock:
+            self.requests += 1
+        future = self._executor.submit(self._answer, question)
+        try:
+            answer, coalesced = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # The worker keeps running (and may still serve coalesced callers); this caller gives up
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"Answer not ready within {self.timeout}s")
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        return answer, coalesced
+
+    def stats(self):
+        with self._lock:
+            service = {"requests": self.requests, "timeouts": self.timeouts, "errors": self.errors}
+        service["question_coalescing"] = self._question_flight.stats()
+        return {"service": service, "bot": self.bot.get_stats()}
+
+
+def make_handler(service):
+    class BotRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            elif self.path == "/stats":
+                self._send_json(200, service.stats())
+            elif self.path == "/metrics":
+                body = service.bot.instrumentation.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/ask":
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY_BYTES:
+                self._send_json(413, {"error": "Request body too large"})
+                return
+            try:
+                question = json.loads(self.rfile.read(length) or b"{}").get("question", "").strip()
+            except (ValueError, AttributeError):
+                self._send_json(400, {"error": "Body must be JSON like {\"question\": \"...\"}"})
+                return
+            if not question:
+                self._send_json(400, {"error": "Missing 'question'"})
+                return
+            started = time.perf_counter()
+            try:
+                answer, coalesced = service.ask(question)
+            except TimeoutError as e:
+                self._send_json(504, {"error": str(e)})
+                return
+            except Exception as e:
+                self._send_json(500, {"error": f"Answering failed: {e}"})
+                return
+            self._send_json(200, {
+                "answer": answer,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+                "coalesced": coalesced
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return BotRequestHandler
+
+
+def make_server(service, host="127.0.0.1", port=8080):
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def make_fake_bot(documents=20000, llm_latency=0.5, mongo_latency=0.002, answers=None, **bot_options):
+    """A bot wired to FakeGeminiModel and the in-memory MongoDB stand-in, for offline runs."""
+    from fakes import FakeGeminiModel, FakeMongoClient, generate_milk_collections
+    from v1 import EnhancedMongoDBBot
+    client = FakeMongoClient(generate_milk_collections(documents), latency=mongo_latency)
+    model = FakeGeminiModel(answers, latency=llm_latency)
+    bot_options.setdefault('instrumentation', Instrumentation())
+    bot_options.setdefault('mongo_workers', 32)
+    bot_options.setdefault('schema_cache_path', None)
+    return EnhancedMongoDBBot(None, None, model=model, client=client, coalesce_requests=True, **bot_options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve EnhancedMongoDBBot over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent answers being computed")
+    parser.add_argument("--fake", action="store_true", help="use offline stand-ins for Gemini and MongoDB")
+    parser.add_argument("--quiet", action="store_true", help="silence the bot's per-question progress output")
+    parser.add_argument("--metrics-jsonl", help="append one JSON line of stage timings per question to this file")
+    args = parser.parse_args()
+
+    if args.quiet:
+        sys.stdout = open(os.devnull, "w")
+    instrumentation = Instrumentation(jsonl_path=args.metrics_jsonl)
+    if args.fake:
+        bot = make_fake_bot(instrumentation=instrumentation, mongo_workers=args.workers)
+    else:
+        from v1 import EnhancedMongoDBBot
+        gemini_api_key = os.environ.get("GEMINI_API_KEY")
+        connection_string = os.environ.get("MONGODB_CONNECTION_STRING")
+        if not gemini_api_key or not connection_string:
+            parser.error("set GEMINI_API_KEY and MONGODB_CONNECTION_STRING (or use --fake)")
+        bot = EnhancedMongoDBBot(gemini_api_key, connection_string, coalesce_requests=True, instrumentation=instrumentation,
+                                 mongo_workers=args.workers)
+
+    server = make_server(BotService(bot, timeout=args.timeout, workers=args.workers), args.host, args.port)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Template-level cache for natural language -> MongoDB query translation.
+
+A question is reduced to its "shape" by replacing member/dcs codes, numbers and
+dates with placeholders. The query generated by the LLM for one question is then
+stored as a parameterized template, so any later question with the same shape is
+answered by filling its own literals back in, without another LLM round trip.
+"""
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+MONTHS = {
+    'jan': 1, 'january': 1, 'feb': 2, 'february': 2, 'mar': 3, 'march': 3,
+    'apr': 4, 'april': 4, 'may': 5, 'jun': 6, 'june': 6, 'jul': 7, 'july': 7,
+    'aug': 8, 'august': 8, 'sep': 9, 'sept': 9, 'september': 9, 'oct': 10, 'october': 10,
+    'nov': 11, 'november': 11, 'dec': 12, 'december': 12
+}
+
+# Order matters: full dates before codes/years, codes (6+ digits) before years and plain numbers.
+LITERAL_PATTERN = re.compile(
+    r'(?P<dmy>\b\d{1,2}[/-]\d{1,2}[/-]\d{4}\b)'
+    r'|(?P<iso>\b\d{4}-\d{2}-\d{2}\b)'
+    r'|(?P<month>\b(?:' + '|'.join(sorted(MONTHS, key=len, reverse=True)) + r')\b(?:\s+(?P<month_year>(?:19|20)\d{2})\b)?)'
+    r'|(?P<code>\b\d{6,}\b)'
+    r'|(?P<year>\b(?:19|20)\d{2}\b)'
+    r'|(?P<num>(?<![\w.])\d+(?:\.\d+)?(?![\w.]))',
+    re.IGNORECASE
+)
+# Comparison operators stay distinct tokens of the key: "fat >= 4.1" and "fat > 4.1" need different queries.
+KEY_TOKEN_PATTERN = re.compile(r'<(?:code|num|day|month|year)>|[<>!=]=|[<>=]|[a-z0-9]+')
+ISODATE_PATTERN = re.compile(r'ISODate\("([^"]+)"\)')
+MARKER_PATTERN = re.compile(r'@@L(\d+)(?:\.(start|end))?@@')
+
+
+def _month_period(year, month):
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+def extract_literals(question):
+    """
+    Splits a question into (template_key, literals). Each literal is a dict with a
+    'kind' of code, num, day, month or year; codes/numbers keep their 'text' and
+    dates resolve to a half-open ['start', 'end') period.
+    Returns (None, []) if a literal could not be interpreted.
+    """
+    literals = []
+    pieces = []
+    last = 0
+    pending_months = []
+    for m in LITERAL_PATTERN.finditer(question):
+        kind = m.lastgroup if m.lastgroup != 'month_year' else 'month'
+        text = m.group(0)
+        literal = {'kind': kind, 'text': text}
+        try:
+            if kind == 'dmy':
+                day, month, year = (int(p) for p in re.split(r'[/-]', text))
+                start = datetime(year, month, day)
+                literal.update(kind='day', start=start, end=start + timedelta(days=1))
+            elif kind == 'iso':
+                start = datetime.strptime(text, '%Y-%m-%d')
+                literal.update(kind='day', start=start, end=start + timedelta(days=1))
+            elif kind == 'month':
+                name = text.split()[0].lower()
+                year = m.group('month_year')
+                if year is None:
+                    # "may" without a year is far more likely to be the verb
+                    if name == 'may':
+                        continue
+                    pending_months.append(literal)
+                    literal['month_num'] = MONTHS[name]
+                else:
+                    literal['start'], literal['end'] = _month_period(int(year), MONTHS[name])
+                    for pending in pending_months:
+                        pending['start'], pending['end'] = _month_period(int(year), pending['month_num'])
+                    pending_months = []
+            elif kind == 'year':
+                year = int(text)
+                literal.update(start=datetime(year, 1, 1), end=datetime(year + 1, 1, 1))
+                for pending in pending_months:
+                    pending['start'], pending['end'] = _month_period(year, pending['month_num'])
+                pending_months = []
+        except ValueError:
+            return None, []
+        pieces.append(question[last:m.start()])
+        pieces.append(f"<{literal['kind']}>")
+        last = m.end()
+        literals.append(literal)
+    pieces.append(question[last:])
+
+    # A bare month name with no year anywhere after it is just a word
+    if any('start' not in lit for lit in literals if lit['kind'] == 'month'):
+        return None, []
+
+    key = ' '.join(KEY_TOKEN_PATTERN.findall(''.join(pieces).lower()))
+    return key, literals
+
+
+def _format_isodate(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse_isodate(text):
+    try:
+        value = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return value.replace(tzinfo=None)
+
+
+def build_template(query_text, literals):
+    """
+    Turns a generated query into a template by replacing every literal taken from the
+    question with a marker. Returns None when the mapping is ambiguous or incomplete,
+    in which case filling the template for another question could give a wrong query.
+    """
+    texts = [lit['text'] for lit in literals if lit['kind'] in ('code', 'num')]
+    if len(texts) != len(set(texts)):
+        return None
+
+    template = query_text
+    for i, lit in enumerate(literals):
+        if lit['kind'] == 'code':
+            quoted = f'"{lit["text"]}"'
+            if quoted not in template:
+                return None
+            template = template.replace(quoted, f'"@@L{i}@@"')
+        elif lit['kind'] == 'num':
+            pattern = re.compile(r'(?<![\w.\-"@])' + re.escape(lit['text']) + r'(?![\w.])')
+            # Numbers must appear exactly once, otherwise a sort direction or
+            # an unrelated constant could be mistaken for the literal.
+            if len(pattern.findall(template)) != 1:
+                return None
+            template = pattern.sub(f'@@L{i}@@', template)
+
+    periods = [(i, lit) for i, lit in enumerate(literals) if 'start' in lit]
+    used_periods = set()
+
+    def replace_isodate(match):
+        value = _parse_isodate(match.group(1))
+        candidates = []
+        if value is not None:
+            for i, lit in periods:
+                if value == lit['start']:
+                    candidates.append((i, 'start'))
+                if value == lit['end']:
+                    candidates.append((i, 'end'))
+        if len(candidates) != 1:
+            raise LookupError(match.group(1))
+        i, edge = candidates[0]
+        used_periods.add(i)
+        return f'ISODate("@@L{i}.{edge}@@")'
+
+    try:
+        template = ISODATE_PATTERN.sub(replace_isodate, template)
+    except LookupError:
+        return None
+    if len(used_periods) != len(periods):
+        return None
+    return template
+
+
+def fill_template(template, literals):
+    def replace_marker(match):
+        lit = literals[int(match.group(1))]
+        if match.group(2):
+            return _format_isodate(lit[match.group(2)])
+        return lit['text']
+    return MARKER_PATTERN.sub(replace_marker, template)
+
+
+class QueryTemplateCache:
+    """
+    LRU + TTL cache of query templates keyed on the question shape, with an optional
+    SQLite file as a backing store shared across runs.
+    """
+
+    def __init__(self, max_size=512, ttl_seconds=24 * 3600, path=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.uncacheable = 0
+        self.evictions = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_templates (key TEXT PRIMARY KEY, template TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _expired(self, created):
+        return self.ttl_seconds is not None and time.time() - created > self.ttl_seconds
+
+    def _remember(self, key, template, created):
+        self._entries[key] = (template, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if not self._expired(entry[1]):
+                self._entries.move_to_end(key)
+                return entry[0]
+            del self._entries[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT template, created FROM query_templates WHERE key = ?", (key,)).fetchone()
+            if row:
+                if not self._expired(row[1]):
+                    self._remember(key, row[0], row[1])
+                    return row[0]
+                self._db.execute("DELETE FROM query_templates WHERE key = ?", (key,))
+                self._db.commit()
+        return None
+
+    def get(self, question):
+        """Returns the cached query filled in with this question's literals, or None."""
+        key, literals = extract_literals(question)
+        with self._lock:
+            template = self._lookup(key) if key else None
+            if template is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return fill_template(template, literals)
+
+    def put(self, question, query_text):
+        """Stores the query generated for a question. Returns False if it cannot be templated."""
+        key, literals = extract_literals(question)
+        template = build_template(query_text, literals) if key else None
+        with self._lock:
+            if template is None:
+                self.uncacheable += 1
+                return False
+            created = time.time()
+            self._remember(key, template, created)
+            self.stores += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_templates (key, template, created) VALUES (?, ?, ?)",
+                    (key, template, created)
+                )
+                self._db.commit()
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM query_templates")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "uncacheable": self.uncacheable,
+                "evictions": self.evictions,
+                "size": len(self._entries)
+            }
@@ -1,19 +1,54 @@
 import pymongo
 import google.generativeai as genai
 import json
-from datetime import datetime
 import re
-import ast
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from template_cache import QueryTemplateCache
+from intent_router import IntentRouter, RouteStats
+from query_parser import parse_query
+from index_advisor import IndexAdvisor
+from rollups import RollupManager
+from result_cache import QueryResultCache, query_key
+from prompt_builder import PromptBuilder
+from llm_streaming import read_streamed_query
+from rate_limiter import AsyncRateLimiter
+from singleflight import SingleFlight
+from instrumentation import Instrumentation
+from query_governor import QueryGovernor, QueryRejected, load_policy
+import columnar_export
+from schema_profiler import DEFAULT_SCHEMA_CACHE_PATH, SchemaProfiler
+from partitions import PartitionedCollection
 
 class EnhancedMongoDBBot:
-    def __init__(self, gemini_api_key, mongodb_connection_string):
-        genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-pro')
+    def __init__(self, gemini_api_key, mongodb_connection_string, query_cache_path=None, query_cache_size=512, query_cache_ttl=24 * 3600,
+                 stream_find_results=True, find_batch_size=1000, index_advisor=False, auto_create_indexes=False,
+                 use_rollups=False, rollup_max_staleness=0, rollup_refresh_interval=900,
+                 cache_results=False, result_cache_bytes=64 * 1024 * 1024, result_cache_ttls=None, result_cache_invalidation=None,
+                 prompt_examples=4, prompt_examples_path=None, stream_llm=False, mongo_workers=8,
+                 coalesce_requests=False, model=None, client=None, instrumentation=None,
+                 query_policy=None, query_policy_path=None,
+                 schema_cache_path=DEFAULT_SCHEMA_CACHE_PATH, schema_sample_size=1000, schema_max_age=24 * 3600, schema_refresh_interval=None,
+                 reject_impossible_filters=True, partition_granularity=None, partition_workers=8):
+        # An existing model handle / MongoClient can be passed in so several bots (or a service) share them
+        if model is None:
+            genai.configure(api_key=gemini_api_key)
+            model = genai.GenerativeModel('gemini-2.5-pro')
+        self.model = model
+        self.stream_llm = stream_llm
+        # Per-stage timings/histograms; pass Instrumentation() to enable (disabled is a no-op)
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation(enabled=False)
 
         try:
-            self.client = pymongo.MongoClient(mongodb_connection_string)
+            self.client = client if client is not None else pymongo.MongoClient(mongodb_connection_string)
             self.db = self.client['lactalis_db']
-            self.collection = self.db['milk_collections']
+            if partition_granularity:
+                # One collection per month/year/day (milk_collections_2024_11, ...), pruned by date
+                self.collection = PartitionedCollection(self.db, 'milk_collections', granularity=partition_granularity,
+                                                        workers=partition_workers)
+            else:
+                self.collection = self.db['milk_collections']
             self.client.admin.command('ping')
             print("✅ MongoDB connection successful.")
         except pymongo.errors.ConnectionFailure as e:
@@ -23,7 +58,13 @@ class EnhancedMongoDBBot:
             print(f" An unexpected error during MongoDB initialization: {e}")
             raise
 
+        # Field presence/types/ranges from a $sample; a fresh cache file skips the probe at startup (None: no file)
+        self.schema_profiler = SchemaProfiler(self.collection, sample_size=schema_sample_size,
+                                              cache_path=schema_cache_path, max_age=schema_max_age)
+        self.reject_impossible_filters = reject_impossible_filters
         self.schema_info = self._get_collection_schema()
+        if schema_refresh_interval:
+            self.schema_profiler.start_background_refresh(schema_refresh_interval)
         self.field_mappings = {
             'member': 'memberCode', 'membercode': 'memberCode', 'member code': 'memberCode', 'members': 'memberCode', 'member codes': 'memberCode', 'membercodes': 'memberCode',
             'dcs': 'dcsCode', 'dcscode': 'dcsCode', 'dcs codes': 'dcsCode', 'dcscodes': 'dcsCode', 'dcs code': 'dcsCode',
@@ -33,145 +74,120 @@ class EnhancedMongoDBBot:
             'collection_date': 'dateTimeOfCollection', 'plant': 'plantCode',
             'plantcode': 'plantCode', 'union': 'unionCode', 'unioncode': 'unionCode'
         }
+        # Few-shot examples are picked per question from an extensible local example store
+        self.prompt_builder = PromptBuilder(self.schema_info, k=prompt_examples)
+        if prompt_examples_path:
+            self.prompt_builder.load_examples(prompt_examples_path)
+        # Questions that only differ in codes, numbers or dates reuse the same generated query
+        self.query_cache = QueryTemplateCache(max_size=query_cache_size, ttl_seconds=query_cache_ttl, path=query_cache_path)
+        # Common question shapes are answered by local rules; the LLM is only the fallback
+        self.router = IntentRouter(self.field_mappings)
+        self.route_stats = RouteStats()
+        # find() only pulls the documents that will be displayed; totals are counted in parallel (mongo_workers threads)
+        self.stream_find_results = stream_find_results
+        self.find_batch_size = find_batch_size
+        self._executor = ThreadPoolExecutor(max_workers=mongo_workers, thread_name_prefix="count")
+        # Batch/async answering runs query execution here (separate from the count pool above)
+        self._query_executor = ThreadPoolExecutor(max_workers=mongo_workers, thread_name_prefix="mongo")
+        # Concurrent identical queries share one MongoDB execution
+        self._query_flight = SingleFlight() if coalesce_requests else None
+        self.partitioned = bool(partition_granularity)
+        if self.partitioned and (use_rollups or index_advisor or auto_create_indexes):
+            raise ValueError("Rollups and the index advisor need a single collection; they are not available with partition_granularity")
+        # Optional: explain every generated query and build index recommendations from the workload
+        self.index_advisor = IndexAdvisor(self.collection, auto_create=auto_create_indexes) if index_advisor or auto_create_indexes else None
+        # Optional: answer eligible $group/count queries from daily/monthly rollup collections
+        # (refreshed in the background; unbounded queries use them only once the watermark check shows nothing
+        # newer, unless rollup_max_staleness opts in to answers missing up to that many seconds of collections)
+        self.rollups = RollupManager(self.db, self.collection.name, max_staleness=rollup_max_staleness) if use_rollups else None
+        if self.rollups is not None and rollup_refresh_interval:
+            self.rollups.start_background_refresh(rollup_refresh_interval)
+        # Optional: reuse results of identical queries ('change_stream' or 'watermark' invalidation)
+        self.result_cache = None
+        if cache_results:
+            self.result_cache = QueryResultCache(self.collection, max_bytes=result_cache_bytes, ttls=result_cache_ttls,
+                                                 invalidation=result_cache_invalidation)
+        # Optional: maxTimeMS/limits on every query and explain-based cost budgets (settings in query_governor.DEFAULT_POLICY)
+        self.governor = None
+        if query_policy is not None or query_policy_path:
+            policy = load_policy(query_policy_path) if query_policy_path else {}
+            policy.update(query_policy or {})
+            self.governor = QueryGovernor(self.collection, policy)
+            if self.partitioned and self.governor.policy["estimate_cost"]:
+                raise ValueError("Explain-based cost estimates are not available with partition_granularity")
 
     def _get_collection_schema(self):
         try:
-            sample_doc = self.collection.find_one()
-            if sample_doc:
-                if '_id' in sample_doc:
-                    del sample_doc['_id']
-                # Convert datetime objects to string 'datetime' for the prompt
-                for k, v in sample_doc.items():
-                    if isinstance(v, datetime):
-                        sample_doc[k] = 'datetime'
-                    else:
-                        sample_doc[k] = type(v).__name__
-                return sample_doc
-            return {}
+            self.schema_profiler.ensure_profile()
+            return self.schema_profiler.prompt_schema()
         except Exception as e:
             print(f" Error getting schema: {e}")
             return {}
 
+    def _local_query(self, user_question):
+        """Answers from the local router or the template cache. Returns None if the LLM is needed."""
+        start = time.perf_counter()
+        with self.instrumentation.stage('route') as span:
+            routed = self.router.route(user_question)
+            if routed is not None:
+                route_name, query_text = routed
+                self.route_stats.record(route_name, time.perf_counter() - start)
+                span.set(route=route_name)
+                print(f"🧭 Answered by local '{route_name}' route (LLM call skipped).")
+                return query_text
+
+            cached_query = self.query_cache.get(user_question)
+            if cached_query is not None:
+                self.route_stats.record("template_cache", time.perf_counter() - start)
+                span.set(route="template_cache")
+                print("⚡ Reusing cached query template (LLM call skipped).")
+                return cached_query
+            span.set(route="llm")
+        return None
+
+    def _llm_query(self, user_question):
+        start = time.perf_counter()
+        query_text = self._generate_query_with_llm(user_question)
+        self.route_stats.record("llm", time.perf_counter() - start)
+        if self._validate_llm_query(query_text):
+            self.query_cache.put(user_question, query_text)
+        return query_text
+
     def _natural_language_to_query(self, user_question):
-        # This prompt is heavily revised to be more robust and provide better examples.
-        prompt = """
-You are an expert MongoDB query generator. Your ONLY task is to convert a user's natural language question into a single, executable PyMongo query string.
-
-**DATABASE SCHEMA**
-- Collection Name: `milk_collections`
-- Schema for your reference:
-%s
-
-**KEY FIELDS & ALIASES**
-- `memberCode` (string): member, member code
-- `dcsCode` (string): dcs, dcs code
-- `qty` (float/int): quantity, qty, milk, milk quantity
-- `fat` (float): fat
-- `snf` (float): snf
-- `dateTimeOfCollection` (datetime): date, datetime, collection date, time
-
-**OUTPUT RULES**
-1.  **OUTPUT ONLY THE QUERY STRING.** Start your response IMMEDIATELY with `find({...})`, `aggregate([...])`, `distinct("field", {...})`, or `count_documents({...})`.
-2.  **NO EXTRA TEXT.** Do not include explanations, comments, markdown, or language names (like "python" or "json").
-3.  **USE CORRECT FIELD NAMES.** Use the schema field names (`memberCode`, `qty`), not user aliases (`member`, `quantity`).
-4.  **CORRECT TYPES.** Numbers should be numbers (`4.1`), codes and other non-numeric IDs must be strings (`"730110400002"`).
-5.  **VALID SYNTAX.** All keys and string values must be in double quotes.
-6.  **DATE HANDLING:**
-    - Always use `ISODate`. A specific date like "on 01/01/2025" becomes a full-day range: `{"dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-01-02T00:00:00Z")}}`.
-    - A date range like "between 01/01/2025 and 03/01/2025" becomes `{"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-03-02T00:00:00Z")}`.
-7.  **AGGREGATION LOGIC:**
-    - **Top/Bottom N:** Use `$sort` and `$limit`. For "top", sort descending (`-1`). For "bottom/lowest/least", sort ascending (`1`).
-    - **Grouped Operations:** Use `$group` with accumulators like `$sum`, `$avg`, `$min`, `$max`. For a global average/sum (not grouped by a field), use `"_id": None`.
-    - **Trends:** Group by time unit (e.g., `{"month": {"$month": "$dateTimeOfCollection"}}`) and `$sort` by it.
-    - **Comparisons:** For comparing entities (e.g., member A vs member B), use `$match` with `{"$in": ["A", "B"]}` and then `$group` by the entity field.
-8.  **AVOID INVALID QUERIES:** Never start a filter with an operator.
-    - WRONG: `find({"$gt": 4.1})`
-    - RIGHT: `find({"fat": {"$gt": 4.1}})`
-
-**USER QUESTION:** "%s"
-
----
-**EXAMPLES**
-- User: "Show me collections for member 730110400002"
-  -> `find({"memberCode": "730110400002"})`
-- User: "Count records for dcs 001000001993 for Jan 2025"
-  -> `count_documents({"dcsCode": "001000001993", "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-02-01T00:00:00Z")}})`
-- User: "Find records with fat > 4.1 and snf > 8.5 for member 0010000019930016 in january 2025"
-  -> `find({"memberCode": "0010000019930016", "fat": {"$gt": 4.1}, "snf": {"$gt": 8.5}, "dateTimeOfCollection": {"$gte": ISODate("2025-01-01T00:00:00Z"), "$lt": ISODate("2025-02-01T00:00:00Z")}})`
-- User: "List 10 unique member codes with qty over 100"
-  -> `distinct("memberCode", {"qty": {"$gt": 100}})`
-- User: "What is the lowest quantity collected on 09/11/2024?"
-  -> `aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-11-09T00:00:00Z"), "$lt": ISODate("2024-11-10T00:00:00Z")}}}, {"$sort": {"qty": 1}}, {"$limit": 1}])`
-- User: "Minimum SNF for DCS 001000001993"
-  -> `aggregate([{"$match": {"dcsCode": "001000001993"}}, {"$group": {"_id": "$dcsCode", "minSNF": {"$min": "$snf"}}}])`
-- User: "Top 5 members by total quantity"
-  -> `aggregate([{"$group": {"_id": "$memberCode", "totalQty": {"$sum": "$qty"}}}, {"$sort": {"totalQty": -1}}, {"$limit": 5}])`
-- User: "Which member has the highest average SNF?"
-  -> `aggregate([{"$group": {"_id": "$memberCode", "avgSNF": {"$avg": "$snf"}}}, {"$sort": {"avgSNF": -1}}, {"$limit": 1}])`
-- User: "What is the average quantity per collection overall?"
-  -> `aggregate([{"$group": {"_id": null, "avgQty": {"$avg": "$qty"}}}])`
-- User: "Trend of average fat per month in 2024"
-  -> `aggregate([{"$match": {"dateTimeOfCollection": {"$gte": ISODate("2024-01-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgFat": {"$avg": "$fat"}}}, {"$sort": {"_id.month": 1}}])`
-- User: "Compare average qty for member 0010000008650047 and member 760540500086"
-  -> `aggregate([{"$match": {"memberCode": {"$in": ["0010000008650047", "760540500086"]}}}, {"$group": {"_id": "$memberCode", "avgQty": {"$avg": "$qty"}}}])`
-- User: "Compare average quantity for member 0010000008650047 in November and December 2024"
-  -> `aggregate([{"$match": {"memberCode": "0010000008650047", "dateTimeOfCollection": {"$gte": ISODate("2024-11-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": {"month": {"$month": "$dateTimeOfCollection"}}, "avgQty": {"$avg": "$qty"}}}, {"$sort": {"_id.month": 1}}])`
-- User: "Compare total quantity for DCS 001000001993 and 001000002000 in 2024"
-  -> `aggregate([{"$match": {"dcsCode": {"$in": ["001000001993", "001000002000"]}, "dateTimeOfCollection": {"$gte": ISODate("2024-01-01T00:00:00Z"), "$lt": ISODate("2025-01-01T00:00:00Z")}}}, {"$group": {"_id": "$dcsCode", "totalQty": {"$sum": "$qty"}}}])`
-""" % (json.dumps(self.schema_info, indent=2), user_question)
+        query_text = self._local_query(user_question)
+        if query_text is None:
+            query_text = self._llm_query(user_question)
+        return query_text
+
+    def _generate_query_with_llm(self, user_question):
+        # Static instructions first (identical on every call so prefix caching applies), then the most similar examples
+        with self.instrumentation.stage('prompt_build') as span:
+            prompt, prompt_info = self.prompt_builder.build(user_question)
+            span.set(bytes=len(prompt), examples=prompt_info['examples'])
         try:
-            response = self.model.generate_content(prompt)
-            query_text = response.text.strip()
-            # Clean up potential markdown code blocks, just in case
-            query_text = re.sub(r"^(```(json|mongodb|python)?\n?)", "", query_text)
-            query_text = re.sub(r"```$", "", query_text)
-            # Remove leading/trailing backticks
-            query_text = query_text.strip('`')
-            return query_text.strip()
+            with self.instrumentation.stage('llm_call', streamed=self.stream_llm) as span:
+                if self.stream_llm:
+                    # Stop reading as soon as a syntactically complete query has arrived
+                    started = time.perf_counter()
+                    response = self.model.generate_content(prompt, stream=True)
+                    query_text, stopped_early, chars_read, usage_chunk = read_streamed_query(response)
+                    # Streamed chunks report the prompt's token counts; the last one read is the most complete
+                    if usage_chunk is not None:
+                        self.prompt_builder.record_usage(usage_chunk, prompt_info)
+                    if stopped_early:
+                        print(f"✂️ Query complete after {chars_read} streamed chars ({time.perf_counter() - started:.2f}s), rest of the response skipped.")
+                else:
+                    response = self.model.generate_content(prompt)
+                    self.prompt_builder.record_usage(response, prompt_info)
+                    # Extracts the query expression, dropping markdown fences or trailing commentary
+                    query_text, _, chars_read, _ = read_streamed_query([response])
+                span.set(bytes=chars_read)
+            print(f"📝 Prompt: ~{prompt_info.get('prompt_tokens', prompt_info['estimated_tokens'])} tokens, {prompt_info['examples']} examples")
+            return query_text
         except Exception as e:
             print(f"Error generating query with LLM: {e}")
             return f"error: LLM query generation failed: {e}"
 
-    def _safe_eval(self, query_string: str):
-        """
-        Safely evaluates a string containing a Python expression (like a dict or list),
-        primarily for converting ISODate strings to datetime objects.
-        """
-        if not isinstance(query_string, str):
-            raise ValueError(f"Input to _safe_eval must be a string, got {type(query_string)}")
-
-        query_string = query_string.strip()
-        if not query_string:
-            return {} # An empty query string means an empty filter
-
-        # Replace JavaScript-style null with Python None
-        query_string = re.sub(r'\bnull\b', 'None', query_string, flags=re.IGNORECASE)
-
-        # 1. Replace MongoDB-specific syntax with Python-compatible equivalents.
-        # Handle ISODate("...") by replacing it with a Python datetime constructor call
-        def iso_to_datetime_str(match):
-            iso_str = match.group(1).replace('Z', '+00:00')
-            if 'T' not in iso_str: # Handle date-only strings
-                iso_str += 'T00:00:00+00:00'
-            return f'datetime.fromisoformat("{iso_str}")'
-
-        processed_string = re.sub(r'ISODate\("([^"]+)"\)', iso_to_datetime_str, query_string)
-
-        # 2. Use a controlled `eval` to parse the string. This is necessary because
-        # `ast.literal_eval` does not support function calls like `datetime.fromisoformat`.
-        # The scope is heavily restricted to prevent security issues.
-        try:
-            allowed_globals = {"__builtins__": {}}
-            allowed_locals = {
-                "datetime": datetime,
-                "None": None,
-                "True": True,
-                "False": False
-            }
-            return eval(processed_string, allowed_globals, allowed_locals)
-        except (SyntaxError, NameError, TypeError, Exception) as e:
-            raise ValueError(f"Could not parse query. Generated string: '{query_string}'. Error: {e}")
-
     def _has_invalid_top_level_operator(self, query_dict):
         """Checks for invalid top-level operators like {"$gt": 4}, which is a common LLM error."""
         if isinstance(query_dict, dict):
@@ -180,112 +196,223 @@ You are an expert MongoDB query generator. Your ONLY task is to convert a user's
                     return True
         return False
 
-    def _execute_mongodb_query(self, query_text):
+    def _find_cursor(self, parsed, limit=None, batch_size=None):
+        """Builds a cursor for a parsed find(...) query, applying its projection, sort and skip."""
+        cursor = self.collection.find(parsed.arg(0, {}), parsed.arg(1), batch_size=batch_size or self.find_batch_size)
+        if parsed.modifiers.get('max_time_ms'):
+            cursor = cursor.max_time_ms(parsed.modifiers['max_time_ms'])
+        if parsed.modifiers.get('sort'):
+            cursor = cursor.sort(parsed.modifiers['sort'])
+        if parsed.modifiers.get('skip'):
+            cursor = cursor.skip(parsed.modifiers['skip'])
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def _count_matching(self, filter_query, max_time_ms=None):
+        options = {"maxTimeMS": max_time_ms} if max_time_ms else {}
+        with self.instrumentation.stage('count', estimated=not filter_query):
+            # An empty filter can use the collection metadata instead of scanning
+            if not filter_query:
+                return self.collection.estimated_document_count(**options)
+            return self.collection.count_documents(filter_query, **options)
+
+    def iter_query_results(self, query_text, batch_size=None):
+        """
+        Lazily yields every document matched by a find(...) query, fetching one cursor
+        batch at a time instead of materializing the whole result set.
+        """
+        parsed = parse_query(query_text)
+        if parsed.method != 'find':
+            raise ValueError(f"Only find(...) queries can be streamed, got {parsed.method}(...)")
+        cursor = self._find_cursor(parsed, limit=parsed.modifiers.get('limit'), batch_size=batch_size)
+        try:
+            for doc in cursor:
+                yield doc
+        finally:
+            cursor.close()
+
+    def get_query_page(self, query_text, page=0, page_size=50):
+        """Returns one page of a find(...) query's results, ordered by _id unless the query sorts."""
+        parsed = parse_query(query_text)
+        if parsed.method != 'find':
+            raise ValueError(f"Only find(...) queries can be paged, got {parsed.method}(...)")
+        filter_query = parsed.arg(0, {})
+        limit = parsed.modifiers.get('limit')
+        skip = parsed.modifiers.get('skip', 0) + page * page_size
+        if limit is not None:
+            page_size = max(0, min(page_size, limit - page * page_size))
+        total_future = self._executor.submit(self.instrumentation.bind(self._count_matching), filter_query)
+        results = []
+        if page_size:
+            cursor = self.collection.find(filter_query, parsed.arg(1), batch_size=page_size)
+            cursor = cursor.sort(parsed.modifiers.get('sort') or [('_id', 1)])
+            results = list(cursor.skip(skip).limit(page_size))
+        total_count = max(0, total_future.result() - parsed.modifiers.get('skip', 0))
+        if limit is not None:
+            total_count = min(total_count, limit)
+        return {"type": "find", "results": results, "count": len(results), "total_count": total_count, "page": page, "page_size": page_size}
+
+    def export_query(self, query_text, path, fmt=None, columns=None, batch_size=50000):
+        """
+        Streams all results of a find(...)/aggregate(...) query to a CSV, Parquet or Arrow IPC
+        file in columnar batches (bounded memory). Exports are deliberately not capped by the
+        query policy's result limits. Returns row count and timing.
+        """
+        parsed = parse_query(query_text)
+        with self.instrumentation.stage('export', method=parsed.method) as span:
+            result = columnar_export.export_query(self.collection, parsed, path, fmt=fmt, columns=columns, batch_size=batch_size)
+            span.set(docs=result["rows"])
+        return result
+
+    def export_question(self, user_question, path, fmt=None, batch_size=50000):
+        """Generates the query for a question and exports its full result set to a file."""
+        query_text = self._natural_language_to_query(user_question)
+        if not self._validate_llm_query(query_text):
+            raise ValueError(f"Could not generate a valid query. The LLM returned: {query_text}")
+        print(f" Exporting results of: {query_text}")
+        return self.export_query(query_text, path, fmt=fmt, batch_size=batch_size)
+
+    def _govern(self, parsed, sample_size):
+        """Applies the query policy. Returns (query to run, approximate result or None)."""
+        if self.governor is None:
+            return parsed, None
+        with self.instrumentation.stage('govern') as span:
+            governed, verdict = self.governor.govern(parsed, sample_size)
+            span.set(verdict=verdict)
+        if verdict == 'sample':
+            print("🛡️ Query is over the cost budget, answering from a random sample instead.")
+            return governed, self.governor.run_sampled(governed, sample_size)
+        return governed, None
+
+    def _run_parsed_query(self, parsed, sample_size=None):
+        if parsed.method == 'find':
+            filter_query = parsed.arg(0, {})
+            if self._has_invalid_top_level_operator(filter_query):
+                return {"error": "Invalid query: a top-level key cannot be a MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
+            parsed, sampled = self._govern(parsed, sample_size)
+            if sampled is not None:
+                return sampled
+            limit = parsed.modifiers.get('limit')
+            # In streaming mode only the documents that will be displayed are pulled,
+            # and the total number of matches is counted concurrently on the server.
+            if limit is None and self.stream_find_results and sample_size is not None:
+                limit = sample_size
+            if limit is None:
+                results = list(self._find_cursor(parsed))
+                return {"type": "find", "results": results, "count": len(results)}
+            total_future = self._executor.submit(self.instrumentation.bind(self._count_matching), filter_query, parsed.modifiers.get('max_time_ms'))
+            results = list(self._find_cursor(parsed, limit=limit, batch_size=min(limit, self.find_batch_size)))
+            total_count = max(0, total_future.result() - parsed.modifiers.get('skip', 0))
+            return {"type": "find", "results": results, "count": len(results), "total_count": total_count}
+
+        elif parsed.method == 'aggregate':
+            pipeline = parsed.args[0]
+            # Validate the $match stage if it exists
+            if pipeline and pipeline[0].get('$match'):
+                if self._has_invalid_top_level_operator(pipeline[0]['$match']):
+                     return {"error": "Invalid aggregation: $match stage has a top-level MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
+            if self.rollups is not None:
+                rewritten = self.rollups.rewrite_aggregate(pipeline)
+                if rewritten is not None:
+                    rollup_name, rollup_pipeline = rewritten
+                    print(f"📦 Answering from rollup collection '{rollup_name}'.")
+                    results = list(self.db[rollup_name].aggregate(rollup_pipeline))
+                    return {"type": "aggregate", "results": results, "count": len(results), "rollup": rollup_name}
+            parsed, sampled = self._govern(parsed, sample_size)
+            if sampled is not None:
+                return sampled
+            options = {k: v for k, v in parsed.arg(1, {}).items() if k in ('allowDiskUse', 'maxTimeMS', 'collation', 'hint')}
+            results = list(self.collection.aggregate(parsed.args[0], **options))
+            result = {"type": "aggregate", "results": results, "count": len(results)}
+            cap = parsed.modifiers.get('result_cap')
+            if cap and len(results) >= cap:
+                result["capped_at"] = cap
+            return result
+
+        elif parsed.method == 'distinct':
+            field_name = parsed.args[0]
+            filter_query = parsed.arg(1, {})
+            if self._has_invalid_top_level_operator(filter_query):
+                return {"error": "Invalid query: a top-level key cannot be a MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
+            parsed, sampled = self._govern(parsed, sample_size)
+            if sampled is not None:
+                return sampled
+            results = self.collection.distinct(field_name, filter_query, **self._time_limit(parsed))
+            return {"type": "distinct", "field": field_name, "results": results, "count": len(results)}
+
+        else:
+            filter_query = parsed.arg(0, {})
+            if self._has_invalid_top_level_operator(filter_query):
+                return {"error": "Invalid query: a top-level key cannot be a MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
+            if self.rollups is not None:
+                rewritten = self.rollups.rewrite_count(filter_query)
+                if rewritten is not None:
+                    rollup_name, rollup_pipeline = rewritten
+                    print(f"📦 Answering from rollup collection '{rollup_name}'.")
+                    totals = list(self.db[rollup_name].aggregate(rollup_pipeline))
+                    return {"type": "count", "results": totals[0]["count"] if totals else 0, "rollup": rollup_name}
+            parsed, sampled = self._govern(parsed, sample_size)
+            if sampled is not None:
+                return sampled
+            count = self.collection.count_documents(filter_query, **self._time_limit(parsed))
+            return {"type": "count", "results": count}
+
+    @staticmethod
+    def _time_limit(parsed):
+        max_time_ms = parsed.modifiers.get('max_time_ms')
+        return {"maxTimeMS": max_time_ms} if max_time_ms else {}
+
+    def _run_and_cache(self, parsed, sample_size=None):
+        if self.index_advisor is not None:
+            plan = self.index_advisor.analyze(parsed)
+            if plan.get("collscan") and plan.get("docs_examined") is not None:
+                print(f"🐢 Query runs as a COLLSCAN (examined {plan.get('docs_examined')} docs for {plan.get('returned')} results).")
+            elif plan.get("collscan"):
+                print("🐢 Query runs as a COLLSCAN.")
+        result = self._run_parsed_query(parsed, sample_size)
+        if self.result_cache is not None:
+            self.result_cache.put(parsed, result, sample_size)
+        return result
+
+    @staticmethod
+    def _empty_result(parsed, reason):
+        if parsed.method == 'count_documents':
+            return {"type": "count", "results": 0, "impossible": reason}
+        result = {"type": parsed.method, "results": [], "count": 0, "impossible": reason}
+        if parsed.method == 'distinct':
+            result["field"] = parsed.args[0]
+        return result
+
+    def _execute_mongodb_query(self, query_text, sample_size=None):
         if query_text.startswith("error:"):
             return {"error": query_text}
-        
+
         try:
-            if query_text.startswith('find('):
-                # Robustly extract the arguments inside find(...)
-                match = re.match(r'find\((.*)\)$', query_text.strip(), re.DOTALL)
-                if not match:
-                    return {"error": f"Invalid find query format: {query_text}"}
-                args_str = match.group(1).strip()
-                # Support both find(filter) and find(filter, projection)
-                if args_str:
-                    # Split on first comma not inside braces or brackets
-                    depth = 0
-                    split_idx = None
-                    for i, c in enumerate(args_str):
-                        if c in '{[':
-                            depth += 1
-                        elif c in '}]':
-                            depth -= 1
-                        elif c == ',' and depth == 0:
-                            split_idx = i
-                            break
-                    if split_idx is not None:
-                        filter_str = args_str[:split_idx].strip()
-                        projection_str = args_str[split_idx+1:].strip()
+            with self.instrumentation.stage('parse', bytes=len(query_text)):
+                parsed = parse_query(query_text)
+            if self.reject_impossible_filters:
+                reason = self.schema_profiler.check_query(parsed)
+                if reason:
+                    print(f"🚫 Filter cannot match any document ({reason}); skipping the database.")
+                    return self._empty_result(parsed, reason)
+            with self.instrumentation.stage('execute', method=parsed.method) as span:
+                result = None
+                if self.result_cache is not None:
+                    result = self.result_cache.get(parsed, sample_size)
+                    if result is not None:
+                        span.set(cached=True)
+                        print("♻️ Using cached query result.")
+                if result is None:
+                    if self._query_flight is not None:
+                        result, _ = self._query_flight.do(query_key(parsed, sample_size), self._run_and_cache, parsed, sample_size)
                     else:
-                        filter_str = args_str
-                        projection_str = None
-                else:
-                    filter_str = "{}"
-                    projection_str = None
-                # Evaluate filter
-                filter_query = self._safe_eval(filter_str)
-                if self._has_invalid_top_level_operator(filter_query):
-                    return {"error": "Invalid query: a top-level key cannot be a MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
-                # Evaluate projection if present
-                if projection_str:
-                    # Remove trailing .limit(...) if present
-                    projection_str = re.sub(r'\)\.limit\(\d+\)\s*$', '', projection_str)
-                    projection_str = re.sub(r'\.limit\(\d+\)\s*$', '', projection_str)
-                    try:
-                        projection = self._safe_eval(projection_str)
-                    except Exception as e:
-                        return {"error": f"Projection parsing error: {e}"}
-                    cursor = self.collection.find(filter_query, projection)
-                else:
-                    cursor = self.collection.find(filter_query)
-                # Support dynamic limit if specified in the query, otherwise return all matching records
-                match_limit = re.search(r'\.limit\((\d+)\)', query_text)
-                if match_limit:
-                    limit = int(match_limit.group(1))
-                    results = list(cursor.limit(limit))
-                    total_count = self.collection.count_documents(filter_query)
-                    return {"type": "find", "results": results, "count": len(results), "total_count": total_count}
-                else:
-                    results = list(cursor)
-                    return {"type": "find", "results": results, "count": len(results)}
-
-            elif query_text.startswith('aggregate('):
-                match = re.match(r'aggregate\((.*)\)$', query_text, re.DOTALL)
-                if not match: return {"error": f"Invalid aggregate query format: {query_text}"}
-                
-                pipeline = self._safe_eval(match.group(1).strip())
-                if not isinstance(pipeline, list):
-                    return {"error": f"Aggregation pipeline must be a list, but got {type(pipeline)} from '{query_text}'"}
-                
-                # Validate the $match stage if it exists
-                if pipeline and pipeline[0].get('$match'):
-                    if self._has_invalid_top_level_operator(pipeline[0]['$match']):
-                         return {"error": "Invalid aggregation: $match stage has a top-level MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
-
-                results = list(self.collection.aggregate(pipeline))
-                return {"type": "aggregate", "results": results, "count": len(results)}
-
-            elif query_text.startswith('distinct('):
-                # Support: distinct("field", filter) or distinct("field", filter, ...)
-                match = re.match(r'distinct\("([^"]+)"(?:,\s*(\{.*?\}))?(?:,\s*(\{.*?\}))?\)$', query_text, re.DOTALL)
-                if not match:
-                    return {"error": f"Invalid distinct query format: {query_text}"}
-                field_name = match.group(1)
-                filter_str = match.group(2).strip() if match.group(2) else "{}"
-                # Ignore any third argument (like limit) for distinct
-                filter_query = self._safe_eval(filter_str)
-                if self._has_invalid_top_level_operator(filter_query):
-                    return {"error": "Invalid query: a top-level key cannot be a MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
-                results = self.collection.distinct(field_name, filter_query)
-                return {"type": "distinct", "field": field_name, "results": results, "count": len(results)}
-
-            elif query_text.startswith('count_documents('):
-                match = re.match(r'count_documents\((.*)\)$', query_text, re.DOTALL)
-                if not match: return {"error": f"Invalid count_documents query format: {query_text}"}
-                
-                filter_str = match.group(1).strip() if match.group(1) else "{}"
-                filter_query = self._safe_eval(filter_str)
-
-                if self._has_invalid_top_level_operator(filter_query):
-                    return {"error": "Invalid query: a top-level key cannot be a MongoDB operator (like $gt, $lt). Please rephrase your question to specify a field."}
-
-                count = self.collection.count_documents(filter_query)
-                return {"type": "count", "results": count}
-
-            else:
-                return {"error": f"Unsupported query format. Query must start with find(...), aggregate(...), distinct(...), or count_documents(...). Received: '{query_text}'"}
+                        result = self._run_and_cache(parsed, sample_size)
+                span.set(docs=result.get('count', 0))
+            return result
 
+        except QueryRejected as qr:
+            return {"error": f"Query rejected by the cost guardrail: {qr}. Please narrow the question (e.g. a member, DCS or date range)."}
         except ValueError as ve:
              return {"error": f"Query Parsing Error: {str(ve)}"}
         except pymongo.errors.OperationFailure as oe:
@@ -328,10 +455,8 @@ You are an expert MongoDB query generator. Your ONLY task is to convert a user's
                 output += "\n"
                 results_to_show = results_data
             
-            # Clean up ObjectId for display
-            for doc in results_to_show:
-                if '_id' in doc:
-                    doc['_id'] = str(doc['_id'])
+            # Clean up ObjectId for display (on copies, results may be shared through the result cache)
+            results_to_show = [dict(doc, _id=str(doc['_id'])) if isinstance(doc, dict) and '_id' in doc else doc for doc in results_to_show]
 
             return output + json.dumps(results_to_show, indent=2, default=str)
 
@@ -343,9 +468,7 @@ You are an expert MongoDB query generator. Your ONLY task is to convert a user's
         valid_starts = ['find(', 'aggregate(', 'distinct(', 'count_documents(']
         return any(query_text.strip().startswith(v) for v in valid_starts)
 
-    def ask_question(self, user_question: str):
-        print(f"\n👤 User question: \"{user_question}\"")
-        
+    def _sample_size_for(self, user_question):
         # Determine sample size from question, default to 10
         sample_size = 10
         match = re.search(r'\b(top|first|last|show|list)\s+(\d+)\b', user_question, re.IGNORECASE)
@@ -354,23 +477,100 @@ You are an expert MongoDB query generator. Your ONLY task is to convert a user's
                 sample_size = int(match.group(2))
             except (ValueError, IndexError):
                 sample_size = 10
-        
-        print("🔄 Generating MongoDB query via LLM...")
-        mongo_query_str = self._natural_language_to_query(user_question)
+        return sample_size
+
+    def _answer_with_query(self, user_question, mongo_query_str):
         print(f" LLM generated query: {mongo_query_str}")
 
-        if not self._validate_llm_query(mongo_query_str):
+        with self.instrumentation.stage('validate'):
+            is_valid = self._validate_llm_query(mongo_query_str)
+        if not is_valid:
             print(" LLM did not return a valid MongoDB query format.")
             return f"Sorry, I could not generate a valid query. The LLM returned:\n{mongo_query_str}"
 
+        sample_size = self._sample_size_for(user_question)
         print("Executing MongoDB query...")
-        query_results_dict = self._execute_mongodb_query(mongo_query_str)
+        query_results_dict = self._execute_mongodb_query(mongo_query_str, sample_size=sample_size)
 
         if "error" in query_results_dict:
             return f" Query Execution Failed: {query_results_dict['error']}"
 
         print(" Formatting response...")
-        return self._format_results_to_natural_language(query_results_dict, sample_size=sample_size)
+        with self.instrumentation.stage('format', docs=min(query_results_dict.get('count', 0), sample_size)) as span:
+            answer = self._format_results_to_natural_language(query_results_dict, sample_size=sample_size)
+            if query_results_dict.get('impossible'):
+                answer = f"ℹ️ No record can match: {query_results_dict['impossible']}.\n" + answer
+            if query_results_dict.get('approximate'):
+                answer = (f"⚠️ Approximate answer from a random sample of {query_results_dict['sampled']:,} of the "
+                          f"{query_results_dict['matched']:,} matching documents (the exact query exceeded the cost budget; "
+                          f"totals are scaled up).\n") + answer
+            if query_results_dict.get('capped_at'):
+                answer = (f"✂️ Only the first {query_results_dict['capped_at']:,} results are shown "
+                          f"(result cap of the query policy); more may match.\n") + answer
+            span.set(bytes=len(answer))
+        return answer
+
+    def ask_question(self, user_question: str):
+        print(f"\n👤 User question: \"{user_question}\"")
+        print("🔄 Generating MongoDB query via LLM...")
+        with self.instrumentation.question(user_question):
+            mongo_query_str = self._natural_language_to_query(user_question)
+            return self._answer_with_query(user_question, mongo_query_str)
+
+    async def _ask_question_async(self, user_question, llm_executor, llm_slots, rate_limiter):
+        loop = asyncio.get_running_loop()
+        bind = self.instrumentation.bind
+        try:
+            with self.instrumentation.question(user_question):
+                mongo_query_str = self._local_query(user_question)
+                if mongo_query_str is None:
+                    async with llm_slots:
+                        if rate_limiter is not None:
+                            await rate_limiter.acquire()
+                        mongo_query_str = await loop.run_in_executor(llm_executor, bind(self._llm_query), user_question)
+                # MongoDB work runs on a shared thread pool; pymongo's connection pool is shared by all threads
+                return await loop.run_in_executor(self._query_executor, bind(self._answer_with_query), user_question, mongo_query_str)
+        except Exception as e:
+            return f"Sorry, answering this question failed: {e}"
+
+    async def iter_answers_async(self, questions, concurrency=8, requests_per_second=None):
+        """
+        Answers many questions concurrently and yields (index, question, answer) tuples as
+        they complete. At most `concurrency` LLM calls are in flight, started at no more
+        than `requests_per_second`; routed/cached questions skip both limits.
+        """
+        questions = list(questions)
+        llm_slots = asyncio.Semaphore(concurrency)
+        rate_limiter = AsyncRateLimiter(requests_per_second) if requests_per_second else None
+        started = time.perf_counter()
+        llm_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm")
+
+        async def answer(index, question):
+            return index, question, await self._ask_question_async(question, llm_executor, llm_slots, rate_limiter)
+
+        tasks = [asyncio.ensure_future(answer(i, q)) for i, q in enumerate(questions)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Never block the event loop on LLM calls still running when the caller stops early
+            llm_executor.shutdown(wait=False, cancel_futures=True)
+        elapsed = time.perf_counter() - started
+        print(f"📊 Answered {len(questions)} questions in {elapsed:.2f}s ({len(questions) / elapsed if elapsed else 0:.1f} questions/s)")
+
+    async def ask_questions_async(self, questions, concurrency=8, requests_per_second=None):
+        """Answers many questions concurrently and returns the answers in question order."""
+        questions = list(questions)
+        answers = [None] * len(questions)
+        async for index, _, answer in self.iter_answers_async(questions, concurrency, requests_per_second):
+            answers[index] = answer
+        return answers
+
+    def ask_questions(self, questions, concurrency=8, requests_per_second=None):
+        """Blocking batch API: runs ask_questions_async on a fresh event loop."""
+        return asyncio.run(self.ask_questions_async(questions, concurrency, requests_per_second))
 
     def get_sample_questions(self):
         return [
@@ -386,6 +586,40 @@ You are an expert MongoDB query generator. Your ONLY task is to convert a user's
             "What is the lowest quantity collected on 09-11-2024?"
         ]
 
+    def get_stats(self):
+        stats = {"routing": self.route_stats.snapshot(), "query_templates": self.query_cache.stats(), "prompt": self.prompt_builder.stats()}
+        if self.index_advisor is not None:
+            stats["index_advisor"] = self.index_advisor.stats()
+        if self.rollups is not None:
+            stats["rollups"] = self.rollups.stats()
+        if self.result_cache is not None:
+            stats["query_results"] = self.result_cache.stats()
+        if self._query_flight is not None:
+            stats["query_coalescing"] = self._query_flight.stats()
+        stats["schema"] = self.schema_profiler.stats()
+        if self.partitioned:
+            stats["partitions"] = self.collection.stats()
+        if self.governor is not None:
+            stats["query_governor"] = self.governor.stats()
+        if self.instrumentation.enabled:
+            stats["stages"] = self.instrumentation.snapshot()
+        return stats
+
+    def refresh_rollups(self, full=False):
+        if self.rollups is None:
+            return None
+        return self.rollups.refresh(full=full)
+
+    def get_index_recommendations(self):
+        if self.index_advisor is None:
+            return []
+        return self.index_advisor.recommend()
+
+    def create_recommended_indexes(self):
+        if self.index_advisor is None:
+            return []
+        return self.index_advisor.create_recommended_indexes()
+
 def main():
     print(" Welcome to MongoDB Bot ")
     try:
@@ -403,7 +637,8 @@ def main():
 
         bot = EnhancedMongoDBBot(GEMINI_API_KEY, MONGODB_CONNECTION_STRING)
         print("\n Enhanced MongoDB Bot is ready!")
-        print("Type 'samples' to see example questions, or 'quit' to exit.\n")
+        print("Type 'samples' to see example questions, 'stats' for routing and cache statistics, 'indexes' for index recommendations,")
+        print("'export <file.csv|.parquet|.arrow> <question>' to save a full result set, or 'quit' to exit.\n")
 
         while True:
             user_input = input(" Your question: ").strip()
@@ -416,6 +651,27 @@ def main():
                     print(f"{i}. {question}")
                 print("-------------------------------------\n")
                 continue
+            if user_input.lower() == 'stats':
+                print(json.dumps(bot.get_stats(), indent=2))
+                continue
+            if user_input.lower() == 'indexes':
+                recommendations = bot.get_index_recommendations()
+                if not recommendations:
+                    print("No index recommendations (enable index_advisor to collect explain plans).\n")
+                for rec in recommendations:
+                    print(f"- {rec['keys']}: {rec['queries']} queries, {rec['collscans']} COLLSCANs, {rec['docs_examined']} docs examined")
+                continue
+            if user_input.lower().startswith('export '):
+                parts = user_input.split(None, 2)
+                if len(parts) < 3:
+                    print("Usage: export <file.csv|.parquet|.arrow> <question>\n")
+                    continue
+                try:
+                    result = bot.export_question(parts[2], parts[1])
+                    print(f"💾 Exported {result['rows']} rows to {result['path']} in {result['seconds']}s\n")
+                except Exception as e:
+                    print(f" Export failed: {e}\n")
+                continue
             if not user_input:
                 continue
 